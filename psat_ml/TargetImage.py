@@ -2,10 +2,45 @@
 
 from astropy.io import fits as pyfits
 #import pyfits
-import pylab
+# pylab (matplotlib) is only imported by the visualise methods, so scoring doesn't pay for it.
 import random
 import numpy as np
 
+
+def readCentralRegion(hdu, extent):
+    """
+        Return a copy of the central 2*extent square of the HDU's image.
+
+        For tile-compressed (fpacked) stamps only the tiles overlapping the
+        centre are decompressed. Uncompressed images are memory mapped, so
+        slicing the data only reads the pages we need.
+    """
+    # NOTE: the centre is taken from the row length (number of columns) on both axes, as it always has been.
+    shape = hdu.shape
+    imageCentre = shape[-1]/2.0
+    lower = int(imageCentre-extent)
+    upper = int(imageCentre+extent)
+
+    if isinstance(hdu, pyfits.CompImageHDU) and len(shape) == 2 and lower >= 0 and upper <= min(shape):
+        try:
+            return np.array(hdu.section[lower:upper, lower:upper])
+        except AttributeError:
+            # Older versions of astropy have no section for compressed images.
+            pass
+
+    data = hdu.data # think this reads in x and y opposite to ds9 see docs
+    return np.array(data[lower:upper, lower:upper])
+
+
+def readStamp(fitsFile, extent=10, extension=1):
+    """
+        Open the FITS file and return the central 2*extent square of the image
+        in the extension, closing the file straight away.
+    """
+    with pyfits.open(fitsFile) as hdulist:
+        return readCentralRegion(hdulist[extension], extent)
+
+
 class TargetImage(object):
 
     # 2023-08-21 KWS Introduced magicNumber for ATLAS integer images.
@@ -35,13 +70,9 @@ class TargetImage(object):
         #    print("Problem opening %s" % pathAndFitsFile)
         #    raise IOError
 
-        hdulist = pyfits.open(pathAndFitsFile)
+        # Read only the central region and close the file straight away.
+        image = readStamp(pathAndFitsFile, extent, extension)
 
-        data = hdulist[extension].data # think this reads in x and y opposite to ds9 see docs
-        maxX = np.shape(data[0])
-        maxY = np.shape(data[1])
-        imageCentre = (maxX[0]/2.0, maxY[0]/2.0) # changed to float division, shouldn't make a difference
-        image = data[int(imageCentre[0]-extent): int(imageCentre[0]+extent),int(imageCentre[0]-extent): int(imageCentre[0]+extent)]
         if magicNumber is not None:
             image[image==magicNumber] = 0
         # print(image)
@@ -57,6 +88,7 @@ class TargetImage(object):
         return self.fitsFile
 
     def visualiseObject(self, cmap="hot"):
+        import pylab
         pylab.ion()
         #pylab.set_cmap("gray")
         pylab.gray()
@@ -135,6 +167,7 @@ class TargetImage(object):
 
     
     def visualiseNormObject(self):
+        import pylab
         shape = (2*self.extent, 2*self.extent)
         pylab.ion()
         pylab.clf()
@@ -150,3 +183,129 @@ class TargetImage(object):
         pylab.xlabel("Pixels")
         pylab.ylabel("Pixels")
         pylab.show()
+
+
+# TargetImageBatch works through its stamps this many at a time, so that the
+# temporary arrays stay in the CPU cache rather than each operation streaming
+# the whole stack through memory.
+BATCH_BLOCK_SIZE = 1024
+
+
+class TargetImageBatch(object):
+
+    def __init__(self, images, extent=10, magicNumber=None, fitsFiles=None):
+        """
+            The batch counterpart of TargetImage: a stack of stamps on which each
+            normalisation is done as a handful of whole-array operations, with
+            per-stamp statistics, rather than one stamp at a time.
+
+            images: (N, 2*extent, 2*extent) array of the central regions of the
+            stamps, as TargetImage.getObject would return them. They are copied
+            to a float32 array with the magic number pixels, NaNs and infinities
+            set to 0 (the TargetImage methods call nan_to_num every time).
+
+            Each normalisation returns an (N, 2*extent, 2*extent) float32 array,
+            each stamp normalised as its TargetImage method would. A stamp with
+            no spread (e.g. a blank one) comes out as 0 rather than NaN or inf.
+            unravel turns the stamps into the Fortran ordered vectors that
+            TargetImage returns.
+        """
+        images = np.asarray(images)
+        self.extent = extent
+        self.fitsFiles = fitsFiles
+        self.object = np.empty(images.shape, dtype=np.float32)
+        for block in self._blocks():
+            stamps = self.object[block]
+            stamps[...] = images[block]
+            if magicNumber is not None:
+                np.copyto(stamps, 0, where=images[block]==magicNumber)
+            stamps[~np.isfinite(stamps)] = 0
+
+    @classmethod
+    def fromFiles(cls, fitsFiles, extent=10, extension=1, magicNumber=None):
+        """
+            Read the central region of each FITS file into a new batch.
+        """
+        images = np.zeros((len(fitsFiles), 2*extent, 2*extent), dtype=np.float32)
+        for i, fitsFile in enumerate(fitsFiles):
+            images[i] = readStamp(fitsFile, extent, extension)
+        return cls(images, extent, magicNumber=magicNumber, fitsFiles=fitsFiles)
+
+    def __len__(self):
+        return len(self.object)
+
+    def getObjects(self):
+        return self.object
+
+    def _blocks(self):
+        for start in range(0, len(self.object), BATCH_BLOCK_SIZE):
+            yield slice(start, start + BATCH_BLOCK_SIZE)
+
+    def _normalise(self, normalise):
+        """
+            Call normalise(stamps, out) on each block of stamps, writing into a new array.
+        """
+        out = np.empty_like(self.object)
+        for block in self._blocks():
+            normalise(self.object[block], out[block])
+        return out
+
+    @staticmethod
+    def _spread(spread):
+        """
+            Per-stamp divisor, with zeros made infinite so stamps with no spread divide to 0.
+        """
+        spread[spread==0] = np.inf
+        return spread
+
+    @staticmethod
+    def unravel(images):
+        """
+            Return each stamp as a row vector in Fortran order, i.e. an (N, 4*extent*extent)
+            array whose rows are what the TargetImage methods return.
+        """
+        return np.transpose(images, (0, 2, 1)).reshape(len(images), -1)
+
+    def unravelObject(self):
+        return self.unravel(self.object)
+
+    def rescale(self):
+        """
+            Rescale each stamp such that the data lie in the range [0,1] or [-1,1].
+        """
+        def rescale(stamps, out):
+            np.abs(stamps, out=out)
+            np.divide(stamps, self._spread(out.max(axis=(1,2), keepdims=True)), out=out)
+        return self._normalise(rescale)
+
+    def meanSubtract(self):
+        """
+            Subtract the mean of each stamp.
+        """
+        def meanSubtract(stamps, out):
+            np.subtract(stamps, stamps.mean(axis=(1,2), keepdims=True), out=out)
+        return self._normalise(meanSubtract)
+
+    def featureStandardisation(self):
+        """
+            Subtract the mean of each stamp, rescale it to [-1,1], then divide by
+            its standard deviation.
+        """
+        def featureStandardisation(stamps, out):
+            np.subtract(stamps, stamps.mean(axis=(1,2), keepdims=True), out=out)
+            out /= self._spread(np.abs(out).max(axis=(1,2), keepdims=True))
+            out /= self._spread(out.std(axis=(1,2), keepdims=True))
+        return self._normalise(featureStandardisation)
+
+    def signPreserveNorm(self):
+        """
+            The sign preserving normalisation of each stamp, sign(x)*log(1+|x|/sigma),
+            where sigma is the standard deviation of the stamp.
+        """
+        def signPreserveNorm(stamps, out):
+            std = self._spread(stamps.std(axis=(1,2), keepdims=True))
+            np.abs(stamps, out=out)
+            out /= std
+            np.log1p(out, out=out)
+            np.copysign(out, stamps, out=out)
+        return self._normalise(signPreserveNorm)
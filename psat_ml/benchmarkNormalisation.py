@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Compare normalising stamps one at a time (TargetImage) with normalising them all at once (TargetImageBatch).
+
+Usage:
+  %s [--stamps=<stamps>] [--extent=<extent>] [--magicNumber=<magicNumber>] [--norms=<norms>] [--seed=<seed>]
+  %s (-h | --help)
+  %s --version
+
+Options:
+  -h --help                      Show this screen.
+  --version                      Show version.
+  --stamps=<stamps>              Number of synthetic stamps to normalise [default: 100000].
+  --extent=<extent>              Half width of the stamps [default: 10].
+  --magicNumber=<magicNumber>    Magic number given to about 1%% of the pixels, to be masked [default: -31415].
+  --norms=<norms>                Comma separated normalisations to compare [default: signPreserveNorm,featureStandardisation,meanSubtract,rescale].
+  --seed=<seed>                  Random seed for the stamps [default: 0].
+
+The stamps are integer difference image pixels with a few magic number pixels
+and a few blank stamps. Only the normalisation is timed, not reading the files.
+The largest difference between the two is reported for each normalisation.
+
+Example:
+  python %s --stamps=1000000 --norms=signPreserveNorm
+
+"""
+import sys
+__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+from docopt import docopt
+from gkutils.commonutils import Struct, cleanOptions
+import time
+import numpy as np
+from TargetImage import TargetImage, TargetImageBatch
+
+
+def makeStamps(n, extent, magicNumber, seed = 0):
+    """Return n random (2*extent, 2*extent) integer stamps."""
+    random = np.random.RandomState(seed)
+    stamps = np.rint(random.normal(0, 50, (n, 2*extent, 2*extent))).astype(np.int32)
+    stamps[random.random_sample(stamps.shape) < 0.01] = magicNumber
+    # Some stamps are off the edge of the chip and blank.
+    stamps[random.random_sample(n) < 0.001] = 0
+    return stamps
+
+
+def singleStampNorm(stamps, extent, magicNumber, norm):
+    """Normalise each stamp with TargetImage. Returns the vectors, one row per stamp."""
+    vectors = np.zeros((len(stamps), 4*extent*extent), dtype = np.float32)
+    for i in range(len(stamps)):
+        # Build the TargetImage around the pixels we already have rather than a file.
+        image = TargetImage.__new__(TargetImage)
+        image.extent = extent
+        image.object = stamps[i].copy()
+        image.object[image.object==magicNumber] = 0
+        vectors[i] = np.nan_to_num(getattr(image, norm)())
+    return vectors
+
+
+def batchNorm(stamps, extent, magicNumber, norm):
+    """Normalise all the stamps with TargetImageBatch. Returns the vectors, one row per stamp."""
+    batch = TargetImageBatch(stamps, extent, magicNumber = magicNumber)
+    return TargetImageBatch.unravel(getattr(batch, norm)())
+
+
+def benchmarkNormalisation(opts):
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    if type(opts) is dict:
+        options = Struct(**opts)
+    else:
+        options = opts
+
+    extent = int(options.extent)
+    magicNumber = int(options.magicNumber)
+    stamps = makeStamps(int(options.stamps), extent, magicNumber, seed = int(options.seed))
+    print("%d stamps of %dx%d pixels" % (len(stamps), 2*extent, 2*extent))
+
+    with np.errstate(all = 'ignore'):
+        for norm in options.norms.split(','):
+            start = time.perf_counter()
+            single = singleStampNorm(stamps, extent, magicNumber, norm)
+            singleSeconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            batch = batchNorm(stamps, extent, magicNumber, norm)
+            batchSeconds = time.perf_counter() - start
+
+            print("%-24s one at a time %8.2fs (%9.0f stamps/s), batch %8.3fs (%10.0f stamps/s), %6.1fx faster, largest difference %.2g" % (norm, singleSeconds, len(stamps) / singleSeconds, batchSeconds, len(stamps) / batchSeconds, singleSeconds / batchSeconds, np.abs(single - batch).max()))
+
+
+def main():
+    opts = docopt(__doc__, version='0.1')
+    opts = cleanOptions(opts)
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    options = Struct(**opts)
+    benchmarkNormalisation(options)
+
+
+if __name__=='__main__':
+    main()
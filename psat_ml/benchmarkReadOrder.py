@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""Compare how fast the stamps are read in database order and in locality order.
+
+Usage:
+  %s <configFile> [<candidate>...] [--listid=<listid>] [--imageroot=<imageroot>] [--querychunksize=<querychunksize>] [--limit=<limit>] [--orders=<orders>] [--repeats=<repeats>] [--batchsize=<batchsize>] [--readthreads=<readthreads>] [--fitsextension=<fitsextension>] [--magicNumber=<magicNumber>] [--keepcache] [--outputcsv=<outputcsv>]
+  %s --filelist=<filelist> [--limit=<limit>] [--orders=<orders>] [--repeats=<repeats>] [--batchsize=<batchsize>] [--readthreads=<readthreads>] [--fitsextension=<fitsextension>] [--magicNumber=<magicNumber>] [--keepcache] [--outputcsv=<outputcsv>]
+  %s (-h | --help)
+  %s --version
+
+Options:
+  -h --help                          Show this screen.
+  --version                          Show version.
+  --filelist=<filelist>              File of image filenames, one per line, in database order, instead of asking the database.
+  --listid=<listid>                  List ID whose objects' images are read [default: 4].
+  --imageroot=<imageroot>            Root location of the actual images [default: /db4/images/].
+  --querychunksize=<querychunksize>  Number of objects whose images are looked up in each database query [default: 1000].
+  --limit=<limit>                    Read at most this many images (the first ones in database order) [default: 100000].
+  --orders=<orders>                  Comma separated read orders to compare (db, locality) [default: db,locality].
+  --repeats=<repeats>                Number of times to read the images in each order. The fastest is reported [default: 3].
+  --batchsize=<batchsize>            Number of images read at a time [default: 1024].
+  --readthreads=<readthreads>        Number of threads reading and normalising the stamps [default: 4].
+  --fitsextension=<fitsextension>    FITS extension holding the image (0 for ATLAS, 1 for Pan-STARRS) [default: 0].
+  --magicNumber=<magicNumber>        Magic number used to mask bad pixels in integer image files (ATLAS only).
+  --keepcache                        Don't drop the files from the page cache before each read. By default they are dropped, so every read comes from the disk or NFS server.
+  --outputcsv=<outputcsv>            Append the results to this CSV file, so the mounts can be compared over time.
+
+The images are read and normalised exactly as the scorers read them (without
+predicting), once per repeat in each order. Before each read the files are
+dropped from this machine's page cache (posix_fadvise DONTNEED), so run it when
+nothing else is reading the same images. The filesystem each image directory is
+on is reported, so spinning disk and NFS runs can be told apart.
+
+Example:
+  python %s /usr/local/ps1code/gitrelease/atlas/config/config4_db1_readonly.yaml --listid=4 --limit=20000 --magicNumber=-31415 --outputcsv=/tmp/readorder.csv
+  python %s --filelist=/tmp/images_in_db_order.txt --fitsextension=1 --orders=db,locality
+
+"""
+import sys
+__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+from docopt import docopt
+from gkutils.commonutils import Struct, cleanOptions, dbConnect
+import os, time, datetime
+from collections import Counter
+from stampReader import readStampBatches, localityOrder
+
+READ_ORDERS = ['db', 'locality']
+
+
+def mountOf(path):
+    """Return (mount point, filesystem type) of the filesystem the path is on, from /proc/mounts."""
+    path = os.path.realpath(path)
+    best = ('/', 'unknown')
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                mountPoint, fsType = fields[1], fields[2]
+                if (path == mountPoint or path.startswith(mountPoint.rstrip('/') + '/')) and len(mountPoint) >= len(best[0]):
+                    best = (mountPoint, fsType)
+    except OSError:
+        pass
+    return best
+
+
+def dropFromCache(imageFilenames):
+    """Ask the kernel to drop the files from the page cache, so the next read goes to the disk."""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for imageFilename in imageFilenames:
+        try:
+            fd = os.open(imageFilename, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    return True
+
+
+def readImages(imageFilenames, readOrder, options):
+    """Read (and normalise) all the images in the given order. Returns the seconds taken."""
+    if readOrder == 'locality':
+        imageFilenames = [imageFilenames[i] for i in localityOrder(imageFilenames)]
+
+    magicNumber = int(options.magicNumber) if options.magicNumber is not None else None
+    start = time.perf_counter()
+    for offset, batch in readStampBatches(imageFilenames, batchSize = int(options.batchsize), extension = int(options.fitsextension), magicNumber = magicNumber, readThreads = int(options.readthreads), readAhead = (readOrder == 'locality')):
+        pass
+    return time.perf_counter() - start
+
+
+def getImageFilenames(options):
+    """Return the image filenames in database order, from the file list or the database."""
+    if options.filelist:
+        with open(options.filelist) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    from runKerasTensorflowClassifierOnPSATImages import getObjectsByList, getImages
+
+    import yaml
+    with open(options.configFile) as yaml_file:
+        config = yaml.load(yaml_file)
+
+    username = config['databases']['local']['username']
+    password = config['databases']['local']['password']
+    database = config['databases']['local']['database']
+    hostname = config['databases']['local']['hostname']
+
+    conn = dbConnect(hostname, username, password, database)
+    if not conn:
+        print("Cannot connect to the database")
+        return None
+
+    # Read the images the way the scorer finds them, but in the database's order.
+    if len(options.candidate) > 0:
+        objectList = [{'id': int(candidate)} for candidate in options.candidate]
+    else:
+        objectList = getObjectsByList(conn, database, listId = int(options.listid))
+
+    imageFilenames = [row['filename'] for row in getImages(conn, database, objectList, imageRoot = options.imageroot, chunkSize = int(options.querychunksize))]
+    conn.close()
+    return imageFilenames
+
+
+def benchmarkReadOrder(opts):
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    if type(opts) is dict:
+        options = Struct(**opts)
+    else:
+        options = opts
+
+    imageFilenames = getImageFilenames(options)
+    if not imageFilenames:
+        print("No images to read")
+        return 1
+    imageFilenames = imageFilenames[:int(options.limit)]
+
+    orders = [order.strip() for order in options.orders.split(',')]
+    for order in orders:
+        if order not in READ_ORDERS:
+            print("Unknown read order %s. Choose from %s." % (order, ', '.join(READ_ORDERS)))
+            return 1
+
+    directories = Counter(os.path.dirname(f) for f in imageFilenames)
+    mounts = Counter(mountOf(directory) for directory in directories)
+    print("%d images in %d directories on %s" % (len(imageFilenames), len(directories), ', '.join('%s (%s)' % mount for mount in mounts)))
+
+    # Count how often consecutive reads change directory, which is what costs the seeks.
+    for order in orders:
+        ordered = imageFilenames if order == 'db' else [imageFilenames[i] for i in localityOrder(imageFilenames)]
+        switches = sum(1 for a, b in zip(ordered, ordered[1:]) if os.path.dirname(a) != os.path.dirname(b))
+        print("%-8s order: %d directory changes" % (order, switches))
+
+    dropCache = not options.keepcache
+    if dropCache and not hasattr(os, 'posix_fadvise'):
+        print("WARNING: Can't drop the files from the page cache on this system. Reads after the first may come from memory.")
+
+    results = []
+    for order in orders:
+        best = None
+        for i in range(int(options.repeats)):
+            if dropCache:
+                dropFromCache(imageFilenames)
+            seconds = readImages(imageFilenames, order, options)
+            print("%-8s order, read %d: %.2fs (%.1f images/s)" % (order, i + 1, seconds, len(imageFilenames) / seconds))
+            if best is None or seconds < best:
+                best = seconds
+        results.append((order, best))
+
+    baseline = dict(results).get('db')
+    for order, seconds in results:
+        speedUp = " (%.2fx db order)" % (baseline / seconds) if baseline else ""
+        print("%-8s order: %.2fs, %.1f images/s%s" % (order, seconds, len(imageFilenames) / seconds, speedUp))
+
+    if options.outputcsv is not None:
+        writeHeader = not os.path.exists(options.outputcsv)
+        date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        mount = ';'.join('%s:%s' % m for m in mounts)
+        with open(options.outputcsv, 'a') as f:
+            if writeHeader:
+                f.write('date,mounts,order,images,directories,seconds,images_per_second,cache_dropped\n')
+            for order, seconds in results:
+                f.write('%s,%s,%s,%d,%d,%f,%f,%s\n' % (date, mount, order, len(imageFilenames), len(directories), seconds, len(imageFilenames) / seconds, dropCache))
+
+    return 0
+
+
+def main():
+    opts = docopt(__doc__, version='0.1')
+    opts = cleanOptions(opts)
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    options = Struct(**opts)
+    benchmarkReadOrder(options)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+"""End-to-end benchmark of the scorers and buildMLDataSet on synthetic stamps, without the production database.
+
+Usage:
+  %s <workdir> [--sizes=<sizes>] [--surveys=<surveys>] [--benchmarks=<benchmarks>] [--imagesperobject=<imagesperobject>] [--stampsize=<stampsize>] [--classifier=<classifier>] [--backend=<backend>] [--workers=<workers>] [--chunksize=<chunksize>] [--batchsize=<batchsize>] [--readthreads=<readthreads>] [--outputcsv=<outputcsv>]
+  %s (-h | --help)
+  %s --version
+
+Options:
+  -h --help                              Show this screen.
+  --version                              Show version.
+  --sizes=<sizes>                        Comma separated numbers of objects to score [default: 1000,100000,1000000].
+  --surveys=<surveys>                    Comma separated surveys: atlas (uncompressed integer stamps with magic number pixels) and ps1 (fpacked float stamps) [default: atlas,ps1].
+  --benchmarks=<benchmarks>              Comma separated benchmarks to run: single (runKerasTensorflowClassifierOnPSATImages), multiprocess (runKerasTensorflowClassifierOnPSATImagesMultiprocess) and build (buildMLDataSet) [default: single,multiprocess,build].
+  --imagesperobject=<imagesperobject>    Number of diff stamps per object [default: 2].
+  --stampsize=<stampsize>                Width and height of the synthetic stamps in pixels [default: 60].
+  --classifier=<classifier>              PSAT-D classifier to score with. Defaults to one with random weights, which is enough to measure throughput.
+  --backend=<backend>                    Inference backend passed to the scorers [default: numpy].
+  --workers=<workers>                    Number of workers for the multiprocess scorer [default: 8].
+  --chunksize=<chunksize>                Number of objects handed to a worker at a time [default: 100].
+  --batchsize=<batchsize>                Number of images read and scored at a time [default: 1024].
+  --readthreads=<readthreads>            Number of threads reading the stamps [default: 4].
+  --outputcsv=<outputcsv>                Append the results to this CSV file, so regressions are visible over time.
+
+The stamps are written once, under <workdir>/images, for the largest size and
+reused by the smaller ones and by later runs. Each size has its own SQLite
+database standing in for MySQL, with atlas_diff_objects, tcs_transient_objects
+and tcs_postage_stamp_images rows for its objects. The few MySQL functions
+the scorers' queries use are provided by the stand-in. SQLite can't take as
+many objects in one image query as MySQL, so they are looked up 200 at a time.
+
+Each benchmark runs in a fresh process, so its peak RSS is its own. Output of
+the scorers goes to <workdir>/logs and their per-stage timings to
+<workdir>/metrics.jsonl.
+
+MySQLdb must still be importable (the scorers import it for its cursor and
+error classes), but no MySQL server is used.
+
+Example:
+  python %s /tmp/benchmark --sizes=1000,100000 --surveys=atlas --outputcsv=/tmp/benchmark.csv
+  python %s /scratch/benchmark --classifier=/usr/local/ps1code/gitrelease/tf_trained_classifiers/02a_asteroids_good330000_bad990000_s3_20230405_classifier.h5 --backend=keras
+
+"""
+import sys
+__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+from docopt import docopt
+from gkutils.commonutils import Struct, cleanOptions
+import os, re, io, time, datetime, sqlite3, resource, multiprocessing
+import numpy as np
+
+MAGIC_NUMBER = -31415
+LIST_ID = 4
+FIRST_OBJECT_ID = 1000000000000
+FIRST_MJD = 59000
+IMAGES_PER_NIGHT = 20000
+TEMPLATES = 64
+EXTENT = 10
+# SQLite limits the depth of an expression to 1000, which a query for 1000 objects' images exceeds.
+QUERY_CHUNK_SIZE = 200
+
+SURVEYS = {'atlas': {'database': 'atlasbench', 'objectTable': 'atlas_diff_objects', 'classifierOption': '--hkoclassifier', 'extension': 0, 'magicNumber': MAGIC_NUMBER},
+           'ps1':   {'database': 'ps1bench', 'objectTable': 'tcs_transient_objects', 'classifierOption': '--ps1classifier', 'extension': 1, 'magicNumber': None}}
+
+SCHEMA = """
+    create table if not exists atlas_diff_objects (id integer primary key, detection_list_id integer, zooniverse_score real);
+    create table if not exists tcs_transient_objects (id integer primary key, detection_list_id integer, confidence_factor real, tcs_images_id integer, followup_id integer);
+    create table if not exists tcs_postage_stamp_images (id integer primary key, image_filename text, pss_filename text, mjd_obs real, filter text, image_type text, pss_error_code integer);
+    create index if not exists idx_image_filename on tcs_postage_stamp_images (image_filename);
+"""
+
+# MySQL's concat of bound values and string literals, e.g. concat(%s, '%%'), is folded
+# into a single bound value so that SQLite can use the image_filename index for the LIKE.
+FOLDABLE_CONCAT = re.compile(r"concat\(\s*((?:%s|'[^']*')(?:\s*,\s*(?:%s|'[^']*'))*)\s*\)")
+PLACEHOLDER = re.compile(r"%s|%%")
+UPDATE_JOIN = re.compile(r"update\s+(\w+)\s+t\s+join\s+\((.*)\)\s+s\s+on\s+s\.id\s*=\s*t\.id\s+set\s+t\.(\w+)\s*=\s*s\.score", re.S)
+
+
+def mysqlConcat(*args):
+    if any(a is None for a in args):
+        return None
+    return ''.join(str(a) for a in args)
+
+
+def mysqlTruncate(x, d):
+    if x is None:
+        return None
+    if d <= 0:
+        return int(x)
+    return int(x * 10 ** d) / 10 ** d
+
+
+def updateFrom(match):
+    """MySQL's update ... join (select ? as id, ? as score union all ...) as SQLite's update ... from (values ...),
+       which isn't subject to the limit on the number of selects in a union.
+    """
+    table, scores, column = match.groups()
+    rows = len(re.findall(r'\bselect\b', scores))
+    return 'update %s as t set %s = s.score from (select column1 as id, column2 as score from (values %s)) s where s.id = t.id' % (table, column, ', '.join(['(?, ?)'] * rows))
+
+
+def translateQuery(query, parameters):
+    """Turn a MySQLdb query (%s placeholders, MySQL functions) into an SQLite one (? placeholders)."""
+    if parameters is not None:
+        parameters = list(parameters)
+        values = []
+        pieces = []
+        position = 0
+        consumed = 0
+
+        def literal(arg):
+            return arg[1:-1].replace('%%', '%')
+
+        for match in re.finditer(FOLDABLE_CONCAT.pattern + '|' + PLACEHOLDER.pattern, query):
+            pieces.append(query[position:match.start()])
+            position = match.end()
+            token = match.group(0)
+            if token == '%%':
+                pieces.append('%')
+            elif token == '%s':
+                pieces.append('?')
+                values.append(parameters[consumed])
+                consumed += 1
+            else:
+                folded = ''
+                for arg in re.findall(r"%s|'[^']*'", match.group(1)):
+                    if arg == '%s':
+                        folded += str(parameters[consumed])
+                        consumed += 1
+                    else:
+                        folded += literal(arg)
+                pieces.append('?')
+                values.append(folded)
+        pieces.append(query[position:])
+        query = ''.join(pieces)
+        parameters = values
+
+    query = re.sub(r'\bif\(', 'iif(', query)
+    query = UPDATE_JOIN.sub(updateFrom, query)
+    return query, parameters
+
+
+class StandInCursor(object):
+    """Just enough of a MySQLdb DictCursor for the scorers."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.rowcount = -1
+
+    def execute(self, query, parameters = None):
+        query, parameters = translateQuery(query, parameters)
+        cursor = self.connection.db.execute(query, parameters or [])
+        if cursor.description is not None:
+            names = [d[0] for d in cursor.description]
+            self.rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+        else:
+            self.rows = []
+        self.rowcount = cursor.rowcount
+        if self.connection.autocommitOn:
+            self.connection.db.commit()
+        return self.rowcount
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def close(self):
+        pass
+
+
+class StandInConnection(object):
+    """Just enough of a MySQLdb connection, backed by an SQLite file."""
+
+    def __init__(self, dbFile):
+        self.db = sqlite3.connect(dbFile, timeout = 600)
+        self.db.create_function('concat', -1, mysqlConcat)
+        self.db.create_function('truncate', 2, mysqlTruncate)
+        # Lets the prefix LIKEs use the image_filename index.
+        self.db.execute('pragma case_sensitive_like = on')
+        self.autocommitOn = False
+
+    def cursor(self, cursorClass = None):
+        return StandInCursor(self)
+
+    def autocommit(self, on):
+        self.autocommitOn = on
+        if on:
+            self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+
+def standInConnect(hostname, username, password, database):
+    """Replacement for gkutils dbConnect. The hostname is the SQLite file."""
+    return StandInConnection(hostname)
+
+
+def makeStampTemplates(survey, stampSize, n = TEMPLATES, seed = 0):
+    """Return n FITS files (as bytes) of noise, half with a source in the middle. ATLAS ones
+       are integer images with magic number pixels, PS1 ones fpacked float images.
+    """
+    from astropy.io import fits as pyfits
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:stampSize, 0:stampSize]
+    centre = (stampSize - 1) / 2.0
+    source = np.exp(-((x - centre) ** 2 + (y - centre) ** 2) / (2 * 1.5 ** 2))
+
+    templates = []
+    for i in range(n):
+        data = rng.normal(0, 10, (stampSize, stampSize))
+        if i % 2 == 0:
+            data += rng.uniform(50, 500) * source
+        f = io.BytesIO()
+        if survey == 'atlas':
+            data = np.rint(data).astype(np.int32)
+            # A few bad pixels, and on some stamps a masked chip edge.
+            data[rng.rand(stampSize, stampSize) < 0.01] = MAGIC_NUMBER
+            if i % 4 == 1:
+                data[:, :rng.randint(1, stampSize // 4)] = MAGIC_NUMBER
+            pyfits.PrimaryHDU(data).writeto(f)
+        else:
+            pyfits.HDUList([pyfits.PrimaryHDU(), pyfits.CompImageHDU(data.astype(np.float32))]).writeto(f)
+        templates.append(f.getvalue())
+    return templates
+
+
+def imageRows(survey, n, imagesPerObject):
+    """Generator of (objectId, image_filename, pss_filename, mjd_obs, filter, night) for the first n objects."""
+    for i in range(n):
+        objectId = FIRST_OBJECT_ID + i
+        for j in range(imagesPerObject):
+            k = i * imagesPerObject + j
+            mjd = FIRST_MJD + k // IMAGES_PER_NIGHT
+            if survey == 'atlas':
+                pssFilename = '02a%05do%04dc' % (mjd, k % 10000)
+                imageFilename = '%d_%s_%d' % (objectId, pssFilename, j)
+                yield objectId, imageFilename, pssFilename, mjd + 0.5, 'o', mjd
+            else:
+                pssFilename = 'rings.v3.skycell.%04d.%03d.wrp.w.%05d' % (k % 2643, j, mjd)
+                imageFilename = '%d_tdiff_%d_%d' % (objectId, mjd, j)
+                yield objectId, imageFilename, pssFilename, mjd + 0.5, 'w.00000', mjd
+
+
+def writeFiles(filenames, templates):
+    """Write each file as a copy of one of the templates, making the directories as needed."""
+    directories = set()
+    for i, filename in enumerate(filenames):
+        directory = os.path.dirname(filename)
+        if directory not in directories:
+            os.makedirs(directory, exist_ok = True)
+            directories.add(directory)
+        with open(filename, 'wb') as f:
+            f.write(templates[i % len(templates)])
+        if (i + 1) % 100000 == 0:
+            print("    %d stamps written" % (i + 1))
+
+
+def generateStamps(workdir, survey, n, imagesPerObject, stampSize):
+    """Write the diff stamps of the first n objects, unless a previous run already has."""
+    done = os.path.join(workdir, 'images', '%s_%d_%d_%d.done' % (survey, n, imagesPerObject, stampSize))
+    if os.path.exists(done):
+        return
+    print("Writing %d %s stamps..." % (n * imagesPerObject, survey))
+    imageRoot = os.path.join(workdir, 'images', SURVEYS[survey]['database'])
+    writeFiles((os.path.join(imageRoot, str(night), imageFilename + '.fits') for objectId, imageFilename, pssFilename, mjd, filt, night in imageRows(survey, n, imagesPerObject)), makeStampTemplates(survey, stampSize))
+    open(done, 'w').close()
+
+
+def generateTrainingStamps(workdir, survey, n, stampSize):
+    """Write n/2 good and n/2 bad stamps, and their lists, for buildMLDataSet. Returns the (good, bad) list files."""
+    trainingDir = os.path.join(workdir, 'training', survey)
+    goodFile = os.path.join(trainingDir, 'good_%d.txt' % n)
+    badFile = os.path.join(trainingDir, 'bad_%d.txt' % n)
+    done = os.path.join(trainingDir, '%d_%d.done' % (n, stampSize))
+    if not os.path.exists(done):
+        print("Writing %d %s training stamps..." % (n, survey))
+        templates = makeStampTemplates(survey, stampSize, seed = 1)
+        lists = {}
+        for label, listFile in (('good', goodFile), ('bad', badFile)):
+            # Several stamps per object, as buildMLDataSet groups them by object.
+            names = ['%d_%d.fits' % (FIRST_OBJECT_ID + i // 2, i % 2) for i in range(n // 2)]
+            writeFiles((os.path.join(trainingDir, label, name) for name in names), templates)
+            with open(listFile, 'w') as f:
+                f.write('\n'.join(names) + '\n')
+        open(done, 'w').close()
+    return goodFile, badFile
+
+
+def createDatabase(workdir, survey, n, imagesPerObject):
+    """Create (or reset) the SQLite stand-in for the first n objects. Returns the database file."""
+    dbFile = os.path.join(workdir, '%s_%d_%d.sqlite' % (survey, n, imagesPerObject))
+    table = SURVEYS[survey]['objectTable']
+    db = sqlite3.connect(dbFile)
+    if not os.path.exists(dbFile + '.done'):
+        print("Creating the %s database for %d objects..." % (survey, n))
+        db.execute('pragma journal_mode = wal')
+        db.executescript(SCHEMA)
+        if survey == 'atlas':
+            db.executemany('insert into atlas_diff_objects (id, detection_list_id) values (?, ?)', ((FIRST_OBJECT_ID + i, LIST_ID) for i in range(n)))
+        else:
+            db.executemany('insert into tcs_transient_objects (id, detection_list_id, tcs_images_id, followup_id) values (?, ?, 1, ?)', ((FIRST_OBJECT_ID + i, LIST_ID, i) for i in range(n)))
+        db.executemany("insert into tcs_postage_stamp_images (image_filename, pss_filename, mjd_obs, filter, image_type, pss_error_code) values (?, ?, ?, ?, 'diff', 0)", ((imageFilename, pssFilename, mjd, filt) for objectId, imageFilename, pssFilename, mjd, filt, night in imageRows(survey, n, imagesPerObject)))
+        db.commit()
+        open(dbFile + '.done', 'w').close()
+    else:
+        # Unscore the objects so the scorers pick them up again.
+        db.execute('update %s set %s = null' % (table, 'zooniverse_score' if survey == 'atlas' else 'confidence_factor'))
+        db.commit()
+    db.close()
+    return dbFile
+
+
+def writeRandomClassifier(classifierFile, num_classes = 2, seed = 0):
+    """Write a PSAT-D weights file with random weights, in the layout Keras uses."""
+    import h5py
+    rng = np.random.RandomState(seed)
+    layers = [('conv2d', (2, 2, 1, 16)), ('max_pooling2d', None), ('conv2d_1', (2, 2, 16, 32)), ('max_pooling2d_1', None),
+              ('conv2d_2', (2, 2, 32, 64)), ('max_pooling2d_2', None), ('dropout', None), ('flatten', None),
+              ('dense', (256, 500)), ('dropout_1', None), ('dense_1', (500, num_classes))]
+    with h5py.File(classifierFile, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf-8') for name, shape in layers]
+        for name, shape in layers:
+            group = f.create_group(name)
+            if shape is None:
+                group.attrs['weight_names'] = []
+                continue
+            weightNames = ['%s/kernel:0' % name, '%s/bias:0' % name]
+            group.attrs['weight_names'] = [w.encode('utf-8') for w in weightNames]
+            group.create_dataset(weightNames[0], data = rng.normal(0, 0.1, shape).astype(np.float32))
+            group.create_dataset(weightNames[1], data = np.zeros(shape[-1], dtype = np.float32))
+
+
+def runBenchmark(benchmark, arguments, logFile, results):
+    """Run one benchmark in this (fresh) process and put (seconds, peak RSS, peak child RSS) on the results queue."""
+    sys.stdout = open(logFile, 'a')
+    try:
+        start = time.time()
+        if benchmark == 'build':
+            import buildMLDataSet
+            buildMLDataSet.buildMLDataSet(arguments)
+        else:
+            if benchmark == 'single':
+                import runKerasTensorflowClassifierOnPSATImages as runner
+                function = runner.runKerasTensorflowClassifier
+            else:
+                import runKerasTensorflowClassifierOnPSATImagesMultiprocess as runner
+                function = runner.runKerasTensorflowClassifierMultiprocess
+            # Point the scorer at the SQLite stand-in. The pool workers inherit it if they are forked.
+            runner.dbConnect = standInConnect
+            multiprocessing.set_start_method('fork', force = True)
+            options = cleanOptions(docopt(runner.__doc__, argv = arguments))
+            function(Struct(**options))
+        seconds = time.time() - start
+        sys.stdout.flush()
+        # ru_maxrss is in kB on Linux. Only the multiprocess scorer has workers of its own.
+        peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        peakChildRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0 if benchmark == 'multiprocess' else 0.0
+        results.put((seconds, peakRss, peakChildRss))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        sys.stdout.flush()
+        results.put(e)
+
+
+def benchmarkScoring(opts):
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    if type(opts) is dict:
+        options = Struct(**opts)
+    else:
+        options = opts
+
+    workdir = os.path.abspath(options.workdir)
+    sizes = sorted(int(size) for size in options.sizes.split(','))
+    surveys = options.surveys.split(',')
+    benchmarks = options.benchmarks.split(',')
+    imagesPerObject = int(options.imagesperobject)
+    stampSize = int(options.stampsize)
+    logDir = os.path.join(workdir, 'logs') + '/'
+    os.makedirs(logDir, exist_ok = True)
+
+    for survey in surveys:
+        if survey not in SURVEYS:
+            sys.exit("Unknown survey %s. Must be one of %s" % (survey, ', '.join(SURVEYS)))
+    for benchmark in benchmarks:
+        if benchmark not in ('single', 'multiprocess', 'build'):
+            sys.exit("Unknown benchmark %s" % benchmark)
+
+    classifier = options.classifier
+    if classifier is None:
+        classifier = os.path.join(workdir, 'psat_d_random_weights.h5')
+        if not os.path.exists(classifier):
+            writeRandomClassifier(classifier)
+
+    context = multiprocessing.get_context('spawn')
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    dateAndTime = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    report = []
+
+    for survey in surveys:
+        settings = SURVEYS[survey]
+        if 'single' in benchmarks or 'multiprocess' in benchmarks:
+            generateStamps(workdir, survey, sizes[-1], imagesPerObject, stampSize)
+
+        for size in sizes:
+            for benchmark in benchmarks:
+                if benchmark == 'build':
+                    goodFile, badFile = generateTrainingStamps(workdir, survey, size, stampSize)
+                    images = 2 * (size // 2)
+                    objects = size // 2
+                    arguments = Struct(posFile = goodFile, negFile = badFile, outputFile = os.path.join(workdir, '%s_%d_training.h5' % (survey, size)),
+                                       extent = EXTENT, extension = settings['extension'], skewFactor = 1, rotate = None, norm = 'spn', magic = settings['magicNumber'],
+                                       stampCache = None, stampCacheSize = None, manifest = None)
+                else:
+                    dbFile = createDatabase(workdir, survey, size, imagesPerObject)
+                    configFile = os.path.join(workdir, '%s_%d_%d.yaml' % (survey, size, imagesPerObject))
+                    with open(configFile, 'w') as f:
+                        f.write("databases:\n  local:\n    hostname: '%s'\n    username: benchmark\n    password: benchmark\n    database: %s\n" % (dbFile, settings['database']))
+                    images = size * imagesPerObject
+                    objects = size
+                    arguments = [configFile, '--listid=%d' % LIST_ID, '--update',
+                                 '%s=%s' % (settings['classifierOption'], classifier),
+                                 '--imageroot=%s/' % os.path.join(workdir, 'images'),
+                                 '--backend=%s' % options.backend,
+                                 '--batchsize=%s' % options.batchsize,
+                                 '--readthreads=%s' % options.readthreads,
+                                 '--metrics=%s' % os.path.join(workdir, 'metrics.jsonl'),
+                                 '--querychunksize=%d' % QUERY_CHUNK_SIZE]
+                    if settings['magicNumber'] is not None:
+                        arguments.append('--magicNumber=%d' % settings['magicNumber'])
+                    if benchmark == 'multiprocess':
+                        arguments += ['--workers=%s' % options.workers, '--chunksize=%s' % options.chunksize, '--loglocation=%s' % logDir, '--logprefix=benchmark_%s_%d_' % (survey, size)]
+
+                print("%s %s, %d objects..." % (survey, benchmark, size))
+                sys.stdout.flush()
+                results = context.Queue()
+                logFile = os.path.join(logDir, 'benchmark_%s_%s_%s_%d.log' % (dateAndTime, survey, benchmark, size))
+                process = context.Process(target = runBenchmark, args = (benchmark, arguments, logFile, results))
+                process.start()
+                result = results.get()
+                process.join()
+                if isinstance(result, Exception):
+                    print("    FAILED: %s (see %s)" % (result, logFile))
+                    continue
+
+                seconds, peakRss, peakChildRss = result
+                row = (date, survey, benchmark, size, objects, images, seconds, images / seconds, objects / seconds, peakRss, peakChildRss)
+                print("    %.1fs, %.1f images/s, %.1f objects/s, peak RSS %.0f MB (workers %.0f MB)" % (seconds, images / seconds, objects / seconds, peakRss, peakChildRss))
+                report.append(row)
+
+    print()
+    print("%-6s %-13s %9s %10s %10s %12s %12s %10s %12s" % ('Survey', 'Benchmark', 'Objects', 'Images', 'Seconds', 'Images/s', 'Objects/s', 'RSS MB', 'Worker MB'))
+    for row in report:
+        print("%-6s %-13s %9d %10d %10.1f %12.1f %12.1f %10.0f %12.0f" % (row[1:3] + row[4:]))
+
+    if options.outputcsv is not None:
+        writeHeader = not os.path.exists(options.outputcsv)
+        with open(options.outputcsv, 'a') as f:
+            if writeHeader:
+                f.write('date,survey,benchmark,size,objects,images,seconds,images_per_second,objects_per_second,peak_rss_mb,peak_worker_rss_mb\n')
+            for row in report:
+                f.write('%s,%s,%s,%d,%d,%d,%f,%f,%f,%f,%f\n' % row)
+
+
+def main():
+    opts = docopt(__doc__, version='0.1')
+    opts = cleanOptions(opts)
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    options = Struct(**opts)
+    benchmarkScoring(options)
+
+
+if __name__=='__main__':
+    main()
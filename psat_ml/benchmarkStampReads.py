@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Compare reading the whole stamp with reading only its central region.
+
+Usage:
+  %s <fitsFile>... [--extent=<extent>] [--extension=<extension>] [--repeats=<repeats>]
+  %s (-h | --help)
+  %s --version
+
+Options:
+  -h --help                  Show this screen.
+  --version                  Show version.
+  --extent=<extent>          Half width of the central region [default: 10].
+  --extension=<extension>    FITS extension containing the image (1 for fpacked stamps) [default: 0].
+  --repeats=<repeats>        Number of times to read the whole list [default: 3].
+
+Example:
+  python %s /db4/images/02a/59000/*.fits --extension=0
+  python %s /db0/images/ps13pi/*.fz.fits --extension=1 --repeats=5
+
+"""
+import sys
+__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+from docopt import docopt
+from gkutils.commonutils import Struct, cleanOptions
+import time
+import numpy as np
+from astropy.io import fits as pyfits
+from TargetImage import readCentralRegion
+
+
+def readFullImage(fitsFile, extent, extension):
+    """The original read: load the whole image, slice the centre, leave the file open."""
+    data = pyfits.open(fitsFile)[extension].data
+    imageCentre = np.shape(data[0])[0]/2.0
+    return data[int(imageCentre-extent): int(imageCentre+extent), int(imageCentre-extent): int(imageCentre+extent)]
+
+
+def readSection(fitsFile, extent, extension):
+    with pyfits.open(fitsFile) as hdulist:
+        return readCentralRegion(hdulist[extension], extent)
+
+
+def timeReads(reader, fitsFiles, extent, extension, repeats):
+    """Return the best time (in seconds) of repeats reads of all the files."""
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        for fitsFile in fitsFiles:
+            reader(fitsFile, extent, extension)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmarkStampReads(opts):
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    if type(opts) is dict:
+        options = Struct(**opts)
+    else:
+        options = opts
+
+    extent = int(options.extent)
+    extension = int(options.extension)
+    repeats = int(options.repeats)
+
+    # Make sure both methods agree before timing them.
+    for fitsFile in options.fitsFile:
+        if not np.array_equal(readFullImage(fitsFile, extent, extension), readSection(fitsFile, extent, extension), equal_nan = True):
+            print("WARNING: full and section reads differ for %s" % fitsFile)
+
+    fullSeconds = timeReads(readFullImage, options.fitsFile, extent, extension, repeats)
+    sectionSeconds = timeReads(readSection, options.fitsFile, extent, extension, repeats)
+
+    n = len(options.fitsFile)
+    print("Full image read:     %.3fs (%.1f stamps/s)" % (fullSeconds, n / fullSeconds))
+    print("Central region read: %.3fs (%.1f stamps/s)" % (sectionSeconds, n / sectionSeconds))
+    print("Speed up: %.2fx" % (fullSeconds / sectionSeconds))
+
+
+def main():
+    opts = docopt(__doc__, version='0.1')
+    opts = cleanOptions(opts)
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    options = Struct(**opts)
+    benchmarkStampReads(options)
+
+
+if __name__=='__main__':
+    main()
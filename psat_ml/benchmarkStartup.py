@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Measure the cold start time of the scoring entry points with python -X importtime.
+
+Usage:
+  %s [<script>...] [--repeats=<repeats>] [--top=<top>] [--outputcsv=<outputcsv>]
+  %s (-h | --help)
+  %s --version
+
+Options:
+  -h --help                  Show this screen.
+  --version                  Show version.
+  --repeats=<repeats>        Number of times to start each script. The fastest start is reported [default: 3].
+  --top=<top>                Number of the most expensive imports to list for each script [default: 10].
+  --outputcsv=<outputcsv>    Append the results to this CSV file, so start-up time can be tracked over time.
+
+Each script is started with --version, which imports everything it needs and
+exits without doing any work. If no scripts are given, the scoring entry points
+are measured.
+
+Example:
+  python %s
+  python %s runKerasTensorflowClassifierOnPSATImages.py --repeats=5 --outputcsv=/tmp/startup.csv
+
+"""
+import sys
+__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+from docopt import docopt
+from gkutils.commonutils import Struct, cleanOptions
+import os, re, time, datetime, subprocess
+
+ENTRY_POINTS = ['runKerasTensorflowClassifierOnPSATImages.py',
+                'runKerasTensorflowClassifierOnPSATImagesMultiprocess.py',
+                'runKerasTensorflowClassifierOnAribitraryImage.py',
+                'runKerasTensorflowClassifierOnExposure.py',
+                'scoringServer.py']
+
+# e.g. "import time:       312 |       1254 |   numpy"
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def startScript(script):
+    """Start the script with -X importtime. Returns (wall seconds, {module: (self us, cumulative us, depth)})."""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', script, '--version'], stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True, cwd = os.path.dirname(os.path.abspath(script)))
+    elapsed = time.perf_counter() - start
+
+    if process.returncode != 0:
+        errors = [line for line in process.stderr.splitlines() if not line.startswith('import time:')]
+        raise RuntimeError("%s failed to start: %s" % (script, '\n'.join(errors[-5:])))
+
+    imports = {}
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            imports[match.group(4)] = (int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2)
+    return elapsed, imports
+
+
+def benchmarkStartup(opts):
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    if type(opts) is dict:
+        options = Struct(**opts)
+    else:
+        options = opts
+
+    scripts = options.script
+    if not scripts:
+        here = os.path.dirname(os.path.abspath(__file__))
+        scripts = [os.path.join(here, script) for script in ENTRY_POINTS]
+
+    repeats = int(options.repeats)
+    top = int(options.top)
+    results = []
+
+    for script in scripts:
+        best = None
+        for i in range(repeats):
+            elapsed, imports = startScript(script)
+            if best is None or elapsed < best[0]:
+                best = (elapsed, imports)
+        elapsed, imports = best
+
+        # Top level imports (depth 0) add up to the total import time.
+        importSeconds = sum(v[1] for v in imports.values() if v[2] == 0) / 1e6
+        results.append((os.path.basename(script), elapsed, importSeconds, len(imports)))
+
+        print("%s: %.3fs to start, %.3fs importing %d modules" % (os.path.basename(script), elapsed, importSeconds, len(imports)))
+        heaviest = sorted([(v[1], k) for k, v in imports.items() if v[2] == 0], reverse = True)[:top]
+        for cumulative, module in heaviest:
+            print("    %10.3fs  %s" % (cumulative / 1e6, module))
+
+    if options.outputcsv is not None:
+        writeHeader = not os.path.exists(options.outputcsv)
+        date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with open(options.outputcsv, 'a') as f:
+            if writeHeader:
+                f.write('date,script,start_seconds,import_seconds,modules\n')
+            for row in results:
+                f.write('%s,%s,%f,%f,%d\n' % ((date,) + row))
+
+
+def main():
+    opts = docopt(__doc__, version='0.1')
+    opts = cleanOptions(opts)
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    options = Struct(**opts)
+    benchmarkStartup(options)
+
+
+if __name__=='__main__':
+    main()
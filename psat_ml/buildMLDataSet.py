@@ -1,14 +1,16 @@
 import optparse, time
 import numpy as np
 import h5py
-import scipy.io as sio
 from TargetImage import *
-from scipy.ndimage import gaussian_filter
-from skimage import img_as_float
-from skimage.morphology import reconstruction
+from stampCache import StampCache
+from directoryIndex import DirectoryIndex
+# scipy and skimage are only needed for background subtraction, so are imported in bg_sub_signPreserveNorm.
 
 np.seterr(all="ignore")
 
+# Stamps read and normalised together by generate_vectors.
+NORM_BATCH_SIZE = 10000
+
 def imageFile_to_list(imageFile):
     print(imageFile)
     counter = 0
@@ -41,6 +43,8 @@ def signPreserveNorm(imageFile, path, extent, extension, magicNumber = None):
     return a
 
 def bg_sub_signPreserveNorm(imageFile, path, extent, extension, magicNumber = None):
+    from scipy.ndimage import gaussian_filter
+    from skimage.morphology import reconstruction
     vec = signPreserveNorm(imageFile, path, extent, extension, magicNumber = magicNumber)
     image = np.reshape(vec, (20,20), order="F")
 
@@ -52,28 +56,75 @@ def bg_sub_signPreserveNorm(imageFile, path, extent, extension, magicNumber = No
     dilated = reconstruction(seed, mask, method='dilation')
     
     return np.ravel(image - dilated, order="F")
+
+# Whole-batch versions of the norm functions, returning one row per stamp.
+def noNormBatch(batch):
+    return batch.unravelObject()
+
+def signPreserveNormBatch(batch):
+    return TargetImageBatch.unravel(batch.signPreserveNorm())
+
+BATCH_NORM_FUNCS = {noNorm: noNormBatch, signPreserveNorm: signPreserveNormBatch}
     
-def generate_vectors(imageList, path, extent, normFunc, extension, magicNumber = None):
+def generate_vectors(imageList, path, extent, normFunc, extension, magicNumber = None, cache = None, directoryIndex = None):
     print("PATH = ", path)
     m = len(imageList)
     X = np.ones((m, 4*extent*extent))
 
-    for i,imageFile in enumerate(imageList):
-        try:
-            if '/' in imageFile:
-                vector = normFunc(imageFile, "", extent, extension, magicNumber = magicNumber)
+    # Find each image by listing the candidate directories once, rather than trying to open it in each.
+    if directoryIndex is None:
+        directoryIndex = DirectoryIndex()
+    directories = [path+"good/", path+"bad/", path+"4_20160706/"]
+
+    def normalise(imageFile, path):
+        # Read through the stamp cache if we have one.
+        if cache is None:
+            return normFunc(imageFile, path, extent, extension, magicNumber = magicNumber)
+        return cache.getOrCompute(path+imageFile, extension, magicNumber, normFunc.__name__, extent, lambda: normFunc(imageFile, path, extent, extension, magicNumber = magicNumber))
+
+    imageDirectories = []
+    for imageFile in imageList:
+        if '/' in imageFile:
+            directory = ""
+        else:
+            directory = directoryIndex.locate(imageFile, directories)
+        if directory is None:
+            print("[!] Exiting: Could not find %s" % imageFile)
+            exit(0)
+        imageDirectories.append(directory)
+
+    batchNormFunc = BATCH_NORM_FUNCS.get(normFunc)
+    if batchNormFunc is None:
+        # No whole-batch version of this norm function, so normalise one stamp at a time.
+        for i,imageFile in enumerate(imageList):
+            vector = normalise(imageFile, imageDirectories[i])
+            X[i,:] = X[i,:] * vector
+        if cache is not None:
+            cache.flush()
+        return X
+
+    # Take what we can from the cache, then read the rest and normalise them NORM_BATCH_SIZE at a time.
+    imageFiles = [directory + imageFile for directory, imageFile in zip(imageDirectories, imageList)]
+    missing = list(range(m))
+    if cache is not None:
+        keys = [cache.stampKey(imageFile, extension, magicNumber, normFunc.__name__, extent) for imageFile in imageFiles]
+        found = cache.getMany(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            if key in found:
+                X[i,:] = found[key]
             else:
-                vector = normFunc(imageFile, path+"good/", extent, extension, magicNumber = magicNumber)
-        except IOError:
-            try:
-                vector = normFunc(imageFile, path+"bad/", extent, extension, magicNumber = magicNumber)
-            except IOError:
-                try:
-                    vector = normFunc(imageFile, path+"4_20160706/", extent, extension, magicNumber = magicNumber)
-                except IOError:
-                    print("[!] Exiting: Could not find %s" % imageFile)
-                    exit(0)
-        X[i,:] = X[i,:] * vector
+                missing.append(i)
+
+    for start in range(0, len(missing), NORM_BATCH_SIZE):
+        rows = missing[start:start + NORM_BATCH_SIZE]
+        batch = TargetImageBatch.fromFiles([imageFiles[i] for i in rows], extent, extension, magicNumber = magicNumber)
+        vectors = batchNormFunc(batch)
+        X[rows,:] = vectors
+        if cache is not None:
+            cache.putMany([(keys[i], vector) for i, vector in zip(rows, vectors)])
+    if cache is not None:
+        cache.flush()
     return X
 
 def generate_key(file):
@@ -81,12 +132,12 @@ def generate_key(file):
     #mjd = file.split("_")[1].split(".")[0]
     return id
     
-def process_examples(list, path, label, extent, normFunc, extension, trainingFraction=.75, magicNumber = None):
+def process_examples(list, path, label, extent, normFunc, extension, trainingFraction=.75, magicNumber = None, cache = None, directoryIndex = None):
 
     m = len(list) # number of training examples
     np.random.seed(0)
     
-    X = generate_vectors(list, path, extent, normFunc, extension, magicNumber = magicNumber)
+    X = generate_vectors(list, path, extent, normFunc, extension, magicNumber = magicNumber, cache = cache, directoryIndex = directoryIndex)
     grouped_X = np.ones((np.shape(X)))
     grouped_dict = group_images(list[:])
     
@@ -97,6 +148,9 @@ def process_examples(list, path, label, extent, normFunc, extension, trainingFra
         tti_keys.append(k)
     np.random.shuffle(tti_keys)
     
+    # Row of each image in X. list.index would search the whole list for every image.
+    rows = dict((image, j) for j, image in enumerate(list))
+
     i = 0
     grouped_list = []
     # for all tti groups
@@ -104,7 +158,7 @@ def process_examples(list, path, label, extent, normFunc, extension, trainingFra
         # for each image in the tti group
         for image in grouped_dict[tti]:
             # add its vector to X
-            grouped_X[i,:] = grouped_X[i,:] * X[list.index(image),:]
+            grouped_X[i,:] = grouped_X[i,:] * X[rows[image],:]
             # add its file to the file list
             grouped_list.append(image)
             i+=1
@@ -209,6 +263,17 @@ def buildMLDataSet(opts):
     if magic is not None:
         magic = int(magic)
     
+    # Optional cache of normalised stamps, shared with the scorers.
+    cache = None
+    stampCache = getattr(options, 'stampCache', None)
+    if stampCache is not None:
+        stampCacheSize = getattr(options, 'stampCacheSize', None)
+        if stampCacheSize == None:
+            stampCacheSize = 1024
+        cache = StampCache(stampCache, maxBytes = stampCacheSize * 1024 * 1024)
+
+    directoryIndex = DirectoryIndex(getattr(options, 'manifest', None))
+
     if posFile == None or outputFile == None:
        # print(parser.usage)
         print("missing good or bad .txt")
@@ -239,12 +304,13 @@ def buildMLDataSet(opts):
         imageList = imageFile_to_list(posFile)
         path = posFile.strip(posFile.split("/")[-1])
         print(path)
-        X = generate_vectors(imageList, path, extent, normFunc, extension, magicNumber = magicNumber)
+        X = generate_vectors(imageList, path, extent, normFunc, extension, magicNumber = magic, cache = cache, directoryIndex = directoryIndex)
         #sio.savemat(outputFile, {"X": X, "images": imageList})
         hf = h5py.File(outputFile,'w')
         hf.create_dataset('X', data=X)
         hf.create_dataset('images',data=imageList)
         hf.close()
+        directoryIndex.save()
         exit(0)
 
     # process positive examples
@@ -253,7 +319,7 @@ def buildMLDataSet(opts):
     m_pos = len(pos_list)
     path = posFile.strip(posFile.split("/")[-1])
     print(path)
-    pos_data = process_examples(pos_list, path, 1, extent, normFunc, extension, magicNumber = magic)
+    pos_data = process_examples(pos_list, path, 1, extent, normFunc, extension, magicNumber = magic, cache = cache, directoryIndex = directoryIndex)
     print("[+] %d positive examples processed." % m_pos)
     
     # process positive examples
@@ -264,7 +330,7 @@ def buildMLDataSet(opts):
     m_neg = len(neg_list)
     path = negFile.strip(negFile.split("/")[-1])
     print(path)
-    neg_data = process_examples(neg_list, path, 0, extent, normFunc, extension, magicNumber = magic)
+    neg_data = process_examples(neg_list, path, 0, extent, normFunc, extension, magicNumber = magic, cache = cache, directoryIndex = directoryIndex)
     print("[+] %d negative examples processed." % m_neg)
 
     print("[+] Building training set.")
@@ -281,6 +347,9 @@ def buildMLDataSet(opts):
     # sio.savemat(outputFile, {"X": X, "y":y, "train_files": train_files, \
     #                         "testX":testX, "testy":testy, "test_files":test_files})
     save_to_hdf5(X,y,train_files,testX,testy,test_files,outputFile)
+    if cache is not None:
+        cache.printStats()
+    directoryIndex.save()
     print("[+] Processing complete.")
     print("[*] Run time: %d minutes." % ((time.time() - startTime) / 60))
     
@@ -294,7 +363,10 @@ def main():
                                    " -s <skew factor [default=1]>\n"+\
                                    " -r <augment training data with rotation [optional]>\n"
                                    " -N <normalisation function [default=signPreserveNorm]>\n"
-                                   " -m <integer mask magic number")
+                                   " -m <integer mask magic number>\n"
+                                   " -c <stamp cache file [optional]>\n"
+                                   " -C <stamp cache size in MB [default=1024]>\n"
+                                   " -M <directory manifest file [optional]>")
 
     parser.add_option("-p", dest="posFile", type="string", \
                       help="specify file listing positive examples")
@@ -314,6 +386,12 @@ def main():
                       help="specify normalisation function to apply to data [default=signPreserveNorm]")
     parser.add_option("-m", dest="magic", type="int", \
                       help="specify an integer magic number mask (e.g. -31415)")
+    parser.add_option("-c", dest="stampCache", type="string", \
+                      help="specify a cache file for the normalised stamps [optional]")
+    parser.add_option("-C", dest="stampCacheSize", type="int", \
+                      help="specify the maximum size of the stamp cache in MB [default=1024]")
+    parser.add_option("-M", dest="manifest", type="string", \
+                      help="specify a file in which to keep the image directory listings between runs [optional]")
 
     (options, args) = parser.parse_args()
 
@@ -0,0 +1,100 @@
+"""In-memory index of the image directories.
+
+Checking every postage stamp with os.path.exists (or finding it by trying one
+directory after another) costs a stat per file, which on the NFS mounted image
+trees dominates the run time. The index lists each directory once, with a
+single os.scandir, and answers every later question about it from memory.
+
+The listings can also be kept in a JSON manifest between runs. A directory
+from the manifest is only trusted if its mtime hasn't changed, which costs one
+stat per directory per run. Otherwise it is listed again.
+"""
+import os
+import json
+import threading
+
+
+class DirectoryIndex(object):
+
+    def __init__(self, manifestFile = None):
+        self.manifestFile = manifestFile
+        self.directories = {}
+        self.verified = set()
+        self.dirty = False
+        self.scans = 0
+        self.lock = threading.Lock()
+
+        if manifestFile and os.path.exists(manifestFile):
+            self.directories = self.readManifest(manifestFile)
+
+    @staticmethod
+    def readManifest(manifestFile):
+        with open(manifestFile) as fp:
+            manifest = json.load(fp)
+        return dict((directory, (entry['mtime'], frozenset(entry['names']))) for directory, entry in manifest['directories'].items())
+
+    def scan(self, directory):
+        """List the directory. A missing directory is recorded as empty."""
+        try:
+            mtime = os.stat(directory).st_mtime
+            with os.scandir(directory) as entries:
+                names = frozenset(entry.name for entry in entries)
+        except (FileNotFoundError, NotADirectoryError):
+            mtime = None
+            names = frozenset()
+        self.scans += 1
+        return mtime, names
+
+    def listing(self, directory):
+        """Return the set of names in the directory, listing it the first time it is asked for."""
+        directory = os.path.normpath(directory)
+        with self.lock:
+            if directory not in self.verified:
+                entry = self.directories.get(directory)
+                if entry is not None:
+                    # From the manifest. Only rescan if the directory has changed since.
+                    try:
+                        mtime = os.stat(directory).st_mtime
+                    except OSError:
+                        mtime = None
+                    if mtime != entry[0]:
+                        entry = None
+                if entry is None:
+                    entry = self.scan(directory)
+                    self.directories[directory] = entry
+                    self.dirty = True
+                self.verified.add(directory)
+            return self.directories[directory][1]
+
+    def exists(self, filename):
+        """Equivalent of os.path.exists for files in the indexed directories."""
+        directory, name = os.path.split(filename)
+        return name in self.listing(directory or '.')
+
+    def locate(self, filename, directories):
+        """Return the first of the directories that contains the file, or None."""
+        for directory in directories:
+            if filename in self.listing(directory):
+                return directory
+        return None
+
+    def save(self):
+        """Write the listings to the manifest, merged with any written meanwhile by other processes."""
+        if not self.manifestFile or not self.dirty:
+            return
+
+        with self.lock:
+            directories = {}
+            if os.path.exists(self.manifestFile):
+                try:
+                    directories = self.readManifest(self.manifestFile)
+                except ValueError:
+                    print("Ignoring unreadable manifest %s" % self.manifestFile)
+            directories.update(self.directories)
+
+            manifest = {'directories': dict((directory, {'mtime': mtime, 'names': sorted(names)}) for directory, (mtime, names) in directories.items())}
+            temporaryFile = '%s.%d.tmp' % (self.manifestFile, os.getpid())
+            with open(temporaryFile, 'w') as fp:
+                json.dump(manifest, fp)
+            os.replace(temporaryFile, self.manifestFile)
+            self.dirty = False
@@ -0,0 +1,118 @@
+"""On-disk store of the raw score of every image, per classifier.
+
+An object's score is the median (or other aggregate) of the scores of all its
+images, so when an object gains one new detection the scorer used to read and
+predict every one of its old stamps again. The store keeps each image's score
+keyed by the image filename and the scorer: a hash of the classifier file's
+contents plus the trainer, backend, FITS extension and magic number, which
+between them decide the score. A later run only predicts the images it has no
+score for, and aggregates the stored and new scores.
+
+A retrained classifier is a different file, so it gets a new key and every
+image is scored again. Images are assumed not to change once written, so the
+filename alone identifies the image (stat-ing every file to check would cost
+more than the lookups save).
+
+Like the stamp cache, the store is an SQLite file that several scoring
+processes can read and write at once.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+# SQLite limits the number of parameters in a statement.
+LOOKUP_CHUNK_SIZE = 500
+
+# One open store per (file, process). Worker processes open their own.
+_stores = {}
+
+# Classifier file hashes, keyed by (path, size, mtime), so each file is only read once per process.
+_classifierHashes = {}
+
+
+def openScoreStore(storeFile):
+    """Return the process's ImageScoreStore for storeFile, opening it the first time."""
+    key = (os.path.realpath(storeFile), os.getpid())
+    store = _stores.get(key)
+    if store is None:
+        store = ImageScoreStore(storeFile)
+        _stores[key] = store
+    return store
+
+
+def classifierHash(classifier):
+    """SHA-1 of the classifier file's contents."""
+    path = os.path.realpath(classifier)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    digest = _classifierHashes.get(key)
+    if digest is None:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        _classifierHashes[key] = digest
+    return digest
+
+
+class ImageScoreStore(object):
+
+    def __init__(self, storeFile):
+        self.storeFile = storeFile
+        self.found = 0
+        self.missing = 0
+        self.stores = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(storeFile, timeout = 60, check_same_thread = False)
+        with self.conn:
+            self.conn.execute('pragma journal_mode=wal')
+            self.conn.execute('''create table if not exists scores (
+                                     filename text not null,
+                                     scorer text not null,
+                                     score real not null,
+                                     scored real not null,
+                                     primary key (filename, scorer)) without rowid''')
+
+    @staticmethod
+    def scorerKey(classifier, trainer = 'PSAT-D', backend = 'keras', extension = 0, magicNumber = None):
+        """Identify everything that decides an image's score."""
+        key = repr((classifierHash(classifier), trainer, backend, int(extension), magicNumber))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, imageFilenames, scorer):
+        """Return a dict of the stored scores of those images that have one."""
+        scores = {}
+        with self.lock:
+            for i in range(0, len(imageFilenames), LOOKUP_CHUNK_SIZE):
+                chunk = imageFilenames[i:i + LOOKUP_CHUNK_SIZE]
+                query = 'select filename, score from scores where scorer = ? and filename in (%s)' % ','.join(['?'] * len(chunk))
+                scores.update(self.conn.execute(query, [scorer] + list(chunk)).fetchall())
+            self.found += len(scores)
+            self.missing += len(set(imageFilenames)) - len(scores)
+        return scores
+
+    def put(self, imageScores, scorer):
+        """Store (filename, score) pairs."""
+        now = time.time()
+        rows = [(filename, scorer, float(score), now) for filename, score in imageScores]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('insert or replace into scores (filename, scorer, score, scored) values (?, ?, ?, ?)', rows)
+            self.stores += len(rows)
+
+    def stats(self):
+        lookups = self.found + self.missing
+        return {'found': self.found,
+                'missing': self.missing,
+                'hitRate': float(self.found) / lookups if lookups else 0.0,
+                'stores': self.stores}
+
+    def printStats(self):
+        stats = self.stats()
+        print("Score store %s: %d images already scored, %d scored now (%.1f%% reused), %d stored" % (self.storeFile, stats['found'], stats['missing'], 100.0 * stats['hitRate'], stats['stores']))
+
+    def close(self):
+        self.conn.close()
@@ -23,12 +23,9 @@ import os, shutil, re
 from gkutils.commonutils import Struct, cleanOptions
 import h5py
 import numpy as np
-import scipy.io as sio
 
-from keras.utils import np_utils
-from keras.models import Sequential
-from keras.layers import Dense, Dropout, Conv2D, MaxPooling2D, Flatten
-from keras.callbacks import ModelCheckpoint  
+# Keras is only imported when we train, so the scorers and reports can use
+# load_data and the metrics below without loading TensorFlow.
 
 from rocCurve import roc_curve
 
@@ -67,6 +64,8 @@ def load_data(filename):
     return (x_train, y_train, train_files), (x_test, y_test, test_files), image_dim
 
 def kerasTensorflowClassifier(opts):
+    from keras.utils import np_utils
+    from keras.callbacks import ModelCheckpoint
 
     # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
     if type(opts) is dict:
@@ -0,0 +1,132 @@
+"""Choose batch sizes and worker counts that fit in the memory we have.
+
+The scorers used to be sized by hand (28 workers, 1024 image batches), and a
+busy node would run out of RAM. The governor works out, from a memory budget
+(or, by default, the memory available when the run starts):
+
+  - how many workers to start, from a rough estimate of what each one needs
+    (its backend plus its batches in flight), and
+  - the batch size each process reads and predicts, which it then keeps
+    adjusting as the stamps are read: halving it when the process's RSS gets
+    close to its limit and growing it back when there is room again.
+
+Every decision is logged. The estimates are deliberately rough. The back off
+is what keeps a process under its limit. Memory is read from /proc, so on
+systems without it the governor leaves the sizes alone.
+"""
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rough resident size of a worker with its model loaded, before it reads any stamps.
+WORKER_BASELINE_BYTES = {'keras': 1024 * 1024 * 1024,
+                         'numpy': 200 * 1024 * 1024}
+
+# Activations (and im2col patches) of one PSAT-D image during predict.
+ACTIVATION_BYTES_PER_IMAGE = 128 * 1024
+
+MIN_BATCH_SIZE = 32
+
+# Halve the batch size above BACKOFF_FRACTION of the limit, grow it again below RECOVER_FRACTION.
+BACKOFF_FRACTION = 0.9
+RECOVER_FRACTION = 0.6
+
+
+def availableMemory():
+    """Bytes of memory available for new work (MemAvailable), or None if we can't tell."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def currentRss():
+    """Resident set size of this process in bytes, or None if we can't tell."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def bytesPerImage(queueDepth = 4, image_dim = 20):
+    """Memory each image in a batch costs: the batches queued and being scored, plus predict's activations."""
+    return image_dim * image_dim * 4 * (queueDepth + 2) + ACTIVATION_BYTES_PER_IMAGE
+
+
+def megabytes(nbytes):
+    return nbytes / (1024.0 * 1024.0)
+
+
+def chooseWorkerCount(requested, backend = 'keras', batchSize = 1024, queueDepth = 4, image_dim = 20, budget = None):
+    """Return (workers, bytes per worker): no more than requested workers, and only as many
+       as fit in the budget (bytes, default the memory available now).
+    """
+    total = budget if budget is not None else availableMemory()
+    if total is None:
+        logger.info("Memory governor: available memory unknown. Using %d workers.", requested)
+        return requested, None
+
+    perWorker = WORKER_BASELINE_BYTES.get(backend, WORKER_BASELINE_BYTES['keras']) + batchSize * bytesPerImage(queueDepth, image_dim)
+    workers = int(max(1, min(requested, total // perWorker)))
+    if workers < requested:
+        logger.warning("Memory governor: %.0f MB budget fits %d workers of about %.0f MB each. Using %d workers instead of %d.", megabytes(total), workers, megabytes(perWorker), workers, requested)
+    else:
+        logger.info("Memory governor: %.0f MB budget, %d workers of about %.0f MB each.", megabytes(total), workers, megabytes(perWorker))
+    return workers, total // workers
+
+
+class MemoryGovernor(object):
+    """Keeps one process's batch size within its memory limit.
+
+       budget is the most this process's RSS should reach, in bytes. By default
+       it is what the process uses now plus the memory available.
+    """
+
+    def __init__(self, budget = None):
+        rss = currentRss()
+        if budget is None:
+            available = availableMemory()
+            if available is not None and rss is not None:
+                budget = rss + available
+        self.limit = budget if rss is not None else None
+        self.requested = None
+        self.perImage = bytesPerImage()
+
+    def batchSize(self, requested, queueDepth = 4, image_dim = 20):
+        """Return the starting batch size: the requested one, or smaller if it wouldn't fit."""
+        self.requested = requested
+        self.perImage = bytesPerImage(queueDepth, image_dim)
+        if self.limit is None:
+            return requested
+
+        room = BACKOFF_FRACTION * self.limit - currentRss()
+        size = int(min(requested, max(MIN_BATCH_SIZE, room // self.perImage)))
+        if size < requested:
+            logger.warning("Memory governor: %.0f MB left of %.0f MB. Batch size %d instead of %d.", megabytes(max(room, 0)), megabytes(self.limit), size, requested)
+        else:
+            logger.debug("Memory governor: %.0f MB limit. Batch size %d.", megabytes(self.limit), size)
+        return size
+
+    def adjust(self, size):
+        """Called before each batch is read. Returns the size to use for it."""
+        if self.limit is None:
+            return size
+
+        rss = currentRss()
+        if rss > BACKOFF_FRACTION * self.limit and size > MIN_BATCH_SIZE:
+            newSize = max(MIN_BATCH_SIZE, size // 2)
+            logger.warning("Memory governor: RSS %.0f MB is near the %.0f MB limit. Batch size %d -> %d.", megabytes(rss), megabytes(self.limit), size, newSize)
+            return newSize
+
+        if rss < RECOVER_FRACTION * self.limit and self.requested is not None and size < self.requested:
+            newSize = min(self.requested, size * 2)
+            logger.info("Memory governor: RSS %.0f MB of %.0f MB limit. Batch size %d -> %d.", megabytes(rss), megabytes(self.limit), size, newSize)
+            return newSize
+
+        return size
@@ -0,0 +1,119 @@
+"""Per-process registry of warm classifier models.
+
+Building the network and loading its weights costs more than scoring a small
+chunk of images, so each classifier is built once per process and the same
+instance is handed back on every subsequent request. Models are keyed by the
+trainer module, the real path of the classifier file and its mtime and size,
+so a classifier that is retrained in place is picked up automatically.
+
+The keras backend builds the network with the trainer's create_model. The
+numpy backend (PSAT-D only) does the same forward pass with numpyInference,
+without importing Keras or TensorFlow.
+
+The registry may be used from several threads at once (e.g. the scoring
+server's client threads). Keras models are wrapped so that predict runs in the
+TensorFlow graph the model was built in, one call at a time, while the threads
+read and normalise their stamps in parallel.
+"""
+import os
+# The trainer module is named by a variable, so import it with importlib.
+import importlib
+import threading
+
+NUM_CLASSES = 2
+IMAGE_DIM = 20
+BACKENDS = ['keras', 'numpy']
+
+_models = {}
+_modelsLock = threading.Lock()
+
+
+class GraphModel(object):
+    """A Keras model whose predict runs in the TensorFlow graph it was built in
+       (TensorFlow 1.x keeps the default graph per thread), one call at a time.
+    """
+
+    def __init__(self, model, graph = None):
+        self.model = model
+        self.graph = graph
+        self.lock = threading.Lock()
+
+    def predict(self, *args, **kwargs):
+        with self.lock:
+            if self.graph is None:
+                return self.model.predict(*args, **kwargs)
+            with self.graph.as_default():
+                return self.model.predict(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+def currentGraph():
+    """Return TensorFlow's default graph, or None if TensorFlow runs eagerly and has none to keep."""
+    import tensorflow as tf
+    if hasattr(tf, 'executing_eagerly') and tf.executing_eagerly():
+        return None
+    return tf.get_default_graph()
+
+
+def classifierKey(classifier, trainer = 'PSAT-D'):
+    """Return the registry key (trainer, path, mtime, size) for a classifier file."""
+    path = os.path.realpath(classifier)
+    stat = os.stat(path)
+    return (trainer, path, stat.st_mtime, stat.st_size)
+
+
+def getModel(classifier, trainer = 'PSAT-D', num_classes = NUM_CLASSES, image_dim = IMAGE_DIM, backend = 'keras'):
+    """Return a built model with the classifier weights loaded, creating it only once per process."""
+    if backend not in BACKENDS:
+        raise ValueError("Backend must be one of %s" % ', '.join(BACKENDS))
+
+    key = classifierKey(classifier, trainer = trainer) + (num_classes, image_dim, backend)
+
+    with _modelsLock:
+        model = _models.get(key)
+        if model is None:
+            # Forget any older instance of the same classifier file (e.g. it was retrained in place).
+            for staleKey in [k for k in _models if k[:2] == key[:2] and k[4:] == key[4:]]:
+                del _models[staleKey]
+
+            if backend != 'keras':
+                import numpyInference
+                if trainer not in numpyInference.SUPPORTED_TRAINERS:
+                    raise ValueError("The numpy backend only supports %s, not %s" % (', '.join(numpyInference.SUPPORTED_TRAINERS), trainer))
+                trainerModule = numpyInference
+            else:
+                trainerModule = importlib.import_module(trainer)
+            model = trainerModule.create_model(num_classes, image_dim)
+            model.load_weights(classifier)
+            if backend == 'keras':
+                model = GraphModel(model, currentGraph())
+            _models[key] = model
+
+    return model
+
+
+def clearModels():
+    """Drop all the cached models, e.g. before forking workers that should build their own."""
+    with _modelsLock:
+        _models.clear()
+
+
+def configureThreads(intraOpThreads = None, interOpThreads = None):
+    """Limit the number of threads TensorFlow uses for each operation and for running
+       operations in parallel. Must be called before the first model is built.
+    """
+    if not intraOpThreads and not interOpThreads:
+        return
+
+    import tensorflow as tf
+    if hasattr(tf, 'config') and hasattr(tf.config, 'threading'):
+        if intraOpThreads:
+            tf.config.threading.set_intra_op_parallelism_threads(int(intraOpThreads))
+        if interOpThreads:
+            tf.config.threading.set_inter_op_parallelism_threads(int(interOpThreads))
+    else:
+        # TensorFlow 1.x takes the thread limits from the Keras session.
+        from keras import backend as K
+        K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=int(intraOpThreads or 0), inter_op_parallelism_threads=int(interOpThreads or 0))))
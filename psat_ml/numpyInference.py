@@ -0,0 +1,134 @@
+"""NumPy-only inference for the PSAT-D network.
+
+The PSAT-D classifier is a small fixed network, three blocks of 2x2
+convolution, relu and 2x2 max pooling, a 500 unit dense layer and a softmax,
+so scoring doesn't need Keras and TensorFlow, which take seconds to import and
+hundreds of MB per worker. This module reads the weights from the same .h5
+files Keras writes and does the forward pass with NumPy.
+
+It has the same create_model / load_weights / predict interface as a Keras
+model, so modelRegistry.getModel can return either (--backend=numpy).
+"""
+import numpy as np
+import h5py
+
+# The PSAT-D layer stack. Dropout does nothing at inference time so isn't listed.
+PSAT_D_LAYERS = [('conv', 'relu'), ('pool', 2),
+                 ('conv', 'relu'), ('pool', 2),
+                 ('conv', 'relu'), ('pool', 2),
+                 ('flatten', None),
+                 ('dense', 'relu'),
+                 ('dense', 'softmax')]
+
+SUPPORTED_TRAINERS = ['PSAT-D']
+
+
+def readWeights(classifier):
+    """Return the list of weight arrays, layer by layer, from a Keras .h5 file.
+       Handles both whole model files (as written by ModelCheckpoint) and weights only files.
+    """
+    weights = []
+    with h5py.File(classifier, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        for layerName in group.attrs['layer_names']:
+            layerName = layerName.decode('utf-8') if isinstance(layerName, bytes) else layerName
+            layer = group[layerName]
+            for weightName in layer.attrs['weight_names']:
+                weightName = weightName.decode('utf-8') if isinstance(weightName, bytes) else weightName
+                weights.append(np.array(layer[weightName], dtype = np.float32))
+    return weights
+
+
+def im2col(x, kh, kw):
+    """Return the (n * h * w, kh * kw * c) matrix of patches for a 'same' padded, stride 1
+       convolution of x (n, h, w, c), as Keras does it.
+    """
+    n, h, w, c = x.shape
+    # TensorFlow puts any odd padding at the bottom and right.
+    padded = np.pad(x, ((0, 0), ((kh - 1) // 2, kh // 2), ((kw - 1) // 2, kw // 2), (0, 0)), mode = 'constant')
+    # A read only (n, h, w, kh, kw, c) view of every patch, without copying.
+    sn, sh, sw, sc = padded.strides
+    patches = np.lib.stride_tricks.as_strided(padded, shape = (n, h, w, kh, kw, c), strides = (sn, sh, sw, sh, sw, sc), writeable = False)
+    return patches.reshape(n * h * w, kh * kw * c)
+
+
+def maxPool(x, size = 2):
+    """Max pooling with 'valid' padding (any odd row or column is dropped)."""
+    n, h, w, c = x.shape
+    h, w = h // size, w // size
+    return x[:, :h * size, :w * size, :].reshape(n, h, size, w, size, c).max(axis = (2, 4))
+
+
+def relu(x):
+    return np.maximum(x, 0, out = x)
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis = 1, keepdims = True))
+    return e / e.sum(axis = 1, keepdims = True)
+
+
+ACTIVATIONS = {'relu': relu, 'softmax': softmax}
+
+
+class NumpyModel(object):
+
+    def __init__(self, layers, num_classes, image_dim):
+        self.layers = layers
+        self.num_classes = num_classes
+        self.image_dim = image_dim
+        self.weights = None
+        # The kernels of the weighted layers as (inputs, outputs) matrices.
+        self.kernels = None
+
+    def load_weights(self, classifier):
+        weights = readWeights(classifier)
+        expected = 2 * len([l for l in self.layers if l[0] in ('conv', 'dense')])
+        if len(weights) != expected:
+            raise ValueError("%s has %d weight arrays. Expected %d for this network." % (classifier, len(weights), expected))
+        self.set_weights(weights)
+
+    def set_weights(self, weights):
+        self.weights = [np.asarray(w, dtype = np.float32) for w in weights]
+        self.kernels = [w.reshape(-1, w.shape[-1]) for w in self.weights[0::2]]
+
+    def get_weights(self):
+        return self.weights
+
+    def multiply(self, i, x):
+        """Multiply the inputs x (rows) by the kernel of weighted layer i."""
+        return x @ self.kernels[i]
+
+    def forward(self, x):
+        """Run the network on x."""
+        biases = self.weights[1::2]
+        i = 0
+        for layer, argument in self.layers:
+            if layer == 'conv':
+                kh, kw = self.weights[2 * i].shape[:2]
+                n, h, w = x.shape[:3]
+                columns = im2col(x, kh, kw)
+                x = ACTIVATIONS[argument]((self.multiply(i, columns) + biases[i]).reshape(n, h, w, -1))
+                i += 1
+            elif layer == 'pool':
+                x = maxPool(x, argument)
+            elif layer == 'flatten':
+                # Keras flattens channels last, i.e. in (h, w, c) order.
+                x = x.reshape(x.shape[0], -1)
+            elif layer == 'dense':
+                x = ACTIVATIONS[argument](self.multiply(i, x) + biases[i])
+                i += 1
+        return x
+
+    def predict(self, x, batch_size = 256, verbose = 0):
+        """Return the class probabilities for the (n, image_dim, image_dim, 1) images."""
+        x = np.asarray(x, dtype = np.float32)
+        predictions = np.zeros((len(x), self.num_classes), dtype = np.float32)
+        # Work in batches to keep the im2col arrays small.
+        for i in range(0, len(x), batch_size):
+            predictions[i:i + batch_size] = self.forward(x[i:i + batch_size])
+        return predictions
+
+
+def create_model(num_classes, image_dim):
+    return NumpyModel(PSAT_D_LAYERS, num_classes, image_dim)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""Compare the scores of quantised (float16, int8) PSAT-D weights with float32 on a training set's test images.
+
+Usage:
+  %s <trainingset> <classifier> [--calibrationsize=<calibrationsize>] [--keras] [--trainer=<trainer>] [--outputcsv=<outputcsv>]
+  %s (-h | --help)
+  %s --version
+
+Options:
+  -h --help                              Show this screen.
+  --version                              Show version.
+  --calibrationsize=<calibrationsize>    Number of training images on which to calibrate the int8 layer inputs [default: 1000].
+  --keras                                Also score with Keras, to check the float32 NumPy scores against it.
+  --trainer=<trainer>                    Training file [default: PSAT-D].
+  --outputcsv=<outputcsv>                Write the report to this CSV file as well.
+
+For each precision the report gives the 1%% MDR and 1%% FPR on the test set and
+the largest difference from the float32 scores, i.e. how much accuracy a
+site's classifier would lose if it were quantised.
+
+It is an accuracy study only. NumPy has no int8 or float16 matrix multiply
+faster than its float32 one, so the quantised weights are applied by rounding
+them (and, for calibrated int8, the layer inputs) to the reduced precision and
+multiplying in float32. That gives the scores of true reduced precision
+arithmetic, since the int8 x int8 products are summed exactly in float32 (the
+sums stay below 2**24), but not its speed, so no throughput is reported and
+the scorers have no quantised backend.
+
+Example:
+  python %s /data/training/atlas/02a_good330000_bad990000_s3_20230405.h5 /usr/local/ps1code/gitrelease/tf_trained_classifiers/02a_asteroids_good330000_bad990000_s3_20230405_classifier.h5 --outputcsv=/tmp/02a_quantisation.csv
+
+"""
+import sys
+__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+from docopt import docopt
+from gkutils.commonutils import Struct, cleanOptions
+import numpy as np
+import h5py
+import numpyInference
+from kerasTensorflowClassifier import load_data, one_percent_mdr, one_percent_fpr
+
+PRECISIONS = ['float32', 'float16', 'int8']
+INT8_MAX = 127
+
+
+def readCalibrationImages(trainingSet, sampleSize = 1000, seed = 0):
+    """Return a random sample of the training images in a buildMLDataSet .h5 file
+       as an (n, image_dim, image_dim, 1) array.
+    """
+    with h5py.File(trainingSet, 'r') as f:
+        m, n = f['X'].shape
+        rows = np.sort(np.random.RandomState(seed).choice(m, min(sampleSize, m), replace = False))
+        X = f['X'][rows]
+    image_dim = int(np.sqrt(n))
+    return np.reshape(X, (len(X), image_dim, image_dim), order = 'F')[..., np.newaxis].astype(np.float32)
+
+
+def quantiseKernel(kernel):
+    """Quantise a (inputs, outputs) kernel to int8 with one scale per output channel."""
+    scale = np.abs(kernel).max(axis = 0) / INT8_MAX
+    scale[scale == 0] = 1.0
+    quantised = np.clip(np.rint(kernel / scale), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return quantised, scale.astype(np.float32)
+
+
+class QuantisedModel(numpyInference.NumpyModel):
+    """The NumPy PSAT-D model with its kernels rounded to float16, or to int8 with one
+       scale per output channel. If calibration images are given, the int8 model
+       quantises the input of each layer too, with scales chosen from the range of
+       values they take on the calibration set.
+    """
+
+    def __init__(self, layers, num_classes, image_dim, precision = 'float32'):
+        if precision not in PRECISIONS:
+            raise ValueError("Precision must be one of %s" % ', '.join(PRECISIONS))
+        numpyInference.NumpyModel.__init__(self, layers, num_classes, image_dim)
+        self.precision = precision
+        self.scales = None
+        self.inputScales = None
+        # The inputs of the weighted layers are appended to this list while calibrating.
+        self.recording = None
+
+    def quantise(self, calibrationImages = None):
+        if self.precision == 'float16':
+            self.kernels = [k.astype(np.float16).astype(np.float32) for k in self.kernels]
+        elif self.precision == 'int8':
+            if calibrationImages is not None:
+                self.recording = []
+                self.forward(np.asarray(calibrationImages, dtype = np.float32))
+                # Ignore the odd extreme pixel when choosing the range.
+                self.inputScales = [max(np.percentile(np.abs(a), 99.99), 1e-12) / INT8_MAX for a in self.recording]
+                self.recording = None
+            kernels, self.scales = zip(*[quantiseKernel(k) for k in self.kernels])
+            self.kernels = [k.astype(np.float32) for k in kernels]
+
+    def multiply(self, i, x):
+        if self.recording is not None:
+            self.recording.append(x)
+        if self.scales is None:
+            # float32, float16 (whose kernels are float16 values held as float32) or not quantised yet.
+            return x @ self.kernels[i]
+        if self.inputScales is None:
+            # Weights only.
+            return (x @ self.kernels[i]) * self.scales[i]
+        inputScale = self.inputScales[i]
+        quantised = np.clip(np.rint(x / inputScale), -INT8_MAX, INT8_MAX)
+        return (quantised @ self.kernels[i]) * (inputScale * self.scales[i])
+
+
+def quantisedModel(classifier, num_classes, image_dim, precision, calibrationImages = None):
+    model = QuantisedModel(numpyInference.PSAT_D_LAYERS, num_classes, image_dim, precision = precision)
+    model.load_weights(classifier)
+    model.quantise(calibrationImages = calibrationImages)
+    return model
+
+
+def quantisationReport(opts):
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    if type(opts) is dict:
+        options = Struct(**opts)
+    else:
+        options = opts
+
+    num_classes = 2
+
+    train_data, test_data, image_dim = load_data(options.trainingset)
+    x_test = test_data[0].astype(np.float32)
+    y_test = test_data[1]
+
+    models = []
+    if options.keras:
+        from modelRegistry import getModel
+        models.append(('keras float32', getModel(options.classifier, trainer = options.trainer, num_classes = num_classes, image_dim = image_dim)))
+
+    for precision in PRECISIONS:
+        if precision == 'int8':
+            # Weights only, then weights and calibrated layer inputs.
+            models.append(('numpy int8 (weights)', quantisedModel(options.classifier, num_classes, image_dim, precision)))
+            calibrationImages = readCalibrationImages(options.trainingset, sampleSize = int(options.calibrationsize))
+            models.append(('numpy int8 (calibrated)', quantisedModel(options.classifier, num_classes, image_dim, precision, calibrationImages = calibrationImages)))
+        else:
+            models.append(('numpy %s' % precision, quantisedModel(options.classifier, num_classes, image_dim, precision)))
+
+    rows = []
+    reference = None
+    for name, model in models:
+        pred = model.predict(x_test, verbose=0)[:,1]
+        if name == 'numpy float32':
+            reference = pred
+        rows.append((name, pred))
+
+    print("%-25s %10s %10s %12s" % ('Precision', '1% MDR', '1% FPR', 'Max diff'))
+    report = []
+    for name, pred in rows:
+        row = (name, one_percent_mdr(y_test, pred), one_percent_fpr(y_test, pred), np.max(np.abs(pred - reference)))
+        print("%-25s %10.4f %10.4f %12.2e" % row)
+        report.append(row)
+
+    if options.outputcsv is not None:
+        with open(options.outputcsv, 'w') as f:
+            f.write('precision,one_percent_mdr,one_percent_fpr,max_difference\n')
+            for row in report:
+                f.write('%s,%f,%f,%e\n' % row)
+
+
+def main():
+    opts = docopt(__doc__, version='0.1')
+    opts = cleanOptions(opts)
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    options = Struct(**opts)
+    quantisationReport(options)
+
+
+if __name__=='__main__':
+    main()
@@ -2,7 +2,7 @@
 """Run the Keras/Tensorflow classifier.
 
 Usage:
-  %s <image>... [--classifier=<classifier>] [--outputcsv=<outputcsv>] [--fitsextension=<fitsextension>] [--keepfilename] [--fileoffiles] [--imagelocation=<imagelocation>] [--trainer=<trainer>]
+  %s <image>... [--classifier=<classifier>] [--outputcsv=<outputcsv>] [--fitsextension=<fitsextension>] [--keepfilename] [--fileoffiles] [--imagelocation=<imagelocation>] [--trainer=<trainer>] [--backend=<backend>] [--batchsize=<batchsize>] [--queuedepth=<queuedepth>] [--readthreads=<readthreads>] [--stampcache=<stampcache>] [--stampcachesize=<stampcachesize>] [--memorybudget=<memorybudget>] [--scorestore=<scorestore>] [--readorder=<readorder>] [--server=<server>] [--metrics=<metrics>] [--debug]
   %s (-h | --help)
   %s --version
 
@@ -16,6 +16,18 @@ Options:
   --fileoffiles                      Image file is a file of files. Allows many thousands of files to be read, avoiding command line constraints.
   --imagelocation=<imagelocation>    Location of the images if not specified in the actual filename.
   --trainer=<trainer>                Training file [default: PSAT-D].
+  --backend=<backend>                Inference backend: keras, or numpy for a lightweight NumPy-only forward pass (PSAT-D only) [default: keras].
+  --batchsize=<batchsize>            Number of images read and scored at a time [default: 1024].
+  --queuedepth=<queuedepth>          Number of batches read ahead of the one being scored [default: 4].
+  --readthreads=<readthreads>        Number of threads reading and normalising the stamps [default: 4].
+  --stampcache=<stampcache>          SQLite file in which to cache the normalised stamps, so they are only read and normalised once.
+  --stampcachesize=<stampcachesize>  Maximum size of the stamp cache in MB. The least recently used stamps are evicted [default: 1024].
+  --memorybudget=<memorybudget>      Memory in MB the scoring may use. The batch size is reduced to fit, and backs off if memory runs short. Defaults to the memory available when it starts.
+  --scorestore=<scorestore>          SQLite file in which to keep every image's score, per classifier, so only images not scored before by the same classifier are read and predicted.
+  --readorder=<readorder>            Order in which the stamps are read: db (as the database returns them) or locality (directory by directory, i.e. MJD by MJD, with the next batch's files read ahead) [default: locality].
+  --metrics=<metrics>                File to which to append the per-stage timings and throughput of the run (JSON lines, or CSV if it ends in .csv).
+  --debug                            Log debug messages, including a sample of the predictions.
+  --server=<server>                  Send the images to a running scoring server listening on this UNIX socket instead of loading the classifier.
 
 Example:
   python %s /tmp/image1.fits /tmp/image2.fits --classifier=/data/db4data1/scratch/kws/training/ps1/20190115/ps1_20190115_400000_1200000.best.hdf5 --outputcsv=/tmp/output.csv
@@ -25,54 +37,42 @@ import sys
 __doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
 from docopt import docopt
 from gkutils.commonutils import Struct, cleanOptions, readGenericDataFile, dbConnect
-import sys, csv, os
-from TargetImage import *
+import sys, csv, os, datetime, logging
 import numpy as np
-from kerasTensorflowClassifier import load_data
 from collections import defaultdict, OrderedDict
-# 2024-08-25 KWS Need importlib to import a library specified by a variable (trainer).
-import importlib
-
-
-def getRBValues(imageFilenames, classifier, extension = 0, keepfilename = None, imageLocation = None, trainer = 'PSAT-D'):
-    num_classes = 2
-    image_dim = 20
-    numImages = len(imageFilenames)
-    images = np.zeros((numImages, image_dim,image_dim,1))
-    #print images
-    # loop through and fill the above matrix, remembering to correctly scale the
-    # raw pixels for the specified sparse filter.
-    for j,imageFilename in enumerate(imageFilenames):
-        if imageLocation is not None and '/' not in imageFilename:
-            imageFilename = imageLocation + '/' + imageFilename
-        #print(imageFilename)
-        #vector = np.nan_to_num(TargetImage(imageFilename, extension=extension).signPreserveNorm())
-        vector = np.nan_to_num(TargetImage(imageFilename, extension=extension, magicNumber = -31415).signPreserveNorm())
-        #print vector
-        #print vector.shape
-        images[j,:,:,0] += np.reshape(vector, (image_dim,image_dim), order="F")
+from runKerasTensorflowClassifierOnPSATImages import getImageRBValues
+from stampCache import openStampCache
+from imageScoreStore import openScoreStore
+from scoringMetrics import ScoringMetrics, setMetrics
 
-    #print images.shape
+logger = logging.getLogger(__name__)
 
 
-    trainer = importlib.import_module(trainer)
-    create_model = trainer.create_model
+def getRBValues(imageFilenames, classifier, extension = 0, keepfilename = None, imageLocation = None, trainer = 'PSAT-D', backend = 'keras', server = None, **readOptions):
+    imagePaths = []
+    for imageFilename in imageFilenames:
+        if imageLocation is not None and '/' not in imageFilename:
+            imageFilename = imageLocation + '/' + imageFilename
+        imagePaths.append(imageFilename)
 
-    model = create_model(num_classes, image_dim)
-    model.load_weights(classifier)
+    if server:
+        # Let a resident scoring server (with the classifier already loaded) do the scoring.
+        from scoringServer import ScoringClient
+        pred = ScoringClient(server).getImageRBValues(imagePaths, classifier, extension = extension, magicNumber = -31415, trainer = trainer, backend = backend, **readOptions)
+    else:
+        pred = getImageRBValues(imagePaths, classifier, extension = extension, magicNumber = -31415, trainer = trainer, backend = backend, **readOptions)
 
-    pred = model.predict(images, verbose=0)
     # Collect the predictions from all the files, but aggregate into objects
     objectDict = defaultdict(list)
-    for i in range(len(pred[:,1])):
+    for i in range(len(pred)):
         if keepfilename:
             candidate = os.path.basename(imageFilenames[i])
         else:
             candidate = os.path.basename(imageFilenames[i]).split('.')[0]
         # Each candidate will end up with a list of predictions.
-        objectDict[candidate].append(pred[i,1])
+        objectDict[candidate].append(pred[i])
 
-        #print "%s,%.3lf"%(imageFilenames[i], pred[i,1])
+        #print "%s,%.3lf"%(imageFilenames[i], pred[i])
 
     return objectDict
 
@@ -97,7 +97,15 @@ def runKerasTensorflowClassifier(opts, processNumber = None):
 
     fitsExtension = int(options.fitsextension)
 
-    objectDictPS1 = getRBValues(imageFilenames, options.classifier, extension = fitsExtension, keepfilename = options.keepfilename, imageLocation = options.imagelocation, trainer = options.trainer)
+    metrics = ScoringMetrics()
+    setMetrics(metrics)
+    metrics.count('images', len(imageFilenames))
+
+    objectDictPS1 = getRBValues(imageFilenames, options.classifier, extension = fitsExtension, keepfilename = options.keepfilename, imageLocation = options.imagelocation, trainer = options.trainer, backend = options.backend, server = options.server, batchSize = int(options.batchsize), queueDepth = int(options.queuedepth), readThreads = int(options.readthreads), stampCache = options.stampcache, stampCacheSize = int(options.stampcachesize), memoryBudget = options.memorybudget, scoreStore = options.scorestore, readOrder = options.readorder)
+    if options.stampcache and not options.server:
+        openStampCache(options.stampcache).printStats()
+    if options.scorestore and not options.server:
+        openScoreStore(options.scorestore).printStats()
     objectScores = defaultdict(dict)
     for k, v in list(objectDictPS1.items()):
         objectScores[k]['ps1'] = np.array(v)
@@ -108,6 +116,7 @@ def runKerasTensorflowClassifier(opts, processNumber = None):
         finalScores[object] = np.median(objectScores[object]['ps1'])
 
     finalScoresSorted = OrderedDict(sorted(list(finalScores.items()), key=lambda t: t[1]))
+    metrics.count('objects', len(finalScoresSorted))
 
     if options.outputcsv is not None:
         prefix = options.outputcsv.split('.')[0]
@@ -127,9 +136,14 @@ def runKerasTensorflowClassifier(opts, processNumber = None):
         # Generate the insert statements
         with open('%s%s%s' % (prefix, processSuffix, suffix), 'w') as f:
             for k, v in list(finalScoresSorted.items()):
-                print(k, finalScoresSorted[k])
+                logger.debug("%s %s", k, finalScoresSorted[k])
                 f.write('%s,%f\n' % (k, finalScoresSorted[k]))
 
+    run = '%s_%d' % (datetime.datetime.fromtimestamp(metrics.start).strftime("%Y%m%d_%H%M%S"), os.getpid())
+    metrics.report(run = run, worker = processNumber)
+    if options.metrics:
+        metrics.write(options.metrics, run = run, worker = processNumber)
+
     scores = list(finalScoresSorted.items())
 
     return scores
@@ -141,6 +155,7 @@ def main():
 
     # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
     options = Struct(**opts)
+    logging.basicConfig(level = logging.DEBUG if options.debug else logging.INFO, format = '%(asctime)s %(levelname)s %(message)s')
     objectsForUpdate = runKerasTensorflowClassifier(options)
 
 if __name__=='__main__':
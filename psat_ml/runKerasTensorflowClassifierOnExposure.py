@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""Run the Keras/Tensorflow classifier on every detection of whole ATLAS difference exposures.
+
+Usage:
+  %s (<exposure> <detections>)... --classifier=<classifier> [--diffroot=<diffroot>] [--fitsextension=<fitsextension>] [--magicNumber=<magicNumber>] [--trainer=<trainer>] [--backend=<backend>] [--batchsize=<batchsize>] [--outputcsv=<outputcsv>] [--metrics=<metrics>] [--debug]
+  %s (-h | --help)
+  %s --version
+
+Options:
+  -h --help                          Show this screen.
+  --version                          Show version.
+  --classifier=<classifier>          Classifier file.
+  --diffroot=<diffroot>              Where the difference exposures are, for exposures given by name (e.g. 02a59000o0123c) [default: /atlas/diff/].
+  --fitsextension=<fitsextension>    FITS extension holding the image. Fpacked (.fz) exposures have it in extension 1 [default: 1].
+  --magicNumber=<magicNumber>        Magic number used to mask bad pixels in integer images. Masked pixels (and pixels off the edge of the exposure) are set to 0.
+  --trainer=<trainer>                Training file [default: PSAT-D].
+  --backend=<backend>                Inference backend: keras, or numpy for a lightweight NumPy-only forward pass (PSAT-D only) [default: keras].
+  --batchsize=<batchsize>            Number of windows predicted at a time [default: 4096].
+  --outputcsv=<outputcsv>            Output file of exposure, x, y and score, one row per detection.
+  --metrics=<metrics>                File to which to append the per-stage timings and throughput of the run (JSON lines, or CSV if it ends in .csv).
+  --debug                            Log debug messages.
+
+Rather than have stampstorm04 cut one FITS file per detection and read each one
+back, each exposure is decompressed once and the 20x20 window around every
+detection is cut straight out of it. The detections file is the same as the one
+given to stampstorm04: one detection per line, whitespace separated, starting
+with its x and y pixel position (FITS convention, the first pixel is 1). Any
+other columns are ignored.
+
+Example:
+  python %s 02a59000o0123c /tmp/good02a59000o0123c.txt --classifier=/usr/local/ps1code/gitrelease/tf_trained_classifiers/02a_asteroids_good330000_bad990000_s3_20230405_classifier.h5 --magicNumber=-31415 --outputcsv=/tmp/02a59000o0123c.csv
+  python %s /atlas/diff/02a/59000/02a59000o0123c.diff.fz /tmp/02a59000o0123c.txt /atlas/diff/02a/59000/02a59000o0124c.diff.fz /tmp/02a59000o0124c.txt --classifier=/tmp/classifier.h5 --backend=numpy
+
+"""
+import sys
+__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+from docopt import docopt
+from gkutils.commonutils import Struct, cleanOptions
+import os, datetime, logging
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from modelRegistry import getModel
+from TargetImage import TargetImageBatch
+from scoringMetrics import ScoringMetrics, setMetrics, getMetrics
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIM = 20
+
+
+def exposureFilename(exposure, diffRoot = '/atlas/diff/'):
+    """Return the file of an exposure given by name (e.g. 02a59000o0123c), or the exposure itself if it is already a file."""
+    if os.path.sep in exposure or exposure.endswith('.fz') or exposure.endswith('.fits'):
+        return exposure
+    camera = exposure[0:3]
+    mjd = exposure[3:8]
+    return os.path.join(diffRoot, camera, mjd, exposure + '.diff.fz')
+
+
+def readDetections(detectionsFile):
+    """Return the x and y positions of the detections in a stampstorm04 style file as two arrays."""
+    positions = np.loadtxt(detectionsFile, usecols = (0, 1), ndmin = 2, dtype = np.float64)
+    return positions[:, 0], positions[:, 1]
+
+
+def readExposure(exposureFile, extension = 1):
+    """Decompress the whole exposure once. Returns the image as a float32 array."""
+    from astropy.io import fits as pyfits
+    with pyfits.open(exposureFile) as hdulist:
+        return np.asarray(hdulist[extension].data, dtype = np.float32)
+
+
+def extractWindows(image, x, y, image_dim = IMAGE_DIM):
+    """Cut the image_dim x image_dim window around each (x, y) out of the image, as an
+       (n, image_dim, image_dim) array.
+
+       Each window is placed as the centre of a stamp is: the detection's (nearest)
+       pixel is at [image_dim/2, image_dim/2]. Pixels off the edge of the exposure are 0.
+    """
+    extent = image_dim // 2
+    rows, columns = image.shape
+
+    # FITS pixel (x, y) is row y - 1, column x - 1. Each window starts extent before it.
+    rowStarts = np.clip(np.rint(y).astype(int) - 1, 0, rows - 1) - extent
+    columnStarts = np.clip(np.rint(x).astype(int) - 1, 0, columns - 1) - extent
+
+    windows = np.zeros((len(rowStarts), image_dim, image_dim), dtype = image.dtype)
+    inside = (rowStarts >= 0) & (rowStarts <= rows - image_dim) & (columnStarts >= 0) & (columnStarts <= columns - image_dim)
+    if inside.any():
+        # A read only view of every image_dim x image_dim window, without copying anything.
+        view = as_strided(image, shape = (rows - image_dim + 1, columns - image_dim + 1, image_dim, image_dim), strides = image.strides * 2, writeable = False)
+        windows[inside] = view[rowStarts[inside], columnStarts[inside]]
+
+    # Padding the whole exposure would copy it, so copy just the part of each edge
+    # detection's window that is on the exposure. The rest stays 0.
+    for i in np.flatnonzero(~inside):
+        top, left = max(rowStarts[i], 0), max(columnStarts[i], 0)
+        bottom, right = min(rowStarts[i] + image_dim, rows), min(columnStarts[i] + image_dim, columns)
+        if bottom > top and right > left:
+            windows[i, top - rowStarts[i]:bottom - rowStarts[i], left - columnStarts[i]:right - columnStarts[i]] = image[top:bottom, left:right]
+    return windows
+
+
+def scoreExposure(exposureFile, detectionsFile, model, extension = 1, magicNumber = None, batchSize = 4096, image_dim = IMAGE_DIM):
+    """Return the x, y positions of the detections and their real/bogus scores."""
+    metrics = getMetrics()
+
+    x, y = readDetections(detectionsFile)
+    if len(x) == 0:
+        return x, y, np.zeros(0)
+
+    with metrics.stage('fitsDecode', 1):
+        image = readExposure(exposureFile, extension = extension)
+
+    with metrics.stage('normalisation', len(x)):
+        stamps = TargetImageBatch(extractWindows(image, x, y, image_dim = image_dim), image_dim // 2, magicNumber = magicNumber).signPreserveNorm()
+    del image
+
+    scores = np.zeros(len(x))
+    for offset in range(0, len(stamps), batchSize):
+        images = stamps[offset:offset + batchSize, :, :, np.newaxis]
+        with metrics.stage('predict', len(images)):
+            scores[offset:offset + len(images)] = model.predict(images, batch_size = len(images), verbose = 0)[:, 1]
+
+    metrics.count('images', len(x))
+    metrics.count('objects', len(x))
+    logger.debug("%s: %d detections, mean score %.3f", exposureFile, len(x), scores.mean())
+    return x, y, scores
+
+
+def runKerasTensorflowClassifierOnExposure(opts):
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    if type(opts) is dict:
+        options = Struct(**opts)
+    else:
+        options = opts
+
+    metrics = ScoringMetrics()
+    setMetrics(metrics)
+
+    magicNumber = int(options.magicNumber) if options.magicNumber is not None else None
+    model = getModel(options.classifier, trainer = options.trainer, num_classes = 2, image_dim = IMAGE_DIM, backend = options.backend)
+
+    results = []
+    for exposure, detectionsFile in zip(options.exposure, options.detections):
+        exposureFile = exposureFilename(exposure, diffRoot = options.diffroot)
+        x, y, scores = scoreExposure(exposureFile, detectionsFile, model, extension = int(options.fitsextension), magicNumber = magicNumber, batchSize = int(options.batchsize))
+        print("%s: scored %d detections" % (exposureFile, len(scores)))
+        name = os.path.basename(exposureFile).split('.')[0]
+        results += [(name, x[i], y[i], scores[i]) for i in range(len(scores))]
+
+    if options.outputcsv is not None:
+        with open(options.outputcsv, 'w') as f:
+            for row in results:
+                f.write('%s,%.3f,%.3f,%f\n' % row)
+
+    run = '%s_%d' % (datetime.datetime.fromtimestamp(metrics.start).strftime("%Y%m%d_%H%M%S"), os.getpid())
+    metrics.report(run = run)
+    if options.metrics:
+        metrics.write(options.metrics, run = run)
+
+    return results
+
+
+def main():
+    opts = docopt(__doc__, version='0.1')
+    opts = cleanOptions(opts)
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    options = Struct(**opts)
+    logging.basicConfig(level = logging.DEBUG if options.debug else logging.INFO, format = '%(asctime)s %(levelname)s %(message)s')
+    runKerasTensorflowClassifierOnExposure(options)
+
+
+if __name__=='__main__':
+    main()
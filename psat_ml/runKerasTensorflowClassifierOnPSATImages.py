@@ -2,7 +2,7 @@
 """Run the Keras/Tensorflow classifier on Pan-STARRS and ATLAS images.
 
 Usage:
-  %s <configFile> [<candidate>...] [--hkoclassifier=<hkoclassifier>] [--mloclassifier=<mloclassifier>] [--sthclassifier=<sthclassifier>] [--chlclassifier=<chlclassifier>] [--ps1classifier=<ps1classifier>] [--ps2classifier=<ps2classifier>] [--outputcsv=<outputcsv>] [--listid=<listid>] [--imageroot=<imageroot>] [--update] [--tablename=<tablename>] [--columnname=<columnname>] [--candidatesinfiles] [--magicNumber=<magicNumber>] [--trainer=<trainer>]
+  %s <configFile> [<candidate>...] [--hkoclassifier=<hkoclassifier>] [--mloclassifier=<mloclassifier>] [--sthclassifier=<sthclassifier>] [--chlclassifier=<chlclassifier>] [--ps1classifier=<ps1classifier>] [--ps2classifier=<ps2classifier>] [--outputcsv=<outputcsv>] [--listid=<listid>] [--imageroot=<imageroot>] [--update] [--tablename=<tablename>] [--columnname=<columnname>] [--updatebatchsize=<updatebatchsize>] [--querychunksize=<querychunksize>] [--candidatesinfiles] [--magicNumber=<magicNumber>] [--trainer=<trainer>] [--backend=<backend>] [--batchsize=<batchsize>] [--queuedepth=<queuedepth>] [--readthreads=<readthreads>] [--stampcache=<stampcache>] [--stampcachesize=<stampcachesize>] [--memorybudget=<memorybudget>] [--scorestore=<scorestore>] [--readorder=<readorder>] [--manifest=<manifest>] [--aggregation=<aggregation>] [--sites=<sites>] [--server=<server>] [--metrics=<metrics>] [--debug] [--follow] [--pollinterval=<pollinterval>] [--followbatchsize=<followbatchsize>] [--rescaninterval=<rescaninterval>]
   %s (-h | --help)
   %s --version
 
@@ -19,11 +19,32 @@ Options:
   --outputcsv=<outputcsv>            Output file [default: /tmp/update_eyeball_scores.csv].
   --imageroot=<imageroot>            Root location of the actual images [default: /db4/images/].
   --update                           Update the database.
-  --tablename=<tablename>            Database table name to update [default: atlas_diff_objects].
-  --columnname=<columnname>          Database column name to update [default: zooniverse_score].
+  --tablename=<tablename>            Database table name to update. Defaults to atlas_diff_objects (ATLAS) or tcs_transient_objects (Pan-STARRS).
+  --columnname=<columnname>          Database column name to update. Defaults to zooniverse_score (ATLAS) or confidence_factor (Pan-STARRS).
+  --updatebatchsize=<updatebatchsize>  Number of rows to update in each database transaction [default: 1000].
+  --querychunksize=<querychunksize>  Number of objects whose images are looked up in each database query [default: 1000].
   --candidatesinfiles                Interpret the inline candidate IDs as a files containing candidates.
   --magicNumber=<magicNumber>        Magic number used to mask bad pixels in integer image files (ATLAS only).
   --trainer=<trainer>                Training file [default: PSAT-D].
+  --backend=<backend>                Inference backend: keras, or numpy for a lightweight NumPy-only forward pass (PSAT-D only) [default: keras].
+  --batchsize=<batchsize>            Number of images read and scored at a time [default: 1024].
+  --queuedepth=<queuedepth>          Number of batches read ahead of the one being scored [default: 4].
+  --readthreads=<readthreads>        Number of threads reading and normalising the stamps [default: 4].
+  --stampcache=<stampcache>          SQLite file in which to cache the normalised stamps, so they are only read and normalised once.
+  --stampcachesize=<stampcachesize>  Maximum size of the stamp cache in MB. The least recently used stamps are evicted [default: 1024].
+  --memorybudget=<memorybudget>      Memory in MB the scoring may use. The batch size is reduced to fit, and backs off if memory runs short. Defaults to the memory available when it starts.
+  --scorestore=<scorestore>          SQLite file in which to keep every image's score, per classifier, so only images not scored before by the same classifier are read and predicted.
+  --readorder=<readorder>            Order in which the stamps are read: db (as the database returns them) or locality (directory by directory, i.e. MJD by MJD, with the next batch's files read ahead) [default: locality].
+  --manifest=<manifest>              JSON file in which to keep the image directory listings between runs.
+  --aggregation=<aggregation>        How to combine the image scores into an object score (median | mean | max | weighted) [default: median].
+  --sites=<sites>                    YAML file describing the sites (telescopes) and how to match their images. Defaults to sites.yaml alongside this script.
+  --metrics=<metrics>                File to which to append the per-stage timings and throughput of the run (JSON lines, or CSV if it ends in .csv).
+  --debug                            Log debug messages, including a sample of the predictions.
+  --follow                           Keep running (with the classifiers loaded), scoring new candidates in the list as they arrive, until stopped.
+  --pollinterval=<pollinterval>      Seconds between polls for new candidates in follow mode [default: 10].
+  --followbatchsize=<followbatchsize>  Most new candidates scored (and written back) at a time in follow mode [default: 100].
+  --rescaninterval=<rescaninterval>  Seconds between full scans of the list in follow mode, for unscored candidates the polls can't see (e.g. moved into the list, or whose images were late) [default: 3600].
+  --server=<server>                  Send the images to a running scoring server listening on this UNIX socket instead of loading the classifiers.
 
 Example:
   python %s ~/config.pso3.gw.warp.yaml --ps1classifier=/data/db4data1/scratch/kws/training/ps1/20190115/ps1_20190115_400000_1200000.best.hdf5 --listid=4 --outputcsv=/tmp/pso3_list_4.csv
@@ -38,13 +59,24 @@ import sys
 __doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
 from docopt import docopt
 from gkutils.commonutils import Struct, cleanOptions, readGenericDataFile, dbConnect
-import sys, csv, os
-from TargetImage import *
+import sys, csv, os, re, time, datetime, signal, threading
 import numpy as np
-from kerasTensorflowClassifier import load_data
 from collections import defaultdict, OrderedDict
-# 2024-08-25 KWS Need importlib to import a library specified by a variable (trainer).
-import importlib
+from modelRegistry import getModel
+from stampReader import readStampBatches, localityOrder
+from stampCache import openStampCache
+from imageScoreStore import openScoreStore
+from scoreAggregation import aggregateScores, objectIdFromFilename
+from siteRegistry import configureSites, partitionImages
+from directoryIndex import DirectoryIndex
+from scoringMetrics import ScoringMetrics, getMetrics, setMetrics
+from memoryGovernor import MemoryGovernor
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Only log the predictions of every DEBUG_SAMPLE_BATCHES-th batch.
+DEBUG_SAMPLE_BATCHES = 100
 
 # 2019-05-05 KWS Limit the number of CPUs to 4 for each process. Should still overuse the CPUs
 #                but should get away with this because of I/O.
@@ -81,53 +113,143 @@ def getObjectsByList(conn, dbName, listId = 4, imageRoot='/db4/images/', ps1Data
 
     return resultSet
 
+def getMaxObjectId(conn, dbName, ps1Data = False):
+    """The highest object ID in the objects table (an index lookup), or 0 if it's empty."""
+    import MySQLdb
+    maxId = 0
+    try:
+        cursor = conn.cursor (MySQLdb.cursors.DictCursor)
+        cursor.execute ("select max(id) as maxId from %s" % ('tcs_transient_objects' if ps1Data else 'atlas_diff_objects'))
+        row = cursor.fetchone ()
+        cursor.close ()
+        if row and row['maxId'] is not None:
+            maxId = int(row['maxId'])
+
+    except MySQLdb.Error as e:
+        print("Error %d: %s" % (e.args[0], e.args[1]))
+
+    return maxId
+
+
+def getNewObjectsByList(conn, dbName, listId = 4, afterId = 0, limit = 100, ps1Data = False):
+    """Get up to limit unscored candidates in the list with IDs above afterId, in ID order.
+       Only the primary key range above afterId is read, not the whole list.
+    """
+    import MySQLdb
+    resultSet = []
+    try:
+        cursor = conn.cursor (MySQLdb.cursors.DictCursor)
+
+        if ps1Data:
+            cursor.execute ("""
+                select id
+                  from tcs_transient_objects
+                 where id > %s
+                   and detection_list_id = %s
+                   and confidence_factor is null
+                   and tcs_images_id is not null
+              order by id
+                 limit %s
+            """, (afterId, listId, limit))
+        else:
+            cursor.execute ("""
+                select id
+                  from atlas_diff_objects
+                 where id > %s
+                   and detection_list_id = %s
+                   and zooniverse_score is null
+              order by id
+                 limit %s
+            """, (afterId, listId, limit))
+        resultSet = cursor.fetchall ()
+        cursor.close ()
+
+    except MySQLdb.Error as e:
+        print("Error %d: %s" % (e.args[0], e.args[1]))
+
+    return resultSet
+
 # 2019-05-02 KWS Separated out the acquisiton of images so that can do
 #                this multithreaded. Also so we can pass a user defined
 #                list of objects to the processing.
 
-def getImages(conn, dbName, objectList, imageRoot='/psdb3/images/', ps1Data = False):
+def getImagesByObject(conn, dbName, objectList, imageRoot='/psdb3/images/', ps1Data = False, chunkSize = 1000, metrics = None, directoryIndex = None):
+    """Get the existing diff images of each object, chunkSize objects per query.
+
+       returns: an OrderedDict of image rows (filename, filter) keyed by object ID
+       in the same order as objectList. The time spent querying the database and
+       checking the files is added to the metrics (the process's current ones if
+       not specified). Whether the files exist is answered by directoryIndex (a
+       fresh one if not specified).
+    """
     import MySQLdb
-    images = []
-    # Now, for each candidate, get the image
-    for row in objectList:
+
+    if metrics is None:
+        metrics = getMetrics()
+
+    if directoryIndex is None:
+        directoryIndex = DirectoryIndex()
+
+    imagesByObject = OrderedDict((str(row['id']), []) for row in objectList)
+    objectIds = list(imagesByObject.keys())
+
+    # 2022-01-01 KWS Use mjd_obs for Pan-STARRS but use filename to get MJD if ATLAS.
+    #                Fixes issue with South Africa (and Chile) night number and MJD
+    #                mismatch.
+    if ps1Data:
+        mjdColumn = "truncate(mjd_obs,0)"
+    else:
+        mjdColumn = "if(instr(pss_filename,'skycell'),truncate(mjd_obs,0),substr(pss_filename,4,5))"
+
+    for i in range(0, len(objectIds), chunkSize):
+        chunk = objectIds[i:i + chunkSize]
+        # Keep the per-object prefix match so the image_filename index can still be used.
+        objectClause = ' or '.join(["(image_filename like concat(%s, '%%') and image_filename not like concat(%s, '%%4300000000%%'))"] * len(chunk))
+        parameters = [imageRoot, dbName]
+        for objectId in chunk:
+            parameters += [objectId, objectId]
+
         try:
+            queryStart = time.time()
             cursor = conn.cursor (MySQLdb.cursors.DictCursor)
-            # 2022-01-01 KWS Use mjd_obs for Pan-STARRS but use filename to get MJD if ATLAS.
-            #                Fixes issue with South Africa (and Chile) night number and MJD
-            #                mismatch.
-            if ps1Data:
-                cursor.execute ("""
-                select concat(%s ,%s,'/',truncate(mjd_obs,0), '/', image_filename,'.fits') as filename, filter from tcs_postage_stamp_images
-                 where image_filename like concat(%s, '%%')
-                   and image_filename not like concat(%s, '%%4300000000%%')
-                   and image_type = 'diff'
-                   and image_filename is not null
-                   and pss_error_code = 0
-                   and mjd_obs is not null
-                """, (imageRoot, dbName, row['id'], row['id']))
-            else:
-                cursor.execute ("""
-                select concat(%s ,%s,'/',if(instr(pss_filename,'skycell'),truncate(mjd_obs,0),substr(pss_filename,4,5)), '/', image_filename,'.fits') as filename, filter from tcs_postage_stamp_images
-                 where image_filename like concat(%s, '%%')
-                   and image_filename not like concat(%s, '%%4300000000%%')
+            cursor.execute ("""
+                select concat(%%s ,%%s,'/',%s, '/', image_filename,'.fits') as filename, filter, image_filename from tcs_postage_stamp_images
+                 where (%s)
                    and image_type = 'diff'
                    and image_filename is not null
                    and pss_error_code = 0
                    and mjd_obs is not null
-                """, (imageRoot, dbName, row['id'], row['id']))
+            """ % (mjdColumn, objectClause), parameters)
 
             imageResultSet = cursor.fetchall ()
             cursor.close ()
-            for row in imageResultSet:
-                # Only append images that actually exist!
-                if os.path.exists(row['filename']):
-                    images.append(row)
+            metrics.add('imageQuery', time.time() - queryStart, 1)
 
         except MySQLdb.Error as e:
             print("Error %d: %s" % (e.args[0], e.args[1]))
+            continue
+
+        statStart = time.time()
+        scans = directoryIndex.scans
+        for row in imageResultSet:
+            objectId = row['image_filename'].split('_')[0]
+            # Only append images that actually exist! Each directory is only listed once.
+            if objectId in imagesByObject and directoryIndex.exists(row['filename']):
+                imagesByObject[objectId].append({'filename': row['filename'], 'filter': row['filter']})
+        metrics.add('fileStat', time.time() - statStart, len(imageResultSet))
+        metrics.count('directoryScans', directoryIndex.scans - scans)
+
+    return imagesByObject
+
+
+def getImages(conn, dbName, objectList, imageRoot='/psdb3/images/', ps1Data = False, chunkSize = 1000, metrics = None, directoryIndex = None):
+    images = []
+    for objectImages in getImagesByObject(conn, dbName, objectList, imageRoot = imageRoot, ps1Data = ps1Data, chunkSize = chunkSize, metrics = metrics, directoryIndex = directoryIndex).values():
+        images += objectImages
 
     return images
 
+
 # Update the database.
 def updateTransientRBValue(conn, objectId, realBogusValue, ps1Data = False):
     import MySQLdb
@@ -198,42 +320,301 @@ def updateObjectRBFactors(conn, objectId, realBogusValue, tableName, columnName)
     return rowsUpdated
 
 
-def getRBValues(imageFilenames, classifier, extension = 0, magicNumber = None, trainer = 'PSAT-D'):
+def updateTransientRBValues(conn, scores, tableName = None, columnName = None, ps1Data = False, batchSize = 1000):
+    """Bulk replacement for updateTransientRBValue.
+
+       scores is a list of (objectId, realBogusValue) pairs. They are sent as
+       multi-row UPDATE ... JOIN statements of batchSize rows, each batch in
+       its own transaction. If tableName and columnName are not specified,
+       the ATLAS or Pan-STARRS defaults are used.
+
+       returns: (rowsUpdated, rowsMissed) where rowsMissed is the number of
+       objects not found in the table.
+    """
+    import MySQLdb
+
+    if tableName is None:
+        tableName = 'tcs_transient_objects' if ps1Data else 'atlas_diff_objects'
+    if columnName is None:
+        columnName = 'confidence_factor' if ps1Data else 'zooniverse_score'
+
+    # Table and column names can't be bound as parameters, so make sure they are just names.
+    for name in (tableName, columnName):
+        if not re.match(r'^[A-Za-z0-9_]+$', name):
+            raise ValueError("Invalid table or column name: %s" % name)
+
+    rowsUpdated = 0
+    rowsMissed = 0
+
+    # Each batch is its own transaction. Autocommit goes back on afterwards, whatever happens.
+    conn.autocommit(False)
+    try:
+        for i in range(0, len(scores), batchSize):
+            batch = scores[i:i + batchSize]
+            objectIds = [int(row[0]) for row in batch]
+            values = []
+            for objectId, realBogusValue in batch:
+                values += [int(objectId), float(realBogusValue)]
+
+            try:
+                cursor = conn.cursor(MySQLdb.cursors.DictCursor)
+
+                # MySQL only counts rows whose value actually changed as updated,
+                # so count the rows that exist to find the ones we missed.
+                cursor.execute ("""
+                    select count(*) as found
+                      from %s
+                     where id in (%s)
+                """ % (tableName, ','.join(['%s'] * len(batch))), objectIds)
+                found = cursor.fetchone()['found']
+
+                cursor.execute ("""
+                    update %s t
+                      join (%s) s on s.id = t.id
+                       set t.%s = s.score
+                """ % (tableName, ' union all '.join(['select %s as id, %s as score'] * len(batch)), columnName), values)
+
+                rowsUpdated += cursor.rowcount
+                rowsMissed += len(batch) - found
+
+                cursor.close ()
+                conn.commit()
+
+            except MySQLdb.Error as e:
+                conn.rollback()
+                rowsMissed += len(batch)
+                print ("Error %d: %s" % (e.args[0], e.args[1]))
+    finally:
+        conn.autocommit(True)
+
+    # Did we miss any transient object rows? If so issue a warning.
+    if rowsMissed > 0:
+        print ("WARNING: %d transient object entries were not updated." % rowsMissed)
+
+    return rowsUpdated, rowsMissed
+
+
+def streamImageRBValues(imageFilenames, classifier, extension = 0, magicNumber = None, trainer = 'PSAT-D', backend = 'keras', batchSize = 1024, queueDepth = 4, readThreads = 4, stampCache = None, stampCacheSize = 1024, memoryBudget = None, readAhead = False):
+    """Generator yielding (offset, predictions) for each batch of images as soon
+       as it has been scored. Memory use is bounded by the batch size and queue
+       depth rather than by the number of images. batchSize is the largest batch:
+       a memory governor shrinks it if the process nears memoryBudget MB (default,
+       the memory available). If stampCache (a file) is given, the normalised
+       stamps are read through it (up to stampCacheSize MB). If readAhead is set,
+       the files of the next batch are fetched while each batch is read.
+    """
     num_classes = 2
     image_dim = 20
-    numImages = len(imageFilenames)
-    images = np.zeros((numImages, image_dim,image_dim,1))
-    #print images
-    # loop through and fill the above matrix, remembering to correctly scale the
-    # raw pixels for the specified sparse filter.
-    for j,imageFilename in enumerate(imageFilenames):
-        vector = np.nan_to_num(TargetImage(imageFilename, extension=extension, magicNumber = magicNumber).signPreserveNorm())
-        #print vector
-        #print vector.shape
-        images[j,:,:,0] += np.reshape(vector, (image_dim,image_dim), order="F")
-
-    #print images.shape
-
-    trainer = importlib.import_module(trainer)
-    create_model = trainer.create_model
-
-    model = create_model(num_classes, image_dim)
-    model.load_weights(classifier)
-
-    pred = model.predict(images, verbose=0)
-    print("PRED = ", pred)
-    # Collect the predictions from all the files, but aggregate into objects
+
+    # Build (or reuse) the model once per process rather than once per call.
+    model = getModel(classifier, trainer = trainer, num_classes = num_classes, image_dim = image_dim, backend = backend)
+
+    cache = None
+    if stampCache:
+        cache = openStampCache(stampCache, maxBytes = int(stampCacheSize) * 1024 * 1024)
+
+    metrics = getMetrics()
+
+    governor = MemoryGovernor(int(memoryBudget) * 1024 * 1024 if memoryBudget else None)
+    batchSize = governor.batchSize(int(batchSize), queueDepth = queueDepth, image_dim = image_dim)
+
+    # The stamps are read in the background while the previous batch is being scored.
+    for batchNumber, (offset, images) in enumerate(readStampBatches(imageFilenames, batchSize = batchSize, queueDepth = queueDepth, extension = extension, magicNumber = magicNumber, image_dim = image_dim, readThreads = readThreads, cache = cache, governor = governor, readAhead = readAhead)):
+        # Each batch is sized to fit in memory, so predict it in one go rather than Keras's default of 32 images at a time.
+        with metrics.stage('predict', len(images)):
+            pred = model.predict(images, batch_size = len(images), verbose=0)
+        if batchNumber % DEBUG_SAMPLE_BATCHES == 0 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Batch %d, images %d to %d: mean score %.3f, first scores %s", batchNumber, offset, offset + len(pred) - 1, pred[:,1].mean(), pred[:5,1])
+        yield offset, pred[:,1]
+
+
+def getImageRBValues(imageFilenames, classifier, extension = 0, magicNumber = None, trainer = 'PSAT-D', backend = 'keras', scoreStore = None, readOrder = 'locality', **readOptions):
+    """Return the real/bogus prediction for each of the images, in the same order as the filenames.
+       readOptions (batchSize, queueDepth, readThreads) are passed on to streamImageRBValues.
+       If scoreStore (a file) is given, images it already has a score for from the same
+       classifier aren't predicted again, and the new scores are added to it.
+       readOrder is the order in which the images are read: 'db' (as given) or
+       'locality' (directory by directory, with the next batch's files read ahead).
+    """
+    predictions = np.zeros(len(imageFilenames))
+
+    store = None
+    toScore = np.arange(len(imageFilenames))
+    if scoreStore:
+        store = openScoreStore(scoreStore)
+        scorer = store.scorerKey(classifier, trainer = trainer, backend = backend, extension = extension, magicNumber = magicNumber)
+        storedScores = store.get(imageFilenames, scorer)
+        if storedScores:
+            known = np.array([f in storedScores for f in imageFilenames], dtype = bool)
+            predictions[known] = [storedScores[f] for f in imageFilenames if f in storedScores]
+            toScore = np.flatnonzero(~known)
+            getMetrics().count('storedScores', int(known.sum()))
+        if len(toScore) == 0:
+            return predictions
+
+    if readOrder == 'locality':
+        # The database returns the images object by object, scattered over the MJD directories.
+        toScore = toScore[localityOrder([imageFilenames[i] for i in toScore])]
+
+    filenamesToScore = [imageFilenames[i] for i in toScore]
+    for offset, pred in streamImageRBValues(filenamesToScore, classifier, extension = extension, magicNumber = magicNumber, trainer = trainer, backend = backend, readAhead = (readOrder == 'locality'), **readOptions):
+        predictions[toScore[offset:offset + len(pred)]] = pred
+        if store is not None:
+            # Store each batch as it comes, so an interrupted run keeps what it has done.
+            store.put(zip(filenamesToScore[offset:offset + len(pred)], pred), scorer)
+
+    return predictions
+
+
+def groupRBValuesByObject(imageFilenames, predictions):
+    """Collect the predictions from all the files, but aggregate into objects."""
     objectDict = defaultdict(list)
-    for i in range(len(pred[:,1])):
+    for i in range(len(predictions)):
         candidate = os.path.basename(imageFilenames[i]).split('_')[0]
         # Each candidate will end up with a list of predictions.
-        objectDict[candidate].append(pred[i,1])
+        objectDict[candidate].append(predictions[i])
 
-        #print "%s,%.3lf"%(imageFilenames[i], pred[i,1])
+        #print "%s,%.3lf"%(imageFilenames[i], predictions[i])
 
     return objectDict
 
 
+def getRBValues(imageFilenames, classifier, extension = 0, magicNumber = None, trainer = 'PSAT-D', backend = 'keras', **readOptions):
+    predictions = getImageRBValues(imageFilenames, classifier, extension = extension, magicNumber = magicNumber, trainer = trainer, backend = backend, **readOptions)
+    return groupRBValuesByObject(imageFilenames, predictions)
+
+
+def getObjectScores(imageFilenames, options, ps1Data = False, rbValues = getImageRBValues):
+    """Split the image rows between the sites in the sites file, apply each site's
+       classifier and combine the per-image predictions into one score per object
+       using the aggregation rule in options.aggregation.
+
+       rbValues is the function used to score each group of images. It defaults
+       to local scoring but can be replaced, e.g. by a scoring server client.
+    """
+
+    # How the stamps are read is the same for every site.
+    readOptions = {'batchSize': int(options.batchsize),
+                   'queueDepth': int(options.queuedepth),
+                   'readThreads': int(options.readthreads),
+                   'stampCache': options.stampcache,
+                   'stampCacheSize': int(options.stampcachesize),
+                   'memoryBudget': options.memorybudget,
+                   'scoreStore': options.scorestore,
+                   'readOrder': options.readorder}
+
+    # 2023-07-24 KWS Split the PS1 and PS2 images like the ATLAS ones.
+    #                The filter column can easily be used for this.
+    # The order of the sites decides which one wins if two have the same number of images.
+    sites = configureSites(options, 'ps1' if ps1Data else 'atlas', sitesFile = options.sites)
+    partitions = partitionImages(imageFilenames, sites)
+
+    # Collect the object, site and score of every image into flat arrays.
+    objectIds = []
+    siteCodes = []
+    scores = []
+    for siteCode, (site, siteFilenames) in enumerate(zip(sites, partitions)):
+        if not siteFilenames:
+            continue
+        if not site['classifier']:
+            print("WARNING: No %s classifier specified. Ignoring %d %s images." % (site['name'], len(siteFilenames), site['name']))
+            continue
+        scores.append(rbValues(siteFilenames, site['classifier'], extension = site['extension'], magicNumber = site['magicNumber'], trainer = options.trainer, backend = options.backend, **readOptions))
+        objectIds.append([objectIdFromFilename(f) for f in siteFilenames])
+        siteCodes.append(np.full(len(siteFilenames), siteCode))
+
+    if not scores:
+        return {}
+
+    # Some objects will have data from two telescopes, some only one. By default
+    # choose the median value of the telescope with the most images.
+    objects, objectScores = aggregateScores(np.concatenate(objectIds), np.concatenate(siteCodes), np.concatenate(scores), rule = options.aggregation)
+
+    finalScores = dict(zip(objects.tolist(), objectScores.tolist()))
+
+    return finalScores
+
+
+def followList(conn, database, options, ps1Data = False, rbValues = getImageRBValues):
+    """Score new candidates in the list as they arrive, until stopped (SIGTERM or ^C).
+
+       Rather than rescanning the whole list for unscored candidates, each poll
+       only asks for the ones with IDs above the highest seen so far. They are
+       scored in micro-batches and written back straight away. Candidates whose
+       IDs are below the mark (e.g. moved into the list later) or which had no
+       images yet are picked up by a full scan of the list every rescaninterval.
+    """
+    listId = int(options.listid)
+    pollInterval = float(options.pollinterval)
+    batchSize = int(options.followbatchsize)
+    rescanInterval = float(options.rescaninterval)
+    metrics = getMetrics()
+
+    stopping = threading.Event()
+    def stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+
+    def scoreBatch(objectList):
+        # New images keep arriving, so list the directories afresh for each batch.
+        directoryIndex = DirectoryIndex(options.manifest)
+        imageFilenames = getImages(conn, database, objectList, imageRoot = options.imageroot, chunkSize = int(options.querychunksize), metrics = metrics, directoryIndex = directoryIndex)
+        directoryIndex.save()
+        metrics.count('images', len(imageFilenames))
+        if not imageFilenames:
+            return
+
+        start = time.time()
+        scores = list(getObjectScores(imageFilenames, options, ps1Data = ps1Data, rbValues = rbValues).items())
+        metrics.count('objects', len(scores))
+
+        if options.outputcsv is not None:
+            with open(options.outputcsv, 'a') as f:
+                for objectId, score in scores:
+                    f.write('%s,%f\n' % (objectId, score))
+
+        if options.update:
+            with metrics.stage('dbUpdate', len(scores)):
+                updateTransientRBValues(conn, scores, tableName = options.tablename, columnName = options.columnname, ps1Data = ps1Data, batchSize = int(options.updatebatchsize))
+
+        print("%s Scored %d of %d objects (%d images) in %.1fs" % (datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S"), len(scores), len(objectList), len(imageFilenames), time.time() - start))
+        sys.stdout.flush()
+
+    highWater = 0
+    lastRescan = None
+    print("Following list %d. Polling every %.0fs." % (listId, pollInterval))
+    try:
+        while not stopping.is_set():
+            if lastRescan is None or time.time() - lastRescan >= rescanInterval:
+                # Take the mark before the scan, so nothing arriving during it is missed.
+                highWater = max(highWater, getMaxObjectId(conn, database, ps1Data = ps1Data))
+                with metrics.stage('objectQuery'):
+                    objectList = getObjectsByList(conn, database, listId = listId, ps1Data = ps1Data)
+                metrics.add('objectQuery', 0.0, len(objectList))
+                lastRescan = time.time()
+                if objectList:
+                    print("Full scan: %d unscored objects in list %d." % (len(objectList), listId))
+            else:
+                with metrics.stage('objectQuery'):
+                    objectList = getNewObjectsByList(conn, database, listId = listId, afterId = highWater, limit = batchSize, ps1Data = ps1Data)
+                metrics.add('objectQuery', 0.0, len(objectList))
+                if objectList:
+                    highWater = max(highWater, max(int(row['id']) for row in objectList))
+
+            for i in range(0, len(objectList), batchSize):
+                if stopping.is_set():
+                    break
+                scoreBatch(objectList[i:i + batchSize])
+
+            # A full batch means there are probably more waiting, so poll again straight away.
+            if len(objectList) < batchSize:
+                stopping.wait(pollInterval)
+    except KeyboardInterrupt:
+        pass
+
+    print("Stopped following list %d." % listId)
+
+
 def runKerasTensorflowClassifier(opts, processNumber = None):
 
     # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
@@ -275,6 +656,23 @@ def runKerasTensorflowClassifier(opts, processNumber = None):
 
     objectList = []
     imageFilenames = []
+    metrics = ScoringMetrics()
+    setMetrics(metrics)
+
+    rbValues = getImageRBValues
+    if options.server:
+        # Let a resident scoring server (with its classifiers already loaded) do the scoring.
+        from scoringServer import ScoringClient
+        rbValues = ScoringClient(options.server).getImageRBValues
+
+    if options.follow:
+        followList(conn, database, options, ps1Data = ps1Data, rbValues = rbValues)
+        run = '%s_%d' % (datetime.datetime.fromtimestamp(metrics.start).strftime("%Y%m%d_%H%M%S"), os.getpid())
+        metrics.report(run = run)
+        if options.metrics:
+            metrics.write(options.metrics, run = run)
+        conn.close()
+        return []
 
     # if candidates are specified in the options, then override the list.
     if len(options.candidate) > 0:
@@ -291,119 +689,22 @@ def runKerasTensorflowClassifier(opts, processNumber = None):
     else:
         # Only collect by the list ID if we are running in single threaded mode
         if processNumber is None:
-            objectList = getObjectsByList(conn, database, listId = int(options.listid), ps1Data = ps1Data)
+            with metrics.stage('objectQuery'):
+                objectList = getObjectsByList(conn, database, listId = int(options.listid), ps1Data = ps1Data)
+            metrics.add('objectQuery', 0.0, len(objectList))
 
     if len(objectList) > 0:
-        imageFilenames = getImages(conn, database, objectList, imageRoot=options.imageroot)
+        directoryIndex = DirectoryIndex(options.manifest)
+        imageFilenames = getImages(conn, database, objectList, imageRoot=options.imageroot, chunkSize = int(options.querychunksize), metrics = metrics, directoryIndex = directoryIndex)
+        directoryIndex.save()
+        metrics.count('images', len(imageFilenames))
         if len(imageFilenames) == 0:
             print("NO IMAGES")
             conn.close()
             return []
 
-    magicNumber = None
-    if options.magicNumber:
-        magicNumber = int(options.magicNumber)
-
-    if ps1Data:
-        # 2023-07-24 KWS Split the PS1 and PS2 images like the ATLAS ones.
-        #                The filter column can easily be used for this.
-        ps1Filenames = []
-        for row in imageFilenames:
-            if '00000' in row['filter']:
-                ps1Filenames.append(row['filename'])
-
-        ps2Filenames = []
-        for row in imageFilenames:
-            if '00002' in row['filter']:
-                ps2Filenames.append(row['filename'])
-
-
-        if ps1Filenames:
-            objectDictPS1 = getRBValues(ps1Filenames, options.ps1classifier, extension = 1, trainer = options.trainer)
-        if ps2Filenames:
-            objectDictPS2 = getRBValues(ps2Filenames, options.ps2classifier, extension = 1, trainer = options.trainer)
-
-        # Now we have two dictionaries. Combine them.
-
-        objectScores = defaultdict(dict)
-
-        if ps1Filenames:
-            for k, v in list(objectDictPS1.items()):
-                objectScores[k]['ps1'] = np.array(v)
-        if ps2Filenames:
-            for k, v in list(objectDictPS2.items()):
-                objectScores[k]['ps2'] = np.array(v)
-
-        finalScores = {}
-
-        objects = list(objectScores.keys())
-        for object in objects:
-            objectKeys = objectScores[object].keys()
-            lengths = {}
-            for key in objectKeys:
-                #print(object, key, objectScores[object][key]) 
-                lengths[key] = len(objectScores[object][key])
-            finalScores[object] = np.median(objectScores[object][max(lengths, key=lambda key: lengths[key])])
-
-
-    else:
-        # Split the images into HKO and MLO data so we can apply the HKO and MLO machines separately.
-        hkoFilenames = []
-        for row in imageFilenames:
-            if '02a' in row['filename']:
-                hkoFilenames.append(row['filename'])
-        mloFilenames = []
-        for row in imageFilenames:
-            if '01a' in row['filename']:
-                mloFilenames.append(row['filename'])
-        sthFilenames = []
-        for row in imageFilenames:
-            if '03a' in row['filename']:
-                sthFilenames.append(row['filename'])
-        chlFilenames = []
-        for row in imageFilenames:
-            if '04a' in row['filename']:
-                chlFilenames.append(row['filename'])
-
-        if hkoFilenames:
-            objectDictHKO = getRBValues(hkoFilenames, options.hkoclassifier, magicNumber = magicNumber, trainer = options.trainer)
-        if mloFilenames:
-            objectDictMLO = getRBValues(mloFilenames, options.mloclassifier, magicNumber = magicNumber, trainer = options.trainer)
-        if sthFilenames:
-            objectDictSTH = getRBValues(sthFilenames, options.sthclassifier, magicNumber = magicNumber, trainer = options.trainer)
-        if chlFilenames:
-            objectDictCHL = getRBValues(chlFilenames, options.chlclassifier, magicNumber = magicNumber, trainer = options.trainer)
-
-        # Now we have two dictionaries. Combine them.
-
-        objectScores = defaultdict(dict)
-
-        if hkoFilenames:
-            for k, v in list(objectDictHKO.items()):
-                objectScores[k]['hko'] = np.array(v)
-        if mloFilenames:
-            for k, v in list(objectDictMLO.items()):
-                objectScores[k]['mlo'] = np.array(v)
-        if sthFilenames:
-            for k, v in list(objectDictSTH.items()):
-                objectScores[k]['sth'] = np.array(v)
-        if chlFilenames:
-            for k, v in list(objectDictCHL.items()):
-                objectScores[k]['chl'] = np.array(v)
-
-        # Some objects will have data from two telescopes, some only one.
-        # If we have data from two telescopes, choose the median value of the longest length list.
-
-        finalScores = {}
-
-        objects = list(objectScores.keys())
-        for object in objects:
-            objectKeys = objectScores[object].keys()
-            lengths = {}
-            for key in objectKeys:
-                lengths[key] = len(objectScores[object][key])
-            finalScores[object] = np.median(objectScores[object][max(lengths, key=lambda key: lengths[key])])
-
+    finalScores = getObjectScores(imageFilenames, options, ps1Data = ps1Data, rbValues = rbValues)
+    metrics.count('objects', len(finalScores))
 
     finalScoresSorted = OrderedDict(sorted(list(finalScores.items()), key=lambda t: t[1]))
 
@@ -426,7 +727,7 @@ def runKerasTensorflowClassifier(opts, processNumber = None):
         # Generate the insert statements
         with open('%s%s%s' % (prefix, processSuffix, suffix), 'w') as f:
             for k, v in list(finalScoresSorted.items()):
-                print(k, finalScoresSorted[k])
+                logger.debug("%s %s", k, finalScoresSorted[k])
                 f.write('%s,%f\n' % (k, finalScoresSorted[k]))
 
     scores = list(finalScoresSorted.items())
@@ -434,8 +735,18 @@ def runKerasTensorflowClassifier(opts, processNumber = None):
     if options.update and processNumber is None:
         # Only allow database updates in single threaded mode. Otherwise multithreaded code
         # does the updates at the end of processing. (Minimises table locks.)
-        for row in scores:
-            updateTransientRBValue(conn, row[0], row[1], ps1Data = ps1Data)
+        with metrics.stage('dbUpdate', len(scores)):
+            rowsUpdated, rowsMissed = updateTransientRBValues(conn, scores, tableName = options.tablename, columnName = options.columnname, ps1Data = ps1Data, batchSize = int(options.updatebatchsize))
+        print("Updated %d rows. %d objects not found." % (rowsUpdated, rowsMissed))
+
+    run = '%s_%d' % (datetime.datetime.fromtimestamp(metrics.start).strftime("%Y%m%d_%H%M%S"), os.getpid())
+    metrics.report(run = run)
+    if options.metrics:
+        metrics.write(options.metrics, run = run)
+    if options.stampcache and not options.server:
+        openStampCache(options.stampcache).printStats()
+    if options.scorestore and not options.server:
+        openScoreStore(options.scorestore).printStats()
 
     conn.commit()
     conn.close()
@@ -449,6 +760,7 @@ def main():
 
     # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
     options = Struct(**opts)
+    logging.basicConfig(level = logging.DEBUG if options.debug else logging.INFO, format = '%(asctime)s %(levelname)s %(message)s')
     objectsForUpdate = runKerasTensorflowClassifier(options)
 
 if __name__=='__main__':
@@ -2,7 +2,7 @@
 """Run the Keras/Tensorflow classifier on Pan-STARRS and ATLAS images.
 
 Usage:
-  %s <configFile> [<candidate>...] [--hkoclassifier=<hkoclassifier>] [--mloclassifier=<mloclassifier>] [--sthclassifier=<sthclassifier>] [--chlclassifier=<chlclassifier>] [--ps1classifier=<ps1classifier>] [--ps2classifier=<ps2classifier>] [--outputcsv=<outputcsv>] [--listid=<listid>] [--imageroot=<imageroot>] [--update] [--tablename=<tablename>] [--columnname=<columnname>] [--loglocation=<loglocation>] [--logprefix=<logprefix>] [--candidatesinfiles] [--magicNumber=<magicNumber>] [--trainer=<trainer>]
+  %s <configFile> [<candidate>...] [--hkoclassifier=<hkoclassifier>] [--mloclassifier=<mloclassifier>] [--sthclassifier=<sthclassifier>] [--chlclassifier=<chlclassifier>] [--ps1classifier=<ps1classifier>] [--ps2classifier=<ps2classifier>] [--outputcsv=<outputcsv>] [--listid=<listid>] [--imageroot=<imageroot>] [--update] [--tablename=<tablename>] [--columnname=<columnname>] [--updatebatchsize=<updatebatchsize>] [--querychunksize=<querychunksize>] [--loglocation=<loglocation>] [--logprefix=<logprefix>] [--candidatesinfiles] [--magicNumber=<magicNumber>] [--trainer=<trainer>] [--backend=<backend>] [--batchsize=<batchsize>] [--queuedepth=<queuedepth>] [--readthreads=<readthreads>] [--stampcache=<stampcache>] [--stampcachesize=<stampcachesize>] [--memorybudget=<memorybudget>] [--scorestore=<scorestore>] [--readorder=<readorder>] [--manifest=<manifest>] [--aggregation=<aggregation>] [--sites=<sites>] [--workers=<workers>] [--chunksize=<chunksize>] [--intraopthreads=<intraopthreads>] [--interopthreads=<interopthreads>] [--journal=<journal>] [--resume] [--server=<server>] [--metrics=<metrics>] [--debug]
   %s (-h | --help)
   %s --version
 
@@ -18,14 +18,37 @@ Options:
   --ps2classifier=<ps2classifier>    PS2 Classifier file. This option will cause the ATLAS classifiers to be ignored.
   --outputcsv=<outputcsv>            Output file.
   --imageroot=<imageroot>            Root location of the actual images [default: /psdb3/images/].
-  --tablename=<tablename>            Database table name to update [default: atlas_diff_objects].
-  --columnname=<columnname>          Database column name to update [default: zooniverse_score].
+  --tablename=<tablename>            Database table name to update. Defaults to atlas_diff_objects (ATLAS) or tcs_transient_objects (Pan-STARRS).
+  --columnname=<columnname>          Database column name to update. Defaults to zooniverse_score (ATLAS) or confidence_factor (Pan-STARRS).
+  --updatebatchsize=<updatebatchsize>  Number of rows to update in each database transaction [default: 1000].
+  --querychunksize=<querychunksize>  Number of objects whose images are looked up in each database query [default: 1000].
   --loglocation=<loglocation>        Log file location [default: /tmp/]
   --logprefix=<logprefix>            Log prefix [default: ml_keras_]
   --update                           Update the database.
   --candidatesinfiles                Interpret the inline candidate IDs as a files containing candidates.
   --magicNumber=<magicNumber>        Magic number used to mask bad pixels in integer image files (ATLAS only).
   --trainer=<trainer>                Training file [default: PSAT-D].
+  --backend=<backend>                Inference backend: keras, or numpy for a lightweight NumPy-only forward pass (PSAT-D only) [default: keras].
+  --batchsize=<batchsize>            Number of images read and scored at a time [default: 1024].
+  --queuedepth=<queuedepth>          Number of batches read ahead of the one being scored [default: 4].
+  --readthreads=<readthreads>        Number of threads reading and normalising the stamps [default: 4].
+  --stampcache=<stampcache>          SQLite file in which to cache the normalised stamps, so they are only read and normalised once.
+  --stampcachesize=<stampcachesize>  Maximum size of the stamp cache in MB. The least recently used stamps are evicted [default: 1024].
+  --memorybudget=<memorybudget>      Memory in MB the whole run may use. No more workers are started than fit, and each worker's batch size is reduced to fit its share, backing off if memory runs short. Defaults to the memory available when it starts.
+  --scorestore=<scorestore>          SQLite file in which to keep every image's score, per classifier, so only images not scored before by the same classifier are read and predicted.
+  --readorder=<readorder>            Order in which the stamps are read: db (as the database returns them) or locality (directory by directory, i.e. MJD by MJD, with the next batch's files read ahead) [default: locality].
+  --manifest=<manifest>              JSON file in which to keep the image directory listings between runs.
+  --aggregation=<aggregation>        How to combine the image scores into an object score (median | mean | max | weighted) [default: median].
+  --sites=<sites>                    YAML file describing the sites (telescopes) and how to match their images. Defaults to sites.yaml alongside this script.
+  --workers=<workers>                Number of worker processes [default: 28].
+  --chunksize=<chunksize>            Most objects handed to a worker at a time. The chunks are made of roughly equal estimated cost (images, weighted by site), so objects with many images go in smaller chunks [default: 100].
+  --intraopthreads=<intraopthreads>  Number of threads each worker's TensorFlow may use within an operation [default: 1].
+  --interopthreads=<interopthreads>  Number of TensorFlow operations each worker may run in parallel [default: 1].
+  --journal=<journal>                SQLite file in which to record each scored chunk as it completes. Any previous run's journal in it is cleared, unless resuming.
+  --resume                           Carry on from an interrupted run: skip the objects already in the journal and apply their outstanding updates. Refused if the journal is from a run with a different configuration file, list, candidates or classifiers.
+  --metrics=<metrics>                File to which to append the per-stage timings and throughput of the run (JSON lines, or CSV if it ends in .csv).
+  --debug                            Log debug messages, including a sample of the predictions.
+  --server=<server>                  Send the images to a running scoring server listening on this UNIX socket instead of loading the classifiers.
 
 Example:
   python %s ~/config.pso3.gw.warp.yaml --ps1classifier=/data/db4data1/scratch/kws/training/ps1/20190115/ps1_20190115_400000_1200000.best.hdf5 --listid=4 --outputcsv=/tmp/pso3_list_4.csv
@@ -38,36 +61,148 @@ Example:
 import sys
 __doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
 from docopt import docopt
-from gkutils.commonutils import Struct, cleanOptions, readGenericDataFile, dbConnect, splitList, parallelProcess
-import sys, csv, os, datetime
-from runKerasTensorflowClassifierOnPSATImages import getObjectsByList, runKerasTensorflowClassifier, updateTransientRBValue
-# 2024-08-25 KWS Need importlib to import a library specified by a variable (trainer).
-import importlib
-
-
-def worker(num, db, objectListFragment, dateAndTime, firstPass, miscParameters, q):
-    """thread worker function"""
+from gkutils.commonutils import Struct, cleanOptions, readGenericDataFile, dbConnect
+import sys, csv, os, time, datetime, logging
+import multiprocessing, multiprocessing.util
+from runKerasTensorflowClassifierOnPSATImages import getObjectsByList, getImagesByObject, getImageRBValues, getObjectScores, updateTransientRBValues
+from modelRegistry import getModel, configureThreads
+from siteRegistry import configureSites, imageCost
+from scoringJournal import ScoringJournal
+from stampCache import openStampCache
+from imageScoreStore import openScoreStore
+from directoryIndex import DirectoryIndex
+from scoringMetrics import ScoringMetrics, setMetrics
+from memoryGovernor import chooseWorkerCount
+
+logger = logging.getLogger(__name__)
+
+# Per-process state of each pool worker, set up once by initialiseWorker.
+workerState = {}
+
+# Aim for this many chunks per worker, so the last few chunks are small enough to even out the finish.
+CHUNKS_PER_WORKER = 8
+
+
+def costBalancedChunks(objects, costs, workers, maxObjects = 100):
+    """Split the objects into chunks of roughly equal estimated cost, each of at most maxObjects.
+       The most expensive objects come first, so the chunks handed out last are the cheapest
+       and the workers finish together.
+
+       returns: (chunks, chunkCosts)
+    """
+    target = sum(costs) / float(max(1, workers) * CHUNKS_PER_WORKER)
+    chunks = []
+    chunkCosts = []
+    chunk = []
+    chunkCost = 0.0
+    for i in sorted(range(len(objects)), key = lambda i: costs[i], reverse = True):
+        chunk.append(objects[i])
+        chunkCost += costs[i]
+        if chunkCost >= target or len(chunk) >= maxObjects:
+            chunks.append(chunk)
+            chunkCosts.append(chunkCost)
+            chunk = []
+            chunkCost = 0.0
+    if chunk:
+        chunks.append(chunk)
+        chunkCosts.append(chunkCost)
+    return chunks, chunkCosts
+
+
+def printWorkerBalance(workerTimes, poolSeconds):
+    """Report how busy each worker was, so we can see whether the work was evenly shared."""
+    if not workerTimes:
+        return
+    busy = []
+    for pid, times in sorted(workerTimes.items()):
+        idle = max(0.0, poolSeconds - times['busy'])
+        busy.append(times['busy'])
+        print("Worker %d: %d chunks, %d objects, %d images, busy %.1fs, idle %.1fs (%.0f%% busy)" % (pid, times['chunks'], times['objects'], times['images'], times['busy'], idle, 100.0 * times['busy'] / poolSeconds if poolSeconds else 0.0))
+    mean = sum(busy) / len(busy)
+    print("Workers busy for %.1fs to %.1fs of %.1fs. Busiest/mean = %.2f" % (min(busy), max(busy), poolSeconds, max(busy) / mean if mean else 0.0))
+
+
+def initialiseWorker(options, ps1Data, dateAndTime):
+    """Pool initializer. Runs once in each worker process: redirects the output to
+       a log file, limits the TensorFlow threads and loads the site classifiers so
+       every chunk finds them warm. The workers don't use the database. The parent
+       looks up the images and applies the updates.
+    """
     # Redefine the output to be a log file.
-    options = miscParameters[0]
-    sys.stdout = open('%s%s_%s_%d.log' % (options.loglocation, options.logprefix, dateAndTime, num), "w")
-
-    # Override the full candidate list with a sublist of candidates.
-    options.candidate = [str(x['id']) for x in objectListFragment]
-    # If we've read the candidates from a file, don't try to open the file again!
-    options.candidatesinfiles = None
-
-    objectsForUpdate = runKerasTensorflowClassifier(options, processNumber = num)
-
-    # Write the objects for update onto a Queue object
-    print ("Adding %d objects onto the queue." % len(objectsForUpdate))
-
-    q.put(objectsForUpdate)
-
-    print ("Process complete.")
-    print ("DB Connection Closed - exiting")
-
-    return 0
-
+    sys.stdout = open('%s%s_%s_%d.log' % (options.loglocation, options.logprefix, dateAndTime, os.getpid()), "w")
+    # Log to the worker's own file, not to any handler inherited from the parent.
+    # (basicConfig's force argument needs Python 3.8.)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    logging.basicConfig(stream = sys.stdout, level = logging.DEBUG if options.debug else logging.INFO, format = '%(asctime)s %(levelname)s %(message)s')
+
+    if not options.server:
+        if options.backend == 'keras':
+            configureThreads(options.intraopthreads, options.interopthreads)
+        for site in configureSites(options, 'ps1' if ps1Data else 'atlas', sitesFile = options.sites):
+            if site['classifier']:
+                getModel(site['classifier'], trainer = options.trainer, backend = options.backend)
+
+    # Each worker reports its own metrics, and appends them to the metrics file, when it exits.
+    metrics = ScoringMetrics()
+    multiprocessing.util.Finalize(metrics, finishWorkerMetrics, args = (metrics, options, dateAndTime), exitpriority = 10)
+
+    workerState['metrics'] = metrics
+    workerState['options'] = options
+    workerState['ps1Data'] = ps1Data
+
+
+def finishWorkerMetrics(metrics, options, dateAndTime):
+    metrics.report(run = dateAndTime, worker = os.getpid())
+    if options.metrics:
+        metrics.write(options.metrics, run = dateAndTime, worker = os.getpid())
+    sys.stdout.flush()
+
+
+def scoreChunk(objectListFragment):
+    """Score one chunk of objects, each with its image rows, in a pool worker.
+       Returns a list of (objectId, score), a snapshot of the chunk's metrics, for
+       the parent to add to the run's, and the worker's pid with the start and end
+       time of the chunk.
+    """
+    start = time.time()
+    options = workerState['options']
+    metrics = ScoringMetrics()
+    setMetrics(metrics)
+
+    # The parent found the images and checked their files exist.
+    imageFilenames = [row for o in objectListFragment for row in o['images']]
+
+    rbValues = getImageRBValues
+    if options.server:
+        # Let a resident scoring server (with its classifiers already loaded) do the scoring.
+        from scoringServer import ScoringClient
+        rbValues = ScoringClient(options.server).getImageRBValues
+
+    objectsForUpdate = list(getObjectScores(imageFilenames, options, ps1Data = workerState['ps1Data'], rbValues = rbValues).items())
+    metrics.count('images', len(imageFilenames))
+    metrics.count('objects', len(objectsForUpdate))
+    workerState['metrics'].merge(metrics)
+
+    print ("Scored %d objects from %d images." % (len(objectsForUpdate), len(imageFilenames)))
+    if options.stampcache and not options.server:
+        openStampCache(options.stampcache).printStats()
+    if options.scorestore and not options.server:
+        openScoreStore(options.scorestore).printStats()
+    sys.stdout.flush()
+
+    return objectsForUpdate, metrics.snapshot(), (os.getpid(), start, time.time())
+
+
+def journalRunKey(options):
+    """Identify the run a journal belongs to: the configuration file, the list or candidates, and the classifiers."""
+    if len(options.candidate) > 0:
+        objects = 'candidates=%s' % ','.join(options.candidate)
+    else:
+        objects = 'listid=%s' % options.listid
+    classifiers = ['%s=%s' % (name, os.path.realpath(getattr(options, name))) for name in ('hkoclassifier', 'mloclassifier', 'sthclassifier', 'chlclassifier', 'ps1classifier', 'ps2classifier') if getattr(options, name)]
+    return ';'.join([os.path.realpath(options.configFile), objects] + classifiers)
 
 
 def runKerasTensorflowClassifierMultiprocess(opts):
@@ -82,13 +217,13 @@ def runKerasTensorflowClassifierMultiprocess(opts):
     with open(options.configFile) as yaml_file:
         config = yaml.load(yaml_file)
 
+    metrics = ScoringMetrics()
+
     username = config['databases']['local']['username']
     password = config['databases']['local']['password']
     database = config['databases']['local']['database']
     hostname = config['databases']['local']['hostname']
 
-    db = []
-
     conn = dbConnect(hostname, username, password, database)
     if not conn:
         print("Cannot connect to the database")
@@ -109,7 +244,7 @@ def runKerasTensorflowClassifierMultiprocess(opts):
 
     # 2018-07-31 KWS We have PS1 data. Don't bother with the HKO/MLO ATLAS data.
     ps1Data = False
-    if options.ps1classifier:
+    if options.ps1classifier or options.ps2classifier:
         ps1Data = True
 
     objectList = []
@@ -126,53 +261,140 @@ def runKerasTensorflowClassifierMultiprocess(opts):
         else:
             objectList = [{'id': int(candidate)} for candidate in options.candidate]
     else:
-        objectList = getObjectsByList(conn, database, listId = int(options.listid), ps1Data = ps1Data)
-
-
-    # 2019-06-07 KWS For reasons not entirely clear, Tensorflow seems to exhaust every last
-    #                bit of CPU and memory.  So let's divide the list by 10 if the list is
-    #                larger than 10000 in size.
-
-    if len(objectList) > 100:
-        bin, subLists = splitList(objectList, bins=16)
-    else:
-        subLists = [objectList]
-
-    for l in subLists:
-        currentDate = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
-        (year, month, day, hour, min, sec) = currentDate.split(':')
-        dateAndTime = "%s%s%s_%s%s%s" % (year, month, day, hour, min, sec)
-
-        objectsForUpdate = []
-
-        if len(objectList) > 0:
-            # 2019-08-24 KWS Hard-wire the number of workers.
-            nProcessors, listChunks = splitList(l, bins=28)
-
-            print ("%s Parallel Processing..." % (datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
-            objectsForUpdate = parallelProcess(db, dateAndTime, nProcessors, listChunks, worker, miscParameters = [options])
-            print ("%s Done Parallel Processing" % (datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
-
-            print ("TOTAL OBJECTS TO UPDATE = %d" % len(objectsForUpdate))
-
-    #    if len(objectsForUpdate) > 0 and options.update:
-    #        updateObjects(conn, objectsForUpdate)
-
-        # Sort the combined list.
-        objectsForUpdate = sorted(objectsForUpdate, key = lambda x: x[1])
+        with metrics.stage('objectQuery'):
+            objectList = getObjectsByList(conn, database, listId = int(options.listid), ps1Data = ps1Data)
+        metrics.add('objectQuery', 0.0, len(objectList))
+
+
+    journal = None
+    if options.journal:
+        journal = ScoringJournal(options.journal)
+        runKey = journalRunKey(options)
+        if not options.resume:
+            journal.start(runKey)
+        elif journal.runKey() != runKey:
+            sys.exit("Cannot resume: the journal %s is from a different run (%s)" % (options.journal, journal.runKey()))
+    elif options.resume:
+        sys.exit("Cannot resume without a journal")
+
+    if options.resume:
+        scoredObjects = journal.scoredObjects()
+        print("Resuming. %d objects already scored in %d chunks." % (len(scoredObjects), journal.chunkCount()))
+        objectList = [o for o in objectList if str(o['id']) not in scoredObjects]
+
+    # Rather than forking fresh processes (each reconnecting and loading the models again)
+    # for every fragment of the list, a fixed pool of workers loads the models once and
+    # pulls small chunks of objects as each worker becomes free. TensorFlow's own threads
+    # are limited per worker so the pool doesn't exhaust every last bit of CPU and memory.
+
+    dateAndTime = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    # Objects have anything from one image to hundreds, so get every object's images up
+    # front and share the work out by estimated cost. Each image directory is listed once,
+    # here, rather than by every worker that is given one of its images.
+    sites = configureSites(options, 'ps1' if ps1Data else 'atlas', sitesFile = options.sites)
+    directoryIndex = DirectoryIndex(options.manifest)
+    imagesByObject = getImagesByObject(conn, database, objectList, imageRoot = options.imageroot, chunkSize = int(options.querychunksize), metrics = metrics, directoryIndex = directoryIndex)
+    directoryIndex.save()
+    objects = []
+    costs = []
+    for objectId, imageRows in imagesByObject.items():
+        cost = imageCost(imageRows, sites)
+        if cost > 0:
+            objects.append({'id': objectId, 'images': imageRows})
+            costs.append(cost)
+    if len(objects) < len(objectList):
+        print("%d of %d objects have no images to score." % (len(objectList) - len(objects), len(objectList)))
+
+    nProcessors = max(1, min(int(options.workers), len(objects)))
+
+    workerOptions = options
+    if not options.server:
+        # Start no more workers than fit in memory, and give each its share of it.
+        nProcessors, workerBudget = chooseWorkerCount(nProcessors, backend = options.backend, batchSize = int(options.batchsize), queueDepth = int(options.queuedepth), budget = int(options.memorybudget) * 1024 * 1024 if options.memorybudget else None)
+        if workerBudget is not None:
+            workerOptions = Struct(**vars(options))
+            workerOptions.memorybudget = workerBudget // (1024 * 1024)
+
+    listChunks, chunkCosts = costBalancedChunks(objects, costs, nProcessors, maxObjects = int(options.chunksize))
+    workerTimes = {}
+
+    objectsForUpdate = []
+    pendingUpdates = []
+    rowsUpdated = 0
+    rowsMissed = 0
+
+    def applyUpdates(updates):
+        with metrics.stage('dbUpdate', len(updates)):
+            updated, missed = updateTransientRBValues(conn, updates, tableName = options.tablename, columnName = options.columnname, ps1Data = ps1Data, batchSize = int(options.updatebatchsize))
+        if journal is not None:
+            journal.markApplied([objectId for objectId, score in updates])
+        return updated, missed
+
+    if options.resume:
+        # Everything journalled by the previous run goes into the output, but only unapplied scores go to the database.
+        objectsForUpdate += journal.scores()
+        pendingUpdates += journal.pendingUpdates()
+
+    if len(listChunks) > 0:
+        print ("%s Parallel Processing %d chunks (%d objects, %d images, cost %.0f) with %d workers..." % (datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S"), len(listChunks), len(objects), sum(len(o['images']) for o in objects), sum(chunkCosts), nProcessors))
+        poolStart = time.time()
+        pool = multiprocessing.Pool(processes = nProcessors, initializer = initialiseWorker, initargs = (workerOptions, ps1Data, dateAndTime))
+        try:
+            # Workers take the next chunk as soon as they finish one, so slow chunks don't hold up the rest.
+            # imap_unordered hands out one chunk at a time, in order, most expensive first.
+            for scores, chunkMetrics, (pid, chunkStart, chunkEnd) in pool.imap_unordered(scoreChunk, listChunks):
+                metrics.merge(chunkMetrics)
+                times = workerTimes.setdefault(pid, {'chunks': 0, 'objects': 0, 'images': 0, 'busy': 0.0})
+                times['chunks'] += 1
+                times['objects'] += len(scores)
+                times['images'] += chunkMetrics['counts'].get('images', 0)
+                times['busy'] += chunkEnd - chunkStart
+                if journal is not None:
+                    journal.recordChunk(scores)
+                objectsForUpdate += scores
+                pendingUpdates += scores
+
+                # Write the results as they arrive, in short transactions, to minimise table locks.
+                if options.update and len(pendingUpdates) >= int(options.updatebatchsize):
+                    updated, missed = applyUpdates(pendingUpdates)
+                    rowsUpdated += updated
+                    rowsMissed += missed
+                    pendingUpdates = []
+        finally:
+            pool.close()
+            pool.join()
+        print ("%s Done Parallel Processing" % (datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
+        printWorkerBalance(workerTimes, time.time() - poolStart)
+
+    print ("TOTAL OBJECTS TO UPDATE = %d" % len(objectsForUpdate))
+
+    # Sort the combined list.
+    objectsForUpdate = sorted(objectsForUpdate, key = lambda x: x[1])
+
+    if options.outputcsv is not None:
+        with open(options.outputcsv, 'w') as f:
+            for row in objectsForUpdate:
+                logger.debug("%s %s", row[0], row[1])
+                f.write('%s,%f\n' % (row[0], row[1]))
 
-        if options.outputcsv is not None:
-            with open(options.outputcsv, 'w') as f:
-                for row in objectsForUpdate:
-                    print(row[0], row[1])
-                    f.write('%s,%f\n' % (row[0], row[1]))
+    if options.update:
+        if pendingUpdates:
+            updated, missed = applyUpdates(pendingUpdates)
+            rowsUpdated += updated
+            rowsMissed += missed
+        print("Updated %d rows. %d objects not found." % (rowsUpdated, rowsMissed))
 
-        if options.update:
-            for row in objectsForUpdate:
-                updateTransientRBValue(conn, row[0], row[1], ps1Data = ps1Data)
+    if journal is not None:
+        journal.close()
 
     conn.close()
 
+    # The whole run: the workers' stage times are summed, so can exceed the wall time.
+    metrics.report(run = dateAndTime)
+    if options.metrics:
+        metrics.write(options.metrics, run = dateAndTime)
+
 
 
 def main():
@@ -181,6 +403,7 @@ def main():
 
     # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
     options = Struct(**opts)
+    logging.basicConfig(level = logging.DEBUG if options.debug else logging.INFO, format = '%(asctime)s %(levelname)s %(message)s')
     runKerasTensorflowClassifierMultiprocess(options)
 
 
@@ -0,0 +1,90 @@
+"""Combine per-image real/bogus scores into one score per object.
+
+Every image has an object ID, a site code (the index of the telescope or
+camera it came from) and a score. Rather than building dictionaries of lists
+per object and per site, the scores are sorted once by (object, site, score)
+and the per-object, per-site counts, means, medians and maxima are read
+straight off the sorted arrays.
+
+The available rules for choosing the final object score are:
+
+  median    the median score of the site with the most images (ties go to the
+            site with the lowest code). This is the rule we have always used.
+  mean      the mean score of all the object's images, whatever the site.
+  max       the highest score of any of the object's images.
+  weighted  the mean of the object's per-site median scores, weighted by the
+            number of images from each site.
+"""
+import numpy as np
+
+AGGREGATION_RULES = ['median', 'mean', 'max', 'weighted']
+
+
+def objectIdFromFilename(imageFilename):
+    """The object ID is the first part of the image filename, e.g. 1234567890123456789_02a59000o0123c.fits."""
+    return imageFilename.split('/')[-1].split('_')[0]
+
+
+def groupSiteScores(objectIds, siteCodes, scores):
+    """Group the per-image scores by object and site.
+
+       returns: (objects, groupObjects, groupSites, groupCounts, groupMeans, groupMedians, groupMaxima)
+       where objects holds the unique object IDs, groupObjects indexes into
+       objects and there is one entry per (object, site) group.
+    """
+    objects, objectCodes = np.unique(np.asarray(objectIds), return_inverse = True)
+    siteCodes = np.asarray(siteCodes)
+    scores = np.asarray(scores, dtype = np.float64)
+
+    # Sort by object, then site, then score (lexsort uses the last key first).
+    order = np.lexsort((scores, siteCodes, objectCodes))
+    objectCodes = objectCodes[order]
+    siteCodes = siteCodes[order]
+    scores = scores[order]
+
+    # The start of each (object, site) group is wherever either code changes.
+    change = np.ones(len(scores), dtype = bool)
+    change[1:] = (objectCodes[1:] != objectCodes[:-1]) | (siteCodes[1:] != siteCodes[:-1])
+    starts = np.flatnonzero(change)
+    counts = np.diff(np.append(starts, len(scores)))
+
+    # Scores are sorted within each group, so the median and maximum can be indexed directly.
+    medians = (scores[starts + (counts - 1) // 2] + scores[starts + counts // 2]) / 2.0
+    maxima = scores[starts + counts - 1]
+    means = np.add.reduceat(scores, starts) / counts
+
+    return objects, objectCodes[starts], siteCodes[starts], counts, means, medians, maxima
+
+
+def aggregateScores(objectIds, siteCodes, scores, rule = 'median'):
+    """Combine the per-image scores into one score per object using the specified rule.
+
+       returns: (objects, objectScores) as two arrays of the same length.
+    """
+    if rule not in AGGREGATION_RULES:
+        raise ValueError("Aggregation rule must be one of %s" % ', '.join(AGGREGATION_RULES))
+
+    if len(scores) == 0:
+        return np.array([]), np.array([])
+
+    objects, groupObjects, groupSites, counts, means, medians, maxima = groupSiteScores(objectIds, siteCodes, scores)
+    numObjects = len(objects)
+
+    if rule == 'median':
+        # For each object pick the group with the most images, lowest site code first on ties.
+        order = np.lexsort((groupSites, -counts, groupObjects))
+        first = np.ones(len(order), dtype = bool)
+        first[1:] = groupObjects[order][1:] != groupObjects[order][:-1]
+        objectScores = medians[order][first]
+
+    elif rule == 'mean':
+        objectScores = np.bincount(groupObjects, weights = means * counts, minlength = numObjects) / np.bincount(groupObjects, weights = counts, minlength = numObjects)
+
+    elif rule == 'max':
+        objectScores = np.full(numObjects, -np.inf)
+        np.maximum.at(objectScores, groupObjects, maxima)
+
+    else:
+        objectScores = np.bincount(groupObjects, weights = medians * counts, minlength = numObjects) / np.bincount(groupObjects, weights = counts, minlength = numObjects)
+
+    return objects, objectScores
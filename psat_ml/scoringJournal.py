@@ -0,0 +1,78 @@
+"""Progress journal for long scoring runs.
+
+Each chunk of objects scored by a worker is written to a small SQLite file as
+soon as it completes, together with the per-object scores and whether they
+have been written to the database yet. If the run dies halfway, it can be
+restarted with --resume: the objects already in the journal are not scored
+again and only the outstanding updates are applied.
+
+The journal belongs to one run. A run without --resume starts it afresh, and
+the run's key (its configuration file, list or candidates and classifiers) is
+kept with it so that a different run can't resume from it.
+"""
+import sqlite3
+import datetime
+
+
+class ScoringJournal(object):
+
+    def __init__(self, journalFile):
+        self.journalFile = journalFile
+        self.conn = sqlite3.connect(journalFile)
+        with self.conn:
+            self.conn.execute('''create table if not exists chunks (
+                                     chunk integer primary key autoincrement,
+                                     objects integer not null,
+                                     completed text not null)''')
+            self.conn.execute('''create table if not exists scores (
+                                     id text primary key,
+                                     score real not null,
+                                     chunk integer not null,
+                                     applied integer not null default 0)''')
+            self.conn.execute('''create table if not exists run (
+                                     key text not null,
+                                     started text not null)''')
+
+    def start(self, runKey):
+        """Empty the journal for a new run, identified by runKey."""
+        with self.conn:
+            self.conn.execute('delete from scores')
+            self.conn.execute('delete from chunks')
+            self.conn.execute('delete from run')
+            self.conn.execute('insert into run (key, started) values (?, ?)', (runKey, datetime.datetime.now().isoformat()))
+
+    def runKey(self):
+        """Return the key of the run the journal belongs to, or None if it has none."""
+        row = self.conn.execute('select key from run').fetchone()
+        return row[0] if row else None
+
+    def recordChunk(self, scores):
+        """Record a completed chunk of (objectId, score) pairs in a single transaction."""
+        with self.conn:
+            cursor = self.conn.execute('insert into chunks (objects, completed) values (?, ?)', (len(scores), datetime.datetime.now().isoformat()))
+            chunk = cursor.lastrowid
+            self.conn.executemany('insert or replace into scores (id, score, chunk, applied) values (?, ?, ?, 0)', [(str(objectId), float(score), chunk) for objectId, score in scores])
+        return chunk
+
+    def markApplied(self, objectIds):
+        """Note that the scores of these objects have been written to the database."""
+        with self.conn:
+            self.conn.executemany('update scores set applied = 1 where id = ?', [(str(objectId),) for objectId in objectIds])
+
+    def scoredObjects(self):
+        """Return the set of object IDs (as strings) that already have a score."""
+        return set(row[0] for row in self.conn.execute('select id from scores'))
+
+    def pendingUpdates(self):
+        """Return the (objectId, score) pairs not yet written to the database."""
+        return self.conn.execute('select id, score from scores where applied = 0').fetchall()
+
+    def scores(self):
+        """Return all the journalled (objectId, score) pairs."""
+        return self.conn.execute('select id, score from scores').fetchall()
+
+    def chunkCount(self):
+        return self.conn.execute('select count(*) from chunks').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
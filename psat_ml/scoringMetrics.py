@@ -0,0 +1,133 @@
+"""Per-stage timing and throughput of scoring runs.
+
+Each process has a current ScoringMetrics (getMetrics) into which the scoring
+code adds the time spent, and the number of items handled, in each stage:
+
+  objectQuery    getting the objects to score from the database
+  imageQuery     getting their postage stamp images from the database
+  fileStat       checking the image files exist
+  fitsDecode     opening and decompressing the FITS files
+  normalisation  normalising the stamps
+  predict        running the classifier
+  dbUpdate       writing the scores back to the database
+
+At the end of a run (and, for the multiprocess runner, of each worker) a
+record of these, plus images/s and objects/s over the wall time, is printed
+and can be appended to a metrics file, as JSON lines or, if the file name ends
+in .csv, as CSV.
+"""
+import os
+import json
+import time
+import socket
+import datetime
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+STAGES = ['objectQuery', 'imageQuery', 'fileStat', 'fitsDecode', 'normalisation', 'predict', 'dbUpdate']
+COUNTS = ['objects', 'images', 'storedScores']
+
+_current = {}
+
+
+def getMetrics():
+    """Return the current process's metrics, creating them the first time."""
+    metrics = _current.get(os.getpid())
+    if metrics is None:
+        metrics = ScoringMetrics()
+        _current[os.getpid()] = metrics
+    return metrics
+
+
+def setMetrics(metrics):
+    """Make metrics the current process's metrics. Returns the previous ones."""
+    previous = _current.get(os.getpid())
+    _current[os.getpid()] = metrics
+    return previous
+
+
+class ScoringMetrics(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        # The stamp reader threads all add to the same metrics.
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, count = 0):
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.counts[stage] += count
+
+    def count(self, name, count):
+        with self.lock:
+            self.counts[name] += count
+
+    @contextmanager
+    def stage(self, stage, count = 0):
+        """Time a block of code, e.g. with metrics.stage('predict', len(images)): ..."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, count)
+
+    def snapshot(self):
+        """A plain (picklable) copy of the seconds and counts, e.g. to send to another process."""
+        with self.lock:
+            return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+    def merge(self, other):
+        """Add in the seconds and counts of other metrics or of a snapshot."""
+        if isinstance(other, ScoringMetrics):
+            other = other.snapshot()
+        with self.lock:
+            for k, v in other['seconds'].items():
+                self.seconds[k] += v
+            for k, v in other['counts'].items():
+                self.counts[k] += v
+
+    def record(self, run = None, worker = None):
+        """Return the metrics as a flat dict, one field per stage time and count."""
+        wallSeconds = time.time() - self.start
+        record = {'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                  'host': socket.gethostname(),
+                  'run': run,
+                  'worker': worker,
+                  'wallSeconds': wallSeconds}
+        with self.lock:
+            for stage in STAGES:
+                record[stage + 'Seconds'] = self.seconds.get(stage, 0.0)
+                record[stage + 'Count'] = self.counts.get(stage, 0)
+            for name in COUNTS:
+                record[name] = self.counts.get(name, 0)
+        record['imagesPerSecond'] = record['images'] / wallSeconds if wallSeconds else 0.0
+        record['objectsPerSecond'] = record['objects'] / wallSeconds if wallSeconds else 0.0
+        return record
+
+    def report(self, run = None, worker = None):
+        """Print where the time went, so we can see how much is database latency versus compute."""
+        record = self.record(run = run, worker = worker)
+        total = sum(record[stage + 'Seconds'] for stage in STAGES)
+        for stage in STAGES:
+            seconds = record[stage + 'Seconds']
+            print("TIMING %-15s %10.3f s (%5.1f%%) %10d" % (stage, seconds, 100.0 * seconds / total if total else 0.0, record[stage + 'Count']))
+        print("TIMING %-15s %10.3f s %d images (%.1f/s), %d objects (%.1f/s)" % ('wall', record['wallSeconds'], record['images'], record['imagesPerSecond'], record['objects'], record['objectsPerSecond']))
+        return record
+
+    def write(self, metricsFile, run = None, worker = None):
+        """Append a record to the metrics file: CSV if it ends in .csv, otherwise JSON lines."""
+        record = self.record(run = run, worker = worker)
+        if metricsFile.endswith('.csv'):
+            fields = ['date', 'host', 'run', 'worker', 'wallSeconds'] + [stage + suffix for stage in STAGES for suffix in ('Seconds', 'Count')] + COUNTS + ['imagesPerSecond', 'objectsPerSecond']
+            writeHeader = not os.path.exists(metricsFile)
+            with open(metricsFile, 'a') as f:
+                if writeHeader:
+                    f.write(','.join(fields) + '\n')
+                f.write(','.join('' if record[k] is None else str(record[k]) for k in fields) + '\n')
+        else:
+            with open(metricsFile, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Resident scoring server. Loads the classifiers once and keeps them warm, scoring
+batches of images sent to it over a local UNIX socket.
+
+Usage:
+  %s <configFile> [--hkoclassifier=<hkoclassifier>] [--mloclassifier=<mloclassifier>] [--sthclassifier=<sthclassifier>] [--chlclassifier=<chlclassifier>] [--ps1classifier=<ps1classifier>] [--ps2classifier=<ps2classifier>] [--imageroot=<imageroot>] [--magicNumber=<magicNumber>] [--trainer=<trainer>] [--backend=<backend>] [--batchsize=<batchsize>] [--queuedepth=<queuedepth>] [--readthreads=<readthreads>] [--stampcache=<stampcache>] [--stampcachesize=<stampcachesize>] [--memorybudget=<memorybudget>] [--scorestore=<scorestore>] [--readorder=<readorder>] [--aggregation=<aggregation>] [--sites=<sites>] [--socket=<socket>]
+  %s (-h | --help)
+  %s --version
+
+Options:
+  -h --help                          Show this screen.
+  --version                          Show version.
+  --hkoclassifier=<hkoclassifier>    HKO Classifier file.
+  --mloclassifier=<mloclassifier>    MLO Classifier file.
+  --sthclassifier=<sthclassifier>    STH Classifier file.
+  --chlclassifier=<chlclassifier>    CHL Classifier file.
+  --ps1classifier=<ps1classifier>    PS1 Classifier file. Candidates will be treated as Pan-STARRS objects.
+  --ps2classifier=<ps2classifier>    PS2 Classifier file. Candidates will be treated as Pan-STARRS objects.
+  --imageroot=<imageroot>            Root location of the actual images [default: /db4/images/].
+  --magicNumber=<magicNumber>        Magic number used to mask bad pixels in integer image files (ATLAS only).
+  --trainer=<trainer>                Training file [default: PSAT-D].
+  --backend=<backend>                Inference backend: keras, or numpy for a lightweight NumPy-only forward pass (PSAT-D only) [default: keras].
+  --batchsize=<batchsize>            Number of images read and scored at a time [default: 1024].
+  --queuedepth=<queuedepth>          Number of batches read ahead of the one being scored [default: 4].
+  --readthreads=<readthreads>        Number of threads reading and normalising the stamps [default: 4].
+  --stampcache=<stampcache>          SQLite file in which to cache the normalised stamps, so they are only read and normalised once.
+  --stampcachesize=<stampcachesize>  Maximum size of the stamp cache in MB. The least recently used stamps are evicted [default: 1024].
+  --memorybudget=<memorybudget>      Memory in MB the scoring may use. The batch size is reduced to fit, and backs off if memory runs short. Defaults to the memory available when it starts.
+  --scorestore=<scorestore>          SQLite file in which to keep every image's score, per classifier, so only images not scored before by the same classifier are read and predicted.
+  --readorder=<readorder>            Order in which the stamps are read: db (as the database returns them) or locality (directory by directory, i.e. MJD by MJD, with the next batch's files read ahead) [default: locality].
+  --aggregation=<aggregation>        How to combine the image scores into an object score (median | mean | max | weighted) [default: median].
+  --sites=<sites>                    YAML file describing the sites (telescopes) and how to match their images. Defaults to sites.yaml alongside this script.
+  --socket=<socket>                  UNIX socket on which to listen [default: /tmp/psat_ml_scoring.sock].
+
+Each request and each response is a single line of JSON. A request is either a
+batch of FITS files, scored with the specified classifier:
+
+  {"filenames": ["/db4/images/...fits", ...], "classifier": "/path/to/classifier.h5", "extension": 0, "magicNumber": -31415, "trainer": "PSAT-D", "backend": "keras"}
+
+or a batch of candidate IDs, whose images are looked up in the database and
+scored with the site classifiers loaded at start-up:
+
+  {"candidates": [1234567890, ...]}
+
+The server only scores with the classifiers it was started with, and only with
+its own --trainer and --backend. Any other classifier, trainer or backend is
+refused. The stamps are read as the server's own options say (batch size,
+threads, stamp cache, score store and so on), whoever the client is.
+
+The response contains the per-image and per-object scores, or an error message:
+
+  {"images": {"<filename>": 0.123, ...}, "objects": {"<id>": 0.123, ...}}
+  {"error": "..."}
+
+Existing scripts can use the server via their --server=<socket> option.
+
+Example:
+  python %s /usr/local/ps1code/gitrelease/atlas/config/config4_db1_readonly.yaml --hkoclassifier=/usr/local/ps1code/gitrelease/tf_trained_classifiers/02a_asteroids_good330000_bad990000_s3_20230405_20x20_nomagic_classifier.h5 --mloclassifier=/usr/local/ps1code/gitrelease/tf_trained_classifiers/01a_asteroids_20x20_good15000_bad45000_s3_20191125_nomagic_classifier.h5 --sthclassifier=/usr/local/ps1code/gitrelease/tf_trained_classifiers/03a_asteroids_good320000_bad960000_s3_20230303_20x20_nomagic_classifier.h5 --chlclassifier=/usr/local/ps1code/gitrelease/tf_trained_classifiers/04a_asteroids_good380000_bad1140000_s3_20230213_20x20_nomagic_classifier.h5 --magicNumber=-31415 --socket=/tmp/atlas_scoring.sock
+
+"""
+import sys
+__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+from docopt import docopt
+from gkutils.commonutils import Struct, cleanOptions, dbConnect
+import os, json, socket, socketserver, signal, threading
+import numpy as np
+from runKerasTensorflowClassifierOnPSATImages import getImages, getImageRBValues, groupRBValuesByObject, getObjectScores
+from modelRegistry import getModel
+from siteRegistry import configureSites
+from scoreAggregation import aggregateScores, objectIdFromFilename
+
+
+class ScoringClient(object):
+    """Talk to a running scoring server. The getRBValues method can be used in place of the local one."""
+
+    def __init__(self, socketPath):
+        self.socketPath = socketPath
+
+    def request(self, request):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socketPath)
+        with sock, sock.makefile('rwb') as stream:
+            stream.write(json.dumps(request).encode('utf-8') + b'\n')
+            stream.flush()
+            response = json.loads(stream.readline().decode('utf-8'))
+
+        if 'error' in response:
+            raise RuntimeError("Scoring server error: %s" % response['error'])
+
+        return response
+
+    def getImageRBValues(self, imageFilenames, classifier, extension = 0, magicNumber = None, trainer = 'PSAT-D', backend = 'keras', **readOptions):
+        # readOptions are accepted so this can stand in for the local function, but the server reads the stamps its own way.
+        response = self.request({'filenames': list(imageFilenames),
+                                 'classifier': classifier,
+                                 'extension': extension,
+                                 'magicNumber': magicNumber,
+                                 'trainer': trainer,
+                                 'backend': backend})
+        return np.array([response['images'][f] for f in imageFilenames])
+
+    def getRBValues(self, imageFilenames, classifier, extension = 0, magicNumber = None, trainer = 'PSAT-D', backend = 'keras', **readOptions):
+        predictions = self.getImageRBValues(imageFilenames, classifier, extension = extension, magicNumber = magicNumber, trainer = trainer, backend = backend, **readOptions)
+        return groupRBValuesByObject(imageFilenames, predictions)
+
+    def scoreCandidates(self, candidates):
+        """Return the per-image and per-object scores for a list of candidate IDs."""
+        response = self.request({'candidates': [int(c) for c in candidates]})
+        return response['images'], response['objects']
+
+
+class ScoringRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # A client may send several requests down the same connection.
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.score(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                response = {'error': '%s: %s' % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class ScoringServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, options, config):
+        self.options = options
+        self.config = config
+        self.conn = None
+        # The database connection is shared by all client threads. The models are too, but
+        # modelRegistry only lets one thread at a time predict with each of them.
+        self.dbLock = threading.Lock()
+
+        # Given a PS1 or PS2 classifier, the data is Pan-STARRS and the ATLAS classifiers aren't used.
+        self.ps1Data = False
+        if options.ps1classifier or options.ps2classifier:
+            self.ps1Data = True
+
+        # Load every classifier we've been given now, so no request pays for it.
+        # These are the only classifiers the server will score with.
+        self.classifiers = set()
+        for site in configureSites(options, 'ps1' if self.ps1Data else 'atlas', sitesFile = options.sites):
+            if site['classifier']:
+                print("Loading %s classifier %s" % (site['name'], site['classifier']))
+                getModel(site['classifier'], trainer = options.trainer, backend = options.backend)
+                self.classifiers.add(os.path.realpath(site['classifier']))
+
+        # How the stamps are read is the server's choice, not the client's.
+        self.readOptions = {'batchSize': int(options.batchsize),
+                            'queueDepth': int(options.queuedepth),
+                            'readThreads': int(options.readthreads),
+                            'stampCache': options.stampcache,
+                            'stampCacheSize': int(options.stampcachesize),
+                            'memoryBudget': options.memorybudget,
+                            'scoreStore': options.scorestore,
+                            'readOrder': options.readorder}
+
+        if os.path.exists(socketPath):
+            os.unlink(socketPath)
+
+        socketserver.UnixStreamServer.__init__(self, socketPath, ScoringRequestHandler)
+
+    def getConnection(self):
+        """Return the database connection, reconnecting if the server has dropped it."""
+        if self.conn is not None:
+            try:
+                self.conn.ping()
+            except Exception:
+                self.conn = None
+
+        if self.conn is None:
+            db = self.config['databases']['local']
+            self.conn = dbConnect(db['hostname'], db['username'], db['password'], db['database'])
+            if not self.conn:
+                self.conn = None
+                raise RuntimeError("Cannot connect to the database")
+            self.conn.autocommit(True)
+
+        return self.conn
+
+    def checkScorer(self, classifier, trainer, backend):
+        """Refuse anything but the server's own site classifiers, trainer and backend."""
+        if trainer != self.options.trainer:
+            raise ValueError("This server only uses the %s trainer, not %s" % (self.options.trainer, trainer))
+        if backend != self.options.backend:
+            raise ValueError("This server only uses the %s backend, not %s" % (self.options.backend, backend))
+        if not isinstance(classifier, str) or os.path.realpath(classifier) not in self.classifiers:
+            raise ValueError("%s is not one of this server's classifiers" % classifier)
+
+    def scoreImages(self, imageFilenames, classifier, extension = 0, magicNumber = None, trainer = 'PSAT-D', backend = 'keras', **readOptions):
+        """Score the images. Any readOptions are ignored in favour of the server's own."""
+        self.checkScorer(classifier, trainer, backend)
+        magicNumber = int(magicNumber) if magicNumber is not None else None
+        predictions = getImageRBValues(imageFilenames, classifier, extension = int(extension), magicNumber = magicNumber, trainer = trainer, backend = backend, **self.readOptions)
+        return dict(zip(imageFilenames, [float(p) for p in predictions]))
+
+    def score(self, request):
+        imageScores = {}
+
+        def rbValues(imageFilenames, classifier, extension = 0, magicNumber = None, trainer = 'PSAT-D', backend = 'keras', **readOptions):
+            scores = self.scoreImages(imageFilenames, classifier, extension = extension, magicNumber = magicNumber, trainer = trainer, backend = backend, **readOptions)
+            imageScores.update(scores)
+            return np.array([scores[f] for f in imageFilenames])
+
+        if 'filenames' in request:
+            predictions = rbValues(request['filenames'],
+                                   request['classifier'],
+                                   extension = int(request.get('extension', 0)),
+                                   magicNumber = request.get('magicNumber'),
+                                   trainer = request.get('trainer', self.options.trainer),
+                                   backend = request.get('backend', self.options.backend))
+            # The images are all scored by one classifier, so count them as one site.
+            objects, scores = aggregateScores([objectIdFromFilename(f) for f in request['filenames']], np.zeros(len(predictions), dtype = int), predictions, rule = self.options.aggregation)
+            objectScores = dict(zip(objects.tolist(), scores.tolist()))
+
+        elif 'candidates' in request:
+            objectList = [{'id': int(candidate)} for candidate in request['candidates']]
+            with self.dbLock:
+                images = getImages(self.getConnection(), self.config['databases']['local']['database'], objectList, imageRoot = self.options.imageroot)
+            finalScores = getObjectScores(images, self.options, ps1Data = self.ps1Data, rbValues = rbValues)
+            objectScores = dict((k, float(v)) for k, v in finalScores.items())
+
+        else:
+            raise ValueError("Request must contain either filenames or candidates")
+
+        return {'images': imageScores, 'objects': objectScores}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        if self.conn is not None:
+            self.conn.close()
+
+
+def scoringServer(opts):
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    if type(opts) is dict:
+        options = Struct(**opts)
+    else:
+        options = opts
+
+    import yaml
+    with open(options.configFile) as yaml_file:
+        config = yaml.load(yaml_file)
+
+    server = ScoringServer(options.socket, options, config)
+
+    # Shut down cleanly (and remove the socket) when cron or systemd stops us.
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+
+    print("Listening on %s" % options.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    opts = docopt(__doc__, version='0.1')
+    opts = cleanOptions(opts)
+
+    # Use utils.Struct to convert the dict into an object for compatibility with old optparse code.
+    options = Struct(**opts)
+    scoringServer(options)
+
+
+if __name__=='__main__':
+    main()
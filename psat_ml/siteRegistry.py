@@ -0,0 +1,105 @@
+"""Registry of the sites (telescopes) whose images are scored with their own classifier.
+
+The sites are described in a YAML file (sites.yaml next to this module by
+default). Each one says which images belong to it, which classifier, FITS
+extension and magic number to use. The image list is partitioned between the
+sites in a single pass, so adding a telescope means adding an entry to the
+file rather than another pass over the images and another block of code.
+"""
+import os
+
+SITES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sites.yaml')
+
+SITE_DEFAULTS = {'column': 'filename',
+                 'classifier': None,
+                 'extension': 0,
+                 'magicNumber': None,
+                 'magicNumberOption': False,
+                 'weight': 1.0}
+
+
+def loadSites(sitesFile = None):
+    """Read the list of sites from the YAML file, filling in any missing settings."""
+    import yaml
+    if sitesFile is None:
+        sitesFile = SITES_FILE
+
+    with open(sitesFile) as yaml_file:
+        config = yaml.safe_load(yaml_file)
+
+    sites = []
+    for entry in config['sites']:
+        site = dict(SITE_DEFAULTS)
+        site.update(entry)
+        if site['column'] not in ('filename', 'filter'):
+            raise ValueError("Site %s: column must be filename or filter" % site['name'])
+        site['match'] = str(site['match'])
+        site['weight'] = float(site['weight'])
+        sites.append(site)
+
+    return sites
+
+
+def configureSites(options, survey, sitesFile = None):
+    """Return the sites of the specified survey (atlas or ps1), with the classifier
+       and magic number resolved from the command line options where given.
+    """
+    magicNumber = None
+    if options.magicNumber:
+        magicNumber = int(options.magicNumber)
+
+    sites = []
+    for site in loadSites(sitesFile):
+        if site['survey'] != survey:
+            continue
+
+        # e.g. --hkoclassifier overrides the classifier in the sites file.
+        classifier = getattr(options, site['name'] + 'classifier', None)
+        if classifier:
+            site['classifier'] = classifier
+
+        if site['magicNumberOption'] and magicNumber is not None:
+            site['magicNumber'] = magicNumber
+
+        sites.append(site)
+
+    return sites
+
+
+def partitionImages(imageRows, sites):
+    """Split the image rows (filename, filter) between the sites in a single pass.
+       Each image goes to the first site it matches. Images that match no site are dropped.
+
+       returns: a list of filename lists, one per site.
+    """
+    partitions = [[] for site in sites]
+    matchers = [(i, site['column'], site['match']) for i, site in enumerate(sites)]
+
+    for row in imageRows:
+        i = matchSite(row, matchers)
+        if i is not None:
+            partitions[i].append(row['filename'])
+
+    return partitions
+
+
+def matchSite(row, matchers):
+    """Index of the first site whose (index, column, match) matcher the image row matches, or None."""
+    values = {'filename': os.path.basename(row['filename']), 'filter': row.get('filter') or ''}
+    for i, column, match in matchers:
+        if match in values[column]:
+            return i
+    return None
+
+
+def imageCost(imageRows, sites):
+    """Estimated cost of scoring the image rows: the sum of the weights of their sites.
+       Images that match no site aren't scored, so cost nothing.
+    """
+    matchers = [(i, site['column'], site['match']) for i, site in enumerate(sites)]
+    cost = 0.0
+    for row in imageRows:
+        i = matchSite(row, matchers)
+        if i is not None:
+            cost += sites[i]['weight']
+    return cost
@@ -0,0 +1,180 @@
+"""On-disk cache of normalised stamp vectors.
+
+The same stamp is often read, decompressed and normalised several times: by
+the nightly scorer, by re-runs with a new classifier and by buildMLDataSet
+when the object ends up in a training set. The cache stores the normalised
+vector (float32, raveled in Fortran order, as returned by the norm functions)
+keyed by the file's real path, size and mtime, the FITS extension, the magic
+number, the norm function and the extent. A file that is rewritten gets a new
+key, so stale vectors are never returned.
+
+The store is an SQLite file rather than HDF5 so that several scoring
+processes can read and write it at once and evicted vectors give their space
+back. The least recently used vectors are evicted once the cache grows beyond
+its size limit. Lookups don't write anything: the access times of the vectors
+found are kept in memory and written, with any new vectors, in one transaction
+per batch by putMany (or flush).
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Most keys looked up in one query (SQLite allows 999 parameters by default).
+LOOKUP_CHUNK_SIZE = 500
+
+# One open cache per (file, process). Worker processes open their own.
+_caches = {}
+
+
+def openStampCache(cacheFile, maxBytes = DEFAULT_MAX_BYTES):
+    """Return the process's StampCache for cacheFile, opening it the first time."""
+    key = (os.path.realpath(cacheFile), os.getpid())
+    cache = _caches.get(key)
+    if cache is None:
+        cache = StampCache(cacheFile, maxBytes = maxBytes)
+        _caches[key] = cache
+    return cache
+
+
+class StampCache(object):
+
+    def __init__(self, cacheFile, maxBytes = DEFAULT_MAX_BYTES):
+        self.cacheFile = cacheFile
+        self.maxBytes = int(maxBytes)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        # Access times of the vectors read since the last write, by key.
+        self.accessed = {}
+        # The reader threads share the connection.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cacheFile, timeout = 60, check_same_thread = False)
+        with self.conn:
+            self.conn.execute('pragma journal_mode=wal')
+            self.conn.execute('''create table if not exists stamps (
+                                     key text primary key,
+                                     vector blob not null,
+                                     nbytes integer not null,
+                                     accessed real not null)''')
+            self.conn.execute('create index if not exists stamps_accessed on stamps (accessed)')
+        self.totalBytes = self.conn.execute('select coalesce(sum(nbytes), 0) from stamps').fetchone()[0]
+
+    @staticmethod
+    def stampKey(imageFilename, extension, magicNumber, norm, extent):
+        """Raises OSError (as opening the file would) if the file doesn't exist."""
+        path = os.path.realpath(imageFilename)
+        stat = os.stat(path)
+        key = repr((path, stat.st_size, stat.st_mtime_ns, int(extension), magicNumber, norm, int(extent)))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.getMany([key]).get(key)
+
+    def getMany(self, keys):
+        """Return {key: vector} for those of the keys that are in the cache.
+           Their access times are written by the next putMany or flush.
+        """
+        found = {}
+        with self.lock:
+            for offset in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+                chunk = keys[offset:offset + LOOKUP_CHUNK_SIZE]
+                query = 'select key, vector from stamps where key in (%s)' % ','.join('?' * len(chunk))
+                for key, blob in self.conn.execute(query, chunk):
+                    found[key] = np.frombuffer(blob, dtype = np.float32)
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+            now = time.time()
+            for key in found:
+                self.accessed[key] = now
+        return found
+
+    def put(self, key, vector):
+        self.putMany([(key, vector)])
+
+    def putMany(self, items):
+        """Store the (key, vector) pairs, and the access times of the vectors read
+           since the last write, in a single transaction.
+        """
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            blob = np.ascontiguousarray(vector, dtype = np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self.lock:
+            if not rows and not self.accessed:
+                return
+            with self.conn:
+                self.writeAccessTimes()
+                self.conn.executemany('insert or replace into stamps (key, vector, nbytes, accessed) values (?, ?, ?, ?)', rows)
+            self.stores += len(rows)
+            self.totalBytes += sum(row[2] for row in rows)
+            if self.totalBytes > self.maxBytes:
+                self.evict()
+
+    def flush(self):
+        """Write the access times of the vectors read since the last write."""
+        with self.lock:
+            if self.accessed:
+                with self.conn:
+                    self.writeAccessTimes()
+
+    def writeAccessTimes(self):
+        """Must be called with the lock held, inside a transaction."""
+        self.conn.executemany('update stamps set accessed = ? where key = ?', [(accessed, key) for key, accessed in self.accessed.items()])
+        self.accessed = {}
+
+    def evict(self):
+        """Drop the least recently used vectors until the cache is at 90% of its limit.
+           Must be called with the lock held.
+        """
+        # Other processes may have added to the cache, so recount.
+        self.totalBytes = self.conn.execute('select coalesce(sum(nbytes), 0) from stamps').fetchone()[0]
+        excess = self.totalBytes - int(self.maxBytes * 0.9)
+        if excess <= 0:
+            return
+
+        freed = 0
+        keys = []
+        for key, nbytes in self.conn.execute('select key, nbytes from stamps order by accessed'):
+            keys.append((key,))
+            freed += nbytes
+            if freed >= excess:
+                break
+
+        with self.conn:
+            self.conn.executemany('delete from stamps where key = ?', keys)
+        self.evictions += len(keys)
+        self.totalBytes -= freed
+
+    def getOrCompute(self, imageFilename, extension, magicNumber, norm, extent, compute):
+        """Return the cached vector for the stamp, calling compute() and storing the result on a miss."""
+        key = self.stampKey(imageFilename, extension, magicNumber, norm, extent)
+        vector = self.get(key)
+        if vector is None:
+            vector = compute()
+            self.put(key, vector)
+        return vector
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': float(self.hits) / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'bytes': self.totalBytes}
+
+    def printStats(self):
+        stats = self.stats()
+        print("Stamp cache %s: %d hits, %d misses (%.1f%% hit rate), %d stored, %d evicted, %.1f MB" % (self.cacheFile, stats['hits'], stats['misses'], 100.0 * stats['hitRate'], stats['stores'], stats['evictions'], stats['bytes'] / 1024.0 / 1024.0))
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,181 @@
+"""Read postage stamps into fixed-size batches of normalised image tensors.
+
+The scorers used to read every stamp into one array before calling predict,
+so memory grew with the number of images and the CPU sat idle during I/O.
+readStampBatches reads the stamps in a background thread and hands back one
+batch at a time, holding at most queueDepth batches in memory, so predict can
+run on one batch while the next is being read.
+
+Opening and decompressing the FITS files is mostly I/O and zlib/rice work,
+which releases the GIL, so each batch's stamps can be read by a pool of
+readThreads threads writing straight into a preallocated stack. The whole
+stack is then masked and normalised at once as a TargetImageBatch.
+
+If a MemoryGovernor is given, it may change the size of each batch as it is
+read, to keep the process within its memory limit.
+
+Our stamps live in one directory per MJD, but the database hands them back in
+object order, so consecutive reads jump all over the disk. localityOrder gives
+an order that reads them directory by directory instead, and with readAhead
+the kernel is told (posix_fadvise WILLNEED) about each batch's files while the
+batch before it is being read, so the disk or NFS server can fetch them ahead.
+
+If a StampCache is given, the normalised stamps are read through it. The time
+spent decoding and normalising the stamps (cache misses only) is added to the
+current ScoringMetrics.
+"""
+import os
+import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from TargetImage import TargetImageBatch, readStamp
+from scoringMetrics import getMetrics
+
+IMAGE_DIM = 20
+
+
+def localityOrder(imageFilenames):
+    """Return the indices of the filenames in the order to read them: grouped by
+       directory (for our images, by MJD) and by name within each directory.
+    """
+    return np.array(sorted(range(len(imageFilenames)), key = lambda i: os.path.split(imageFilenames[i])), dtype = int)
+
+
+def adviseWillNeed(imageFilenames):
+    """Tell the kernel we are about to read these files, so it can start reading them
+       in the background. Does nothing where posix_fadvise isn't available.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for imageFilename in imageFilenames:
+        try:
+            fd = os.open(imageFilename, os.O_RDONLY)
+        except OSError:
+            # Missing files are dealt with when the stamp is read.
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def fillBatch(batch, imageFilenames, extension = 0, magicNumber = None, pool = None, cache = None):
+    """Fill the preallocated (n, image_dim, image_dim, 1) batch from the image files,
+       using the thread pool if one is given. The whole batch is looked up in the
+       cache at once, each thread reads its own rows of the rest, then they are
+       normalised together.
+    """
+    image_dim = batch.shape[1]
+    extent = image_dim // 2
+    metrics = getMetrics()
+    images = np.zeros((len(imageFilenames), image_dim, image_dim), dtype = np.float32)
+    cached = np.zeros(len(imageFilenames), dtype = bool)
+
+    def stampKey(imageFilename):
+        return cache.stampKey(imageFilename, extension, magicNumber, 'signPreserveNorm', extent)
+
+    if cache is not None:
+        # Look the whole batch up in one query rather than one per stamp.
+        keys = list(pool.map(stampKey, imageFilenames)) if pool is not None else [stampKey(f) for f in imageFilenames]
+        found = cache.getMany(keys)
+        for j, key in enumerate(keys):
+            vector = found.get(key)
+            if vector is not None:
+                batch[j,:,:,0] = np.reshape(vector, (image_dim, image_dim), order="F")
+                cached[j] = True
+
+    def read(j):
+        start = time.perf_counter()
+        images[j] = readStamp(imageFilenames[j], extent, extension)
+        metrics.add('fitsDecode', time.perf_counter() - start, 1)
+
+    toNormalise = np.flatnonzero(~cached)
+    if pool is None:
+        for j in toNormalise:
+            read(j)
+    else:
+        # list() makes sure any exception raised by a reader thread is raised here.
+        list(pool.map(read, toNormalise))
+
+    if len(toNormalise) > 0:
+        with metrics.stage('normalisation', len(toNormalise)):
+            if len(toNormalise) < len(imageFilenames):
+                images = images[toNormalise]
+            normalised = TargetImageBatch(images, extent, magicNumber = magicNumber).signPreserveNorm()
+            batch[toNormalise,:,:,0] = normalised
+
+    if cache is not None:
+        # The new vectors and the access times of the cached ones go in one transaction.
+        vectors = TargetImageBatch.unravel(normalised) if len(toNormalise) > 0 else []
+        cache.putMany([(keys[j], vectors[i]) for i, j in enumerate(toNormalise)])
+
+    return batch
+
+
+def readStampBatches(imageFilenames, batchSize = 1024, queueDepth = 4, extension = 0, magicNumber = None, image_dim = IMAGE_DIM, readThreads = 1, cache = None, governor = None, readAhead = False):
+    """Generator yielding (offset, batch) pairs, where batch holds the normalised
+       stamps of imageFilenames[offset:offset + len(batch)]. The stamps are read
+       in the background, by readThreads threads, at most queueDepth batches ahead.
+       The batches are batchSize long unless a governor says otherwise. If readAhead
+       is set, the kernel is asked to fetch the files of the next batch while each
+       batch is read.
+    """
+    batches = queue.Queue(maxsize = max(1, queueDepth))
+    stop = threading.Event()
+
+    def reader():
+        pool = None
+        if readThreads > 1:
+            pool = ThreadPoolExecutor(max_workers = readThreads)
+        hints = None
+        if readAhead:
+            hints = ThreadPoolExecutor(max_workers = 1)
+            hints.submit(adviseWillNeed, imageFilenames[:batchSize])
+        try:
+            offset = 0
+            size = batchSize
+            while offset < len(imageFilenames):
+                if stop.is_set():
+                    return
+                if governor is not None:
+                    size = governor.adjust(size)
+                chunk = imageFilenames[offset:offset + size]
+                if hints is not None:
+                    hints.submit(adviseWillNeed, imageFilenames[offset + len(chunk):offset + len(chunk) + size])
+                batch = np.zeros((len(chunk), image_dim, image_dim, 1), dtype = np.float32)
+                batches.put((offset, fillBatch(batch, chunk, extension = extension, magicNumber = magicNumber, pool = pool, cache = cache)))
+                offset += len(chunk)
+        except Exception as e:
+            # Hand the problem over to the consumer rather than dying silently.
+            batches.put(e)
+            return
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if hints is not None:
+                hints.shutdown(wait = False)
+        batches.put(None)
+
+    thread = threading.Thread(target = reader, daemon = True)
+    thread.start()
+
+    try:
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # If the consumer gives up early, let the reader finish rather than block on a full queue.
+        stop.set()
+        while thread.is_alive():
+            try:
+                batches.get(timeout = 0.1)
+            except queue.Empty:
+                pass